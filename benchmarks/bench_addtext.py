@@ -0,0 +1,54 @@
+"""
+Micro-benchmark for `DraftMessage.addtext()`
+
+Times appending a body built from many small pieces, followed by the joining
+that `DraftMessage.compile()` performs, at increasing total body sizes.  The
+cost per byte should stay roughly constant as the body grows; if it instead
+grows with the body size (as it would if each append copied the text
+accumulated so far), the script exits with an error.
+
+Run with ``python benchmarks/bench_addtext.py``.
+"""
+
+from __future__ import annotations
+from functools import partial
+import sys
+from timeit import repeat
+from daemail.message import DraftMessage
+
+PIECE = "> This is a line of quoted command output.\n"
+
+SIZES = [1 << 20, 4 << 20, 16 << 20]
+
+# Maximum allowed ratio between the per-byte costs for the largest and
+# smallest body sizes
+MAX_GROWTH = 3.0
+
+
+def build(npieces: int) -> None:
+    msg = DraftMessage(from_addr=None, to_addrs=[], subject="Benchmark")
+    for _ in range(npieces):
+        msg.addtext(PIECE)
+    (body,) = msg.iterparts()
+    assert isinstance(body, str)
+    assert len(body) == npieces * len(PIECE)
+
+
+def main() -> int:
+    costs = []
+    for size in SIZES:
+        npieces = size // len(PIECE)
+        t = min(repeat(partial(build, npieces), number=1, repeat=5))
+        cost = t / (npieces * len(PIECE)) * 1e9
+        costs.append(cost)
+        print(f"{size >> 20:4d} MiB: {t * 1000:9.2f} ms  {cost:6.3f} ns/byte")
+    growth = costs[-1] / costs[0]
+    print(f"Per-byte cost growth: {growth:.2f}x")
+    if growth > MAX_GROWTH:
+        print("FAIL: appending text is superlinear in body size", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,278 @@
+"""
+Benchmark for the capture → report → compile → send pipeline
+
+Runs a command producing a given amount of synthetic output through
+`CommandRunner.run()`, `CommandReporter.report()`, `DraftMessage.compile()`,
+and `TryingSender.send_message()`, and reports the throughput of each stage
+and of the pipeline as a whole along with the peak RSS.  Each case is run in
+a fresh subprocess so that its peak RSS is measured in isolation.
+
+Cases cover every combination of:
+
+- output sizes from 1 KiB up to 64 MiB (or up to 1 GiB with ``--full``)
+- text output (quoted in the body) and binary output (attached)
+- merged and split stdout & stderr
+- output captured in memory, spooled straight to disk (``--spool-size 0``),
+  and spooled to disk past a 1 MiB threshold (``--spool-size 1M``)
+- a ``null`` outgoing sender (for which any deferred parts are expanded in
+  memory), an ``mbox`` sender, and a ``sink`` that streams the message
+  through `write_message()` and discards it
+
+Results can be saved with ``--json FILE`` and compared against an earlier run
+with ``--compare FILE``, in which case the script exits with an error if any
+case's throughput dropped or peak RSS grew by more than ``--tolerance``.
+
+Run with ``python benchmarks/bench_pipeline.py``.
+"""
+
+from __future__ import annotations
+import argparse
+from dataclasses import asdict, dataclass
+from email.headerregistry import Address
+import itertools
+import json
+import os
+from pathlib import Path
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from daemail.reporter import CommandReporter
+from daemail.runner import CommandResult, CommandRunner
+from daemail.senders import TryingSender
+from daemail.stream import write_message
+from daemail.timings import Timings
+
+SIZES = [1 << 10, 1 << 20, 16 << 20, 64 << 20]
+
+FULL_SIZES = [*SIZES, 256 << 20, 1 << 30]
+
+KINDS = ["text", "binary"]
+
+MODES = ["merged", "split"]
+
+#: Mapping from names of ways of capturing output to `CommandRunner`
+#: ``spool_size`` values
+SPOOLS: dict[str, int | None] = {"memory": None, "disk": 0, "1M": 1 << 20}
+
+SENDERS = ["null", "mbox", "sink"]
+
+# Writes the requested number of bytes of text or binary data to stdout, with
+# one tenth as much written to stderr
+GENERATOR = """\
+import os, sys
+size, kind = int(sys.argv[1]), sys.argv[2]
+if kind == "text":
+    line = b"Line %05d of synthetic command output\\n"
+    block = b"".join(line % i for i in range(1600))
+else:
+    block = os.urandom(65536)
+for fd, n in ((1, size), (2, size // 10)):
+    while n > 0:
+        n -= os.write(fd, block[:n])
+"""
+
+
+@dataclass
+class Case:
+    size: int
+    kind: str
+    mode: str
+    spool: str
+    sender: str
+
+    @property
+    def name(self) -> str:
+        return (
+            f"{showsize(self.size)}-{self.kind}-{self.mode}-{self.spool}"
+            f"-{self.sender}"
+        )
+
+
+@dataclass
+class Result:
+    case: str
+    #: Total bytes of captured output
+    nbytes: int
+    #: Seconds taken by each stage
+    stages: dict[str, float]
+    #: Peak RSS of the benchmarking process in bytes
+    maxrss: int
+
+    @property
+    def total(self) -> float:
+        return sum(self.stages.values())
+
+    def throughput(self, stage: str | None = None) -> float:
+        """
+        Return the throughput in MB/s of the given stage, or of the whole
+        pipeline if ``stage`` is `None`
+        """
+        t = self.total if stage is None else self.stages[stage]
+        return self.nbytes / max(t, 1e-9) / 1e6
+
+
+def run_case(case: Case, tmpdir: str) -> Result:
+    runner = CommandRunner(
+        no_stderr=False,
+        no_stdout=False,
+        split=case.mode == "split",
+        spool_size=SPOOLS[case.spool],
+    )
+    binary = case.kind == "binary"
+    reporter = CommandReporter(
+        encoding="utf-8",
+        failure_only=False,
+        from_addr=Address("Benchmark", addr_spec="bench@example.com"),
+        mime_type="application/octet-stream" if binary else None,
+        nonempty=False,
+        stderr_encoding="utf-8",
+        stdout_filename="stdout.bin" if binary else None,
+        to_addrs=[Address("Recipient", addr_spec="null@example.com")],
+        utc=False,
+    )
+    if case.sender == "mbox":
+        config = {"method": "mbox", "path": os.path.join(tmpdir, "bench.mbox")}
+    else:
+        config = {"method": "null"}
+    from outgoing import from_dict
+
+    with from_dict(config) as sender:
+        mailer = TryingSender(
+            sender=sender, dead_letter_path=os.path.join(tmpdir, "dead.letter")
+        )
+        timings = Timings()
+        with timings.stage("capture"):
+            r = runner.run(sys.executable, "-c", GENERATOR, str(case.size), case.kind)
+        assert isinstance(r, CommandResult), r
+        nbytes = len(r.stdout or b"") + len(r.stderr or b"")
+        with timings.stage("report"):
+            msg = reporter.report(r)
+        assert msg is not None
+        with timings.stage("compile"):
+            msgobj = msg.compile(deferred=True)
+        with timings.stage("send"):
+            if case.sender == "sink":
+                write_message(msgobj, discard)
+            else:
+                outcome = mailer.send_message(msgobj)
+                assert outcome == "sent", outcome
+        r.close()
+    return Result(
+        case=case.name,
+        nbytes=nbytes,
+        stages={st.name: st.duration for st in timings.stages},
+        maxrss=peak_rss(),
+    )
+
+
+def discard(_data: bytes) -> None:
+    pass
+
+
+def peak_rss() -> int:
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes everywhere but macOS, where it's in bytes
+    return ru.ru_maxrss if sys.platform == "darwin" else ru.ru_maxrss * 1024
+
+
+def run_isolated(case: Case) -> Result:
+    """Run ``case`` in a fresh Python process and return its result"""
+    r = subprocess.run(
+        [sys.executable, __file__, "--case", json.dumps(asdict(case))],
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return Result(**json.loads(r.stdout))
+
+
+def compare(results: list[Result], baseline: list[Result], tolerance: float) -> bool:
+    """
+    Print how each result compares to the baseline result for the same case,
+    and return `False` if any got worse by more than ``tolerance``
+    """
+    ok = True
+    before = {r.case: r for r in baseline}
+    for r in results:
+        if (b := before.get(r.case)) is None:
+            continue
+        speed = r.throughput() / b.throughput() - 1
+        rss = r.maxrss / b.maxrss - 1
+        flag = ""
+        if speed < -tolerance or rss > tolerance:
+            flag = "  REGRESSION"
+            ok = False
+        print(f"{r.case:40s}  throughput {speed:+7.1%}  peak RSS {rss:+7.1%}{flag}")
+    return ok
+
+
+def showsize(size: int) -> str:
+    for unit, shift in [("GiB", 30), ("MiB", 20), ("KiB", 10)]:
+        if size >= 1 << shift:
+            return f"{size >> shift}{unit}"
+    return f"{size}B"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark daemail's capture → report → compile → send pipeline"
+    )
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--full", action="store_true", help="Include output sizes up to 1 GiB"
+    )
+    parser.add_argument("--json", metavar="FILE", help="Save the results to FILE")
+    parser.add_argument(
+        "--compare", metavar="FILE", help="Compare the results to those in FILE"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Maximum allowed relative slowdown or peak RSS growth [default: 0.2]",
+    )
+    args = parser.parse_args()
+    if args.case is not None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            result = run_case(Case(**json.loads(args.case)), tmpdir)
+        print(json.dumps(asdict(result)))
+        return 0
+    cases = [
+        Case(*c)
+        for c in itertools.product(
+            FULL_SIZES if args.full else SIZES, KINDS, MODES, SPOOLS, SENDERS
+        )
+    ]
+    results = []
+    print(
+        f"{'case':40s} {'total MB/s':>10s} {'capture':>9s} {'report':>9s}"
+        f" {'compile':>9s} {'send':>9s} {'peak RSS':>10s}"
+    )
+    start = time.monotonic()
+    for case in cases:
+        r = run_isolated(case)
+        results.append(r)
+        print(
+            f"{r.case:40s} {r.throughput():10.1f}"
+            + "".join(
+                f" {r.throughput(st):9.1f}"
+                for st in ("capture", "report", "compile", "send")
+            )
+            + f" {r.maxrss / 1048576:6.1f} MiB"
+        )
+    print(f"Finished in {time.monotonic() - start:.1f} s")
+    if args.json is not None:
+        Path(args.json).write_text(
+            json.dumps([asdict(r) for r in results], indent=4) + "\n"
+        )
+    if args.compare is not None:
+        baseline = [Result(**r) for r in json.loads(Path(args.compare).read_text())]
+        if not compare(results, baseline, args.tolerance):
+            print("FAIL: performance regressed", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
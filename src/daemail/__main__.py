@@ -1,32 +1,46 @@
 from __future__ import annotations
 from codecs import getdecoder
-from contextlib import AbstractContextManager
-from dataclasses import dataclass
+from collections.abc import Callable, Iterator
+from contextlib import ExitStack, contextmanager, suppress
+from dataclasses import dataclass, field
 from email.headerregistry import Address
 import locale
 import os
 from pathlib import Path
+from queue import Full, Queue
+from signal import Signals
 import sys
+from threading import Lock, Thread
+import time
 import traceback
-from typing import Any
+from typing import IO, TYPE_CHECKING, Any
 import click
-import daemon
-from daemon.daemon import DaemonError
-from mailbits import ContentType
-from morecontext import dirchanged
-from outgoing import from_config_file, get_default_configpath
 
 # Import runner instead of runner.CommandRunner etc. for mocking purposes
 from . import __version__, reporter, runner, senders
+from .capture import get_compressor
+from .dedup import DedupStore, hash_sinks
+from .digest import KEY_RGX, Digest, compose_digest
+from .metrics import JobMetrics, MetricsSink, output_size
+from .stream import written_size
+from .timings import NullTimings, Timings
 from .util import (
     AddressParamType,
+    DurationParamType,
+    SignalParamType,
+    SizeParamType,
     dt2stamp,
     dtnow,
     get_mime_type,
     multiline822,
+    parse_batch,
     show_argv,
 )
 
+if TYPE_CHECKING:
+    from .message import DraftMessage
+    from .runner import Progress
+
 outfile_type = click.Path(writable=True, dir_okay=False, resolve_path=True)
 
 
@@ -41,6 +55,8 @@ def validate_encoding(_ctx: click.Context, _param: click.Parameter, value: Any)
 
 def validate_mime_type(_ctx: click.Context, _param: click.Parameter, value: Any) -> Any:
     if value is not None:
+        from mailbits import ContentType
+
         try:
             ContentType.parse(value)
         except ValueError:
@@ -48,6 +64,30 @@ def validate_mime_type(_ctx: click.Context, _param: click.Parameter, value: Any)
     return value
 
 
+def validate_compression(
+    _ctx: click.Context, _param: click.Parameter, value: Any
+) -> Any:
+    if value is not None:
+        try:
+            get_compressor(value)
+        except ImportError:
+            raise click.BadParameter(
+                f"{value} compression requires the zstandard package" " or Python 3.14+"
+            )
+    return value
+
+
+def validate_digest_key(
+    _ctx: click.Context, _param: click.Parameter, value: Any
+) -> Any:
+    if value is not None and not KEY_RGX.fullmatch(value):
+        raise click.BadParameter(
+            f"{value!r}: digest keys must consist of letters, numbers, hyphens,"
+            " underscores, and periods"
+        )
+    return value
+
+
 def get_cwd() -> str:
     # Prefer $PWD to os.getcwd() as the former does not resolve symlinks
     return os.environ.get("PWD") or os.getcwd()
@@ -66,12 +106,32 @@ def get_cwd() -> str:
     "--version",
     message="%(prog)s %(version)s",
 )
+@click.option(
+    "--batch",
+    type=click.File("r", encoding="utf-8"),
+    help="Run each command listed in FILE instead of a single COMMAND",
+    metavar="FILE",
+)
 @click.option(
     "-c",
     "--config",
-    type=click.Path(dir_okay=False),
-    default=get_default_configpath,
-    help="Specify the configuration file to use",
+    # Resolve now, as the file isn't read until after changing directory:
+    type=click.Path(dir_okay=False, resolve_path=True),
+    help="Specify the configuration file to use  [default: outgoing's default]",
+)
+@click.option(
+    "--compress",
+    type=click.Choice(["gzip", "xz", "zstd"]),
+    callback=validate_compression,
+    help="Compress stdout attachments with the given method",
+)
+@click.option(
+    "--compress-threshold",
+    type=SizeParamType(),
+    default="1M",
+    show_default=True,
+    metavar="SIZE",
+    help="Only compress stdout attachments at least this large",
 )
 @click.option(
     "-C",
@@ -88,6 +148,51 @@ def get_cwd() -> str:
     type=outfile_type,
     help="Append undeliverable mail to this file",
 )
+@click.option(
+    "--debug-timings",
+    is_flag=True,
+    help="Record how long each stage of handling the command takes",
+)
+@click.option(
+    "--dedup",
+    metavar="FILE",
+    type=click.Path(dir_okay=False, resolve_path=True),
+    help="Shrink failure reports identical to the previous run's, tracked in FILE",
+)
+@click.option(
+    "--dedup-suppress",
+    is_flag=True,
+    help="With --dedup, don't send repeated failure reports at all",
+)
+@click.option(
+    "--digest",
+    metavar="KEY",
+    callback=validate_digest_key,
+    help="Combine reports sharing KEY into a single digest e-mail",
+)
+@click.option(
+    "--digest-dir",
+    metavar="DIR",
+    type=click.Path(file_okay=False, resolve_path=True),
+    default=lambda: os.path.join(click.get_app_dir("daemail"), "digests"),
+    help="Store reports awaiting a digest e-mail in this directory",
+)
+@click.option(
+    "--digest-size",
+    type=SizeParamType(),
+    default="5M",
+    show_default=True,
+    metavar="SIZE",
+    help="Send a digest early once its reports total this many bytes",
+)
+@click.option(
+    "--digest-window",
+    type=DurationParamType(),
+    default="10m",
+    show_default=True,
+    metavar="DURATION",
+    help="Send a digest this long after its first report",
+)
 @click.option(
     "-e",
     "--encoding",
@@ -121,6 +226,33 @@ def get_cwd() -> str:
     is_flag=True,
     help="Only send e-mail if command returned nonzero",
 )
+@click.option(
+    "--heartbeat",
+    type=DurationParamType(positive=True),
+    metavar="DURATION",
+    help="Send a progress report this often while the command runs",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Run up to this many --batch commands at once",
+)
+@click.option(
+    "--combine",
+    is_flag=True,
+    help="Send a single combined report for all --batch commands",
+)
+@click.option(
+    "--kill-after",
+    type=DurationParamType(),
+    default="10s",
+    show_default=True,
+    metavar="DURATION",
+    help="Send SIGKILL this long after a timed-out command is signalled",
+)
 @click.option(
     "-l",
     "--logfile",
@@ -128,6 +260,12 @@ def get_cwd() -> str:
     type=outfile_type,
     help="Append unrecoverable errors to this file",
 )
+@click.option(
+    "--max-output",
+    type=SizeParamType(),
+    metavar="SIZE",
+    help="Only keep the first & last SIZE/2 bytes of output",
+)
 @click.option(
     "-M",
     "--mime-type",
@@ -135,6 +273,12 @@ def get_cwd() -> str:
     callback=validate_mime_type,
     help="Send output as attachment with given MIME type",
 )
+@click.option(
+    "--metrics",
+    metavar="PATH",
+    type=click.Path(dir_okay=False, resolve_path=True),
+    help="Append a JSON record about each command run to this file or socket",
+)
 @click.option(
     "-n",
     "--nonempty",
@@ -143,17 +287,46 @@ def get_cwd() -> str:
 )
 @click.option("--no-stdout", is_flag=True, help="Don't capture stdout")
 @click.option("--no-stderr", is_flag=True, help="Don't capture stderr")
+@click.option(
+    "--relay-socket",
+    metavar="PATH",
+    type=click.Path(dir_okay=False, resolve_path=True),
+    help="Send mail via the daemail-relayd listening on this socket",
+)
+@click.option(
+    "--rusage",
+    is_flag=True,
+    help="Report the command's resource usage",
+)
 @click.option(
     "-S",
     "--split",
     is_flag=True,
     help="Capture stdout and stderr separately",
 )
+@click.option(
+    "--spool-dir",
+    metavar="DIR",
+    type=click.Path(file_okay=False, resolve_path=True),
+    help="Queue mail in this directory for delivery by daemail-spoold",
+)
+@click.option(
+    "--spool-size",
+    type=SizeParamType(),
+    metavar="SIZE",
+    help="Spool captured output to disk once it exceeds SIZE",
+)
 @click.option(
     "--stdout-filename",
     metavar="FILENAME",
     help="Send output as attachment with given filename",
 )
+@click.option(
+    "--tee",
+    metavar="PATH",
+    type=click.Path(writable=True, dir_okay=False, resolve_path=True, allow_dash=True),
+    help="Also copy the command's output to this file (or to stdout if '-') as it runs",
+)
 @click.option(
     "-t",
     "--to-addr",
@@ -164,13 +337,31 @@ def get_cwd() -> str:
     required=True,
     help="To: address of e-mail",
 )
+@click.option(
+    "--timeout",
+    type=DurationParamType(),
+    metavar="DURATION",
+    help="Kill the command if it runs for longer than this",
+)
+@click.option(
+    "--timeout-signal",
+    type=SignalParamType(),
+    default="TERM",
+    show_default=True,
+    help="Signal to send to a command that runs past --timeout",
+)
+@click.option(
+    "--timestamps",
+    is_flag=True,
+    help="Prefix each line of output with the time at which it was received",
+)
 @click.option("-Z", "--utc", is_flag=True, help="Use UTC timestamps")
-@click.argument("command")
+@click.argument("command", required=False)
 @click.argument("args", nargs=-1, type=click.UNPROCESSED)
 def main(
-    command: str,
+    command: str | None,
     args: tuple[str, ...],
-    config: Path | str,
+    config: Path | str | None,
     chdir: str,
     foreground: bool,
     logfile: str,
@@ -180,17 +371,64 @@ def main(
     nonempty: bool,
     no_stdout: bool,
     no_stderr: bool,
+    relay_socket: str | None,
+    rusage: bool,
     split: bool,
+    spool_size: int | None,
+    spool_dir: str | None,
     encoding: str | None,
     stderr_encoding: str | None,
     mime_type: str | None,
+    max_output: int | None,
     stdout_filename: str | None,
+    compress: str | None,
+    compress_threshold: int,
     utc: bool,
     dead_letter: str,
+    digest: str | None,
+    digest_dir: str,
+    digest_size: int,
+    digest_window: float,
+    batch: IO[str] | None,
+    jobs: int,
+    combine: bool,
+    timeout: float | None,
+    timeout_signal: int,
+    timestamps: bool,
+    kill_after: float,
+    heartbeat: float | None,
+    tee: str | None,
+    metrics: str | None,
+    debug_timings: bool,
+    dedup: str | None,
+    dedup_suppress: bool,
 ) -> None:
     """Daemonize a command and e-mail the results"""
 
-    sender = from_config_file(config, fallback=False)
+    job: Callable[[], None]
+    if batch is not None:
+        if command is not None:
+            raise click.UsageError("COMMAND cannot be given with --batch")
+        try:
+            commands = parse_batch(batch.read())
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--batch")
+        if not commands:
+            raise click.BadParameter("no commands in file", param_hint="--batch")
+        batch_name = os.path.basename(batch.name)
+        job_desc = f"{len(commands)} commands from {batch.name}"
+    elif command is None:
+        raise click.UsageError("Missing argument 'COMMAND'.")
+    elif combine or jobs != 1:
+        raise click.UsageError("--combine and --jobs require --batch")
+    else:
+        job_desc = show_argv(command, *args)
+    if dedup_suppress and dedup is None:
+        raise click.UsageError("--dedup-suppress requires --dedup")
+    if timestamps and max_output is not None:
+        raise click.UsageError("--timestamps cannot be combined with --max-output")
+    if compress is not None and mime_type is None and stdout_filename is None:
+        raise click.UsageError("--compress requires --mime-type or --stdout-filename")
 
     if encoding is None:
         encoding = locale.getpreferredencoding(True)
@@ -204,11 +442,37 @@ def main(
         stdout_filename = "stdout"
         split = True
 
+    mailer = senders.TryingSender(
+        dead_letter_path=dead_letter,
+        # Don't load the configuration (and with it `outgoing`) until there's
+        # a message to send:
+        sender=None,
+        configpath=config,
+        spool_dir=spool_dir,
+        relay_socket=relay_socket,
+    )
+    # ... but do check for obvious problems with it while they can still be
+    # reported
+    try:
+        mailer.check_config()
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
     daemail = Daemail(
         runner=runner.CommandRunner(
             no_stderr=no_stderr,
             no_stdout=no_stdout,
             split=split,
+            spool_size=spool_size,
+            max_output=max_output,
+            rusage=rusage,
+            timeout=timeout,
+            timeout_signal=timeout_signal,
+            kill_after=kill_after,
+            heartbeat=heartbeat,
+            tee=tee,
+            events=timestamps,
+            sinks=hash_sinks if dedup is not None else None,
         ),
         reporter=reporter.CommandReporter(
             encoding=encoding,
@@ -220,53 +484,303 @@ def main(
             stdout_filename=stdout_filename,
             to_addrs=list(to_addr),
             utc=utc,
+            compress=compress,
+            compress_threshold=compress_threshold,
+            timestamps=timestamps,
+            dedup=DedupStore(dedup) if dedup is not None else None,
+            dedup_suppress=dedup_suppress,
         ),
-        mailer=senders.TryingSender(
-            dead_letter_path=dead_letter,
-            sender=sender,
+        mailer=mailer,
+        digest=(
+            Digest(
+                key=digest,
+                digest_dir=digest_dir,
+                window=digest_window,
+                max_size=digest_size,
+            )
+            if digest is not None
+            else None
         ),
+        metrics=MetricsSink(metrics) if metrics is not None else None,
+        timings=Timings() if debug_timings else NullTimings(),
     )
 
-    ctx: AbstractContextManager[Any]
-    if foreground:
-        ctx = dirchanged(chdir)
+    if batch is not None:
+
+        def job() -> None:
+            daemail.run_batch(
+                commands,
+                jobs=jobs,
+                combine_as=batch_name if combine else None,
+            )
+
     else:
-        ctx = daemon.DaemonContext(working_directory=chdir, umask=os.umask(0))
-    try:
-        with ctx:
+        assert command is not None
+
+        def job() -> None:
             daemail.run(command, *args)
+
+    if foreground:
+        from morecontext import dirchanged
+
+        with dirchanged(chdir):
+            job()
+        if debug_timings:
+            click.echo(f"Timings: {daemail.timings}", err=True)
+            log_timings(logfile, job_desc, daemail.timings)
+        return
+
+    import daemon
+    from daemon.daemon import DaemonError
+
+    try:
+        with daemon.DaemonContext(working_directory=chdir, umask=os.umask(0)):
+            job()
+            if debug_timings:
+                log_timings(logfile, job_desc, daemail.timings)
     except DaemonError:
         # Daemonization failed; report errors normally
         raise
     except Exception:
-        if foreground:
-            raise
         # Daemonization succeeded but mailer failed; report errors to logfile.
         # If this open() fails, die alone where no one will ever know.
         with open(logfile, "a", encoding="utf-8") as fp:
             print("daemail:", __version__, file=fp)
-            print("Command:", show_argv(command, *args), file=fp)
+            print("Command:", job_desc, file=fp)
             print("Date:", dt2stamp(dtnow()), file=fp)
             print("Configuration:", file=fp)
             print(multiline822(daemail.shows_config()), file=fp)
             print("Chdir:", repr(chdir), file=fp)
+            if debug_timings:
+                print("Timings:", daemail.timings, file=fp)
             print("Traceback:", file=fp)
             print(multiline822(traceback.format_exc()), file=fp)
             print("", file=fp)
         sys.exit(1)
 
 
+@dataclass
+class Job:
+    """
+    The outcome of running a single command.  The report may refer to the
+    command's captured output, and so the job must not be closed until the
+    report has been sent.
+    """
+
+    msg: DraftMessage | None
+    stats: JobMetrics
+    result: runner.CommandResult | runner.CommandError
+
+    def __enter__(self) -> Job:
+        return self
+
+    def __exit__(self, *_exc: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if isinstance(self.result, runner.CommandResult):
+            self.result.close()
+
+
 @dataclass
 class Daemail:
     runner: runner.CommandRunner
     reporter: reporter.CommandReporter
     mailer: senders.TryingSender
+    digest: Digest | None = None
+    metrics: MetricsSink | None = None
+    #: Records the time taken by each stage of `run()`.  Batches of commands
+    #: are not timed.
+    timings: Timings = field(default_factory=NullTimings)
+    #: Lock held while sending mail so that the mailer is only ever used by
+    #: one thread at a time
+    send_lock: Lock = field(default_factory=Lock, repr=False)
 
     def run(self, command: str, *args: str) -> None:
-        r = self.runner.run(command, *args)
-        msg = self.reporter.report(r)
+        with self.heartbeats():
+            job = self.run_job([command, *args], self.timings)
+        with job:
+            self.dispatch(job.msg, [job], self.timings)
+
+    def run_batch(
+        self, commands: list[list[str]], jobs: int, combine_as: str | None = None
+    ) -> None:
+        """
+        Run ``commands`` with up to ``jobs`` of them running at once.  If
+        ``combine_as`` is `None`, each command's report is sent as soon as the
+        command finishes; otherwise, all of the reports are sent together as a
+        single e-mail labelled with ``combine_as`` once every command has
+        finished.
+        """
+        # Only --batch needs concurrent.futures (which imports logging), so
+        # don't load it at startup
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        with (
+            self.heartbeats(slots=jobs),
+            ThreadPoolExecutor(max_workers=jobs) as pool,
+        ):
+            futures = [pool.submit(self.run_job, argv) for argv in commands]
+            # If anything goes wrong with one job, carry on with the others so
+            # that all of their `Job`s are closed (and, if not combining, their
+            # reports sent) before re-raising the first error
+            errors: list[BaseException] = []
+            if combine_as is None:
+                # Send from this thread only so that the sender is never used
+                # by more than one thread at a time
+                for fut in as_completed(futures):
+                    if (exc := fut.exception()) is not None:
+                        errors.append(exc)
+                        continue
+                    with fut.result() as job:
+                        try:
+                            self.dispatch(job.msg, [job])
+                        except Exception as e:
+                            errors.append(e)
+                if errors:
+                    raise errors[0]
+            else:
+                with ExitStack() as stack:
+                    jobs_done = []
+                    for fut in futures:
+                        if (exc := fut.exception()) is not None:
+                            errors.append(exc)
+                        else:
+                            jobs_done.append(stack.enter_context(fut.result()))
+                    if errors:
+                        raise errors[0]
+                    msgs = [j.msg for j in jobs_done if j.msg is not None]
+                    combined: DraftMessage | None
+                    if msgs:
+                        reports = [m.compile() for m in msgs]
+                        combined = compose_digest(
+                            combine_as, reports, msgs[0], tag="BATCH"
+                        )
+                    else:
+                        combined = None
+                    self.dispatch(combined, jobs_done)
+
+    def run_job(self, argv: list[str], timings: Timings | None = None) -> Job:
+        """
+        Run a command and return the report to send for it, if any, along
+        with measurements of the run.  The returned `Job` must be closed once
+        the report has been sent.
+        """
+        if timings is None:
+            timings = NullTimings()
+        with timings.stage("run") as st:
+            r = self.runner.run(*argv)
+        if timings.enabled and isinstance(r, runner.CommandResult):
+            st.nbytes = (output_size(r.stdout) or 0) + (output_size(r.stderr) or 0)
+        t0 = time.monotonic()
+        try:
+            with timings.stage("report"):
+                msg = self.reporter.report(r)
+        except BaseException:
+            if isinstance(r, runner.CommandResult):
+                r.close()
+            raise
+        return Job(msg, JobMetrics.from_result(r, time.monotonic() - t0), r)
+
+    def dispatch(
+        self,
+        msg: DraftMessage | None,
+        jobs: list[Job],
+        timings: Timings | None = None,
+    ) -> None:
+        """
+        Send ``msg`` (if it's not `None`), and then record the command runs it
+        reports on for deduplication and write out their metrics.  Runs whose
+        report ended up in the dead letter mbox are not recorded, so that the
+        next report for the command isn't shrunk to a repeat notice.
+        """
+        outcome: str | None = None
         if msg is not None:
-            self.mailer.send(msg)
+            t0 = time.monotonic()
+            outcome = self.send(msg, timings)
+            elapsed = time.monotonic() - t0
+            for job in jobs:
+                job.stats.send_time = elapsed
+                job.stats.send_outcome = outcome
+        if outcome != "dead-letter":
+            for job in jobs:
+                self.reporter.record(job.result)
+        if self.metrics is not None:
+            for job in jobs:
+                try:
+                    self.metrics.write(job.stats.as_record())
+                except OSError:
+                    # Metrics are best-effort; failing to record them
+                    # shouldn't keep the remaining reports from being sent
+                    pass
+
+    def send(self, msg: DraftMessage, timings: Timings | None = None) -> str:
+        """
+        Send ``msg`` (possibly as part of a digest) and return how it was
+        handled.  If ``timings`` is enabled, the timings recorded so far are
+        added to the message in an :mailheader:`X-Daemail-Timings` header.
+        """
+        if timings is None:
+            timings = NullTimings()
+        if self.digest is not None:
+            with timings.stage("digest"):
+                # Only hold the lock while actually sending, not while storing
+                # the report
+                self.digest.add_report(msg, self.mailer, self.send_lock)
+            return "digest"
+        with self.send_lock:
+            with timings.stage("compile"):
+                msgobj = msg.compile(deferred=True)
+            if timings.enabled:
+                msgobj["X-Daemail-Timings"] = str(timings)
+            with timings.stage("send") as st:
+                outcome = self.mailer.send_message(msgobj)
+            if timings.enabled:
+                # The message is only serialized while it's being sent, so
+                # its size is counted then (if we did the serializing)
+                st.nbytes = written_size(msgobj)
+            return outcome
+
+    @contextmanager
+    def heartbeats(self, slots: int = 1) -> Iterator[None]:
+        """
+        While the context is active, turn the runner's heartbeats into
+        ``[RUNNING]`` reports and send them from a background thread so that
+        composing & sending them never holds up draining a command's output.
+        Up to ``slots`` heartbeats are queued at once; any more that arrive
+        while the thread is busy are dropped.
+        """
+        if self.runner.heartbeat is None:
+            yield
+            return
+        q: Queue[Progress | None] = Queue(maxsize=slots)
+
+        def enqueue(progress: Progress) -> None:
+            with suppress(Full):
+                q.put_nowait(progress)
+
+        def send_heartbeats() -> None:
+            while (progress := q.get()) is not None:
+                try:
+                    msg = self.reporter.heartbeat(progress)
+                    # Heartbeats bypass any digest, as they're only useful
+                    # while the command is still running
+                    with self.send_lock:
+                        self.mailer.send(msg)
+                except Exception:
+                    # Heartbeats are best-effort; don't let one failure stop
+                    # the rest
+                    pass
+
+        thread = Thread(target=send_heartbeats, name="daemail-heartbeat")
+        thread.start()
+        self.runner.on_heartbeat = enqueue
+        try:
+            yield
+        finally:
+            self.runner.on_heartbeat = None
+            q.put(None)
+            thread.join()
 
     def shows_config(self) -> str:
         s = ""
@@ -274,24 +788,71 @@ class Daemail:
         s += '"To:" addresses:\n'
         for t in self.reporter.to_addrs:
             s += "  " + str(t) + "\n"
-        s += f"Outgoing mail class: {type(self.mailer.sender)}\n"
+        s += "Outgoing config file: " + repr(self.mailer.configpath) + "\n"
+        if self.mailer.sender is not None:
+            s += f"Outgoing mail class: {type(self.mailer.sender)}\n"
         s += "Dead letter mbox: " + repr(self.mailer.dead_letter_path) + "\n"
+        s += "Spool directory: " + repr(self.mailer.spool_dir) + "\n"
+        s += "Relay socket: " + repr(self.mailer.relay_socket) + "\n"
+        if self.metrics is not None:
+            s += "Metrics sink: " + repr(self.metrics.path) + "\n"
         s += "Split stdout/stderr: " + yesno(self.runner.split) + "\n"
+        s += "Spool output after: " + showsize(self.runner.spool_size) + "\n"
+        s += "Maximum output: " + showsize(self.runner.max_output) + "\n"
+        s += "Report resource usage: " + yesno(self.runner.rusage) + "\n"
+        if self.runner.timeout is not None:
+            s += f"Timeout: {self.runner.timeout} seconds\n"
+            s += f"Timeout signal: {Signals(self.runner.timeout_signal).name}\n"
+            s += f"Kill after: {self.runner.kill_after} seconds\n"
+        if self.runner.heartbeat is not None:
+            s += f"Heartbeat interval: {self.runner.heartbeat} seconds\n"
+        s += "Timestamp output: " + yesno(self.reporter.timestamps) + "\n"
+        if self.reporter.dedup is not None:
+            s += "Deduplication store: " + repr(self.reporter.dedup.path) + "\n"
+            s += "Suppress repeats: " + yesno(self.reporter.dedup_suppress) + "\n"
+        if self.runner.tee is not None:
+            s += "Tee output to: " + repr(self.runner.tee) + "\n"
         s += "Capture stdout: " + yesno(not self.runner.no_stdout) + "\n"
         s += "stdout encoding: " + self.reporter.encoding + "\n"
         s += "stdout MIME type: " + str(self.reporter.mime_type) + "\n"
         s += "stdout filename: " + str(self.reporter.stdout_filename) + "\n"
+        s += "stdout compression: " + str(self.reporter.compress) + "\n"
+        s += (
+            "Compression threshold: "
+            + showsize(self.reporter.compress_threshold)
+            + "\n"
+        )
         s += "Capture stderr: " + yesno(not self.runner.no_stderr) + "\n"
         s += "stderr encoding: " + self.reporter.stderr_encoding + "\n"
+        if self.digest is not None:
+            s += "Digest key: " + self.digest.key + "\n"
+            s += "Digest directory: " + repr(self.digest.digest_dir) + "\n"
+            s += f"Digest window: {self.digest.window} seconds\n"
+            s += "Digest size: " + showsize(self.digest.max_size) + "\n"
         s += "Send iff failure: " + yesno(self.reporter.failure_only) + "\n"
         s += "Send iff nonempty: " + yesno(self.reporter.nonempty) + "\n"
         s += "UTC timestamps: " + yesno(self.reporter.utc) + "\n"
+        s += "Debug timings: " + yesno(self.timings.enabled) + "\n"
         return s.rstrip("\n")
 
 
+def log_timings(logfile: str, job_desc: str, timings: Timings) -> None:
+    """Append the timings for a command to the logfile"""
+    with open(logfile, "a", encoding="utf-8") as fp:
+        print("daemail:", __version__, file=fp)
+        print("Command:", job_desc, file=fp)
+        print("Date:", dt2stamp(dtnow()), file=fp)
+        print("Timings:", timings, file=fp)
+        print("", file=fp)
+
+
 def yesno(b: bool) -> str:
     return "yes" if b else "no"
 
 
+def showsize(size: int | None) -> str:
+    return "none" if size is None else f"{size} bytes"
+
+
 if __name__ == "__main__":
     main(prog_name=__package__)  # pragma: no cover
@@ -0,0 +1,436 @@
+from __future__ import annotations
+from abc import ABC, abstractmethod
+from collections.abc import Iterable, Iterator
+from dataclasses import dataclass
+import lzma
+import mmap
+import struct
+from tempfile import SpooledTemporaryFile
+import time
+from typing import Protocol
+import zlib
+
+#: Number of bytes to read from a pipe or buffer at a time
+CHUNK_SIZE = 65536
+
+
+class OutputSink(ABC):
+    """
+    Base class for destinations that a command's output is written to chunk
+    by chunk as it's captured.  `close()` is called once the command's output
+    has ended.
+    """
+
+    @abstractmethod
+    def write(self, chunk: bytes) -> None:
+        """Append a chunk of output"""
+        ...
+
+    def close(self) -> None:  # noqa: B027
+        """Release any resources held by the instance"""
+        pass
+
+
+class CapturedOutput(OutputSink):
+    """
+    Base class for containers of command output that are filled in chunk by
+    chunk while the command runs and then read back in chunks afterwards
+    """
+
+    @abstractmethod
+    def __len__(self) -> int: ...
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    @abstractmethod
+    def chunks(self, size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """Iterate over the stored output in chunks of at most ``size`` bytes"""
+        ...
+
+    def buffers(self, size: int = CHUNK_SIZE) -> Iterator[memoryview]:
+        """
+        Like `chunks()`, but yields read-only memoryviews that may refer
+        directly to the stored output rather than to copies of it.  Each view
+        is released when the next one is requested, so it must not be used
+        after that.
+        """
+        for chunk in self.chunks(size):
+            yield memoryview(chunk)
+
+    def getvalue(self) -> bytes:
+        """Return the complete stored output as a single `bytes` object"""
+        return b"".join(self.chunks())
+
+    def last_bytes(self, size: int) -> bytes:
+        """Return (at most) the last ``size`` bytes of the stored output"""
+        return self.getvalue()[-size:]
+
+
+class SpooledOutput(CapturedOutput):
+    """
+    Captured output that is held in memory until it grows past ``max_size``
+    bytes, at which point it is moved to a temporary file on disk.  If
+    ``max_size`` is 0, the output is written to disk from the start; if it is
+    `None`, the output is always kept in memory.
+    """
+
+    def __init__(self, max_size: int | None) -> None:
+        self.max_size = max_size
+        # SpooledTemporaryFile treats a max_size of 0 as "never roll over"
+        self._fp: SpooledTemporaryFile[bytes] = SpooledTemporaryFile(
+            max_size=max_size or 0
+        )
+        if max_size == 0:
+            self._fp.rollover()
+        self._size = 0
+
+    def __repr__(self) -> str:
+        return f"<SpooledOutput: {self._size} bytes, max_size={self.max_size}>"
+
+    def write(self, chunk: bytes) -> None:
+        self._fp.seek(0, 2)
+        self._fp.write(chunk)
+        self._size += len(chunk)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def rolled_over(self) -> bool:
+        """Whether the output has been moved to disk"""
+        return self.max_size is not None and self._size > self.max_size
+
+    def chunks(self, size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        # Seek before every read so that other iterations over (or writes to)
+        # the same instance in between don't throw this one off
+        pos = 0
+        while True:
+            self._fp.seek(pos)
+            blob = self._fp.read(size)
+            if not blob:
+                break
+            pos += len(blob)
+            yield blob
+
+    def buffers(self, size: int = CHUNK_SIZE) -> Iterator[memoryview]:
+        if not self.rolled_over:
+            yield from super().buffers(size)
+            return
+        # Map the temporary file into memory so that the output can be read
+        # without copying it into `bytes` objects first
+        self._fp.flush()
+        with (
+            mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ) as m,
+            memoryview(m) as view,
+        ):
+            for i in range(0, len(view), size):
+                with view[i : i + size] as piece:
+                    yield piece
+
+    def last_bytes(self, size: int) -> bytes:
+        self._fp.seek(max(self._size - size, 0))
+        return self._fp.read()
+
+    def close(self) -> None:
+        self._fp.close()
+
+
+class TruncatedOutput(CapturedOutput):
+    """
+    Captured output that is limited to a budget of ``max_size`` bytes: the
+    first half of the budget is filled with the start of the output, and the
+    rest is used as a ring buffer holding the most recent output.  Anything
+    in between is discarded, and the number of discarded bytes is recorded in
+    `omitted`.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.head_size = max_size // 2
+        self.tail_size = max_size - self.head_size
+        self._head = bytearray()
+        self._ring = bytearray(self.tail_size)
+        # Position in `_ring` at which the next byte will be written:
+        self._pos = 0
+        # Number of bytes currently stored in `_ring`:
+        self._filled = 0
+        #: Total number of bytes written
+        self.total = 0
+
+    def __repr__(self) -> str:
+        return (
+            f"<TruncatedOutput: {self.total} bytes, {self.omitted} omitted,"
+            f" max_size={self.max_size}>"
+        )
+
+    def write(self, chunk: bytes) -> None:
+        self.total += len(chunk)
+        data = memoryview(chunk)
+        if len(self._head) < self.head_size:
+            n = self.head_size - len(self._head)
+            self._head += data[:n]
+            data = data[n:]
+        if not data or not self.tail_size:
+            return
+        if len(data) >= self.tail_size:
+            self._ring[:] = data[-self.tail_size :]
+            self._pos = 0
+            self._filled = self.tail_size
+            return
+        n = min(len(data), self.tail_size - self._pos)
+        self._ring[self._pos : self._pos + n] = data[:n]
+        self._ring[: len(data) - n] = data[n:]
+        self._pos = (self._pos + len(data)) % self.tail_size
+        self._filled = min(self._filled + len(data), self.tail_size)
+
+    @property
+    def head(self) -> bytes:
+        """The start of the output"""
+        return bytes(self._head)
+
+    @property
+    def tail(self) -> bytes:
+        """The end of the output, not overlapping with `head`"""
+        if self._filled < self.tail_size:
+            return bytes(self._ring[: self._filled])
+        else:
+            return bytes(self._ring[self._pos :] + self._ring[: self._pos])
+
+    @property
+    def omitted(self) -> int:
+        """The number of bytes discarded from between `head` and `tail`"""
+        return self.total - len(self._head) - self._filled
+
+    def __len__(self) -> int:
+        return len(self._head) + self._filled
+
+    def last_bytes(self, size: int) -> bytes:
+        if self.omitted:
+            # Don't splice the head onto the tail across the gap
+            return self.tail[-size:]
+        return (self.head + self.tail)[-size:]
+
+    def chunks(self, size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        yield from output_chunks(self.head, size)
+        yield from output_chunks(self.tail, size)
+
+
+#: Stream ID of stdout in an `EventLog`
+STDOUT = 1
+
+#: Stream ID of stderr in an `EventLog`
+STDERR = 2
+
+#: Header of each record in an `EventLog`: the time at which the chunk was
+#: received in seconds since the start of the log, the ID of the stream it
+#: was read from, and the length of the chunk
+EVENT_HEADER = struct.Struct("!dBI")
+
+
+@dataclass
+class Event:
+    """A chunk of output read from one of a command's streams"""
+
+    #: Seconds since the start of the `EventLog`
+    offset: float
+    stream: int
+    data: bytes
+
+
+class EventLog:
+    """
+    Output read from multiple streams of a command, recorded as a single log
+    of timestamped chunks in the order in which they arrived.  The log is
+    stored in a `SpooledOutput` that moves to disk once it grows past
+    ``max_size`` bytes.
+
+    Output is written to the log and read back from it via `EventView`
+    instances, each of which covers one or more of the streams.
+    """
+
+    def __init__(self, max_size: int | None) -> None:
+        self._log = SpooledOutput(max_size)
+        #: Monotonic time from which event offsets are measured
+        self.start = time.monotonic()
+        # Number of bytes recorded for each stream:
+        self._sizes: dict[int, int] = {}
+        # The most recent output, overall and for each stream, kept so that
+        # `EventView.last_bytes()` doesn't need to read through the whole log:
+        self._tail = bytearray()
+        self._tails: dict[int, bytearray] = {}
+
+    def __repr__(self) -> str:
+        return f"<EventLog: {len(self._log)} bytes, streams={self._sizes}>"
+
+    def view(self, *streams: int) -> EventView:
+        """Return a view of the output from the given streams"""
+        return EventView(self, streams)
+
+    def record(self, stream: int, chunk: bytes) -> None:
+        """Append a chunk of output read from ``stream`` just now"""
+        offset = time.monotonic() - self.start
+        self._log.write(EVENT_HEADER.pack(offset, stream, len(chunk)))
+        self._log.write(chunk)
+        self._sizes[stream] = self._sizes.get(stream, 0) + len(chunk)
+        for tail in (self._tail, self._tails.setdefault(stream, bytearray())):
+            tail += chunk
+            del tail[:-CHUNK_SIZE]
+
+    def size(self, streams: Iterable[int]) -> int:
+        """Return the total number of bytes recorded for the given streams"""
+        return sum(self._sizes.get(st, 0) for st in streams)
+
+    def events(self, streams: Iterable[int] | None = None) -> Iterator[Event]:
+        """
+        Iterate over the recorded events in order, optionally only those for
+        the given streams
+        """
+        wanted = set(streams) if streams is not None else None
+        buf = bytearray()
+        for chunk in self._log.chunks():
+            buf += chunk
+            pos = 0
+            while len(buf) - pos >= EVENT_HEADER.size:
+                offset, stream, length = EVENT_HEADER.unpack_from(buf, pos)
+                start = pos + EVENT_HEADER.size
+                if len(buf) < start + length:
+                    break
+                if wanted is None or stream in wanted:
+                    yield Event(offset, stream, bytes(buf[start : start + length]))
+                pos = start + length
+            del buf[:pos]
+
+    def last_bytes(self, streams: tuple[int, ...], size: int) -> bytes:
+        """Return (at most) the last ``size`` bytes output on ``streams``"""
+        if len(streams) == 1:
+            tail = self._tails.get(streams[0], bytearray())
+        elif set(streams) >= self._sizes.keys():
+            tail = self._tail
+        else:
+            tail = None
+        total = self.size(streams)
+        if tail is not None and (size <= len(tail) or total == len(tail)):
+            return bytes(tail[-size:])
+        return b"".join(ev.data for ev in self.events(streams))[-size:]
+
+    def close(self) -> None:
+        self._log.close()
+
+
+class EventView(CapturedOutput):
+    """
+    The output recorded in an `EventLog` for one or more streams, in the
+    order in which it was received.  Chunks written to the view are recorded
+    in the log as coming from the view's first stream.
+    """
+
+    def __init__(self, log: EventLog, streams: tuple[int, ...]) -> None:
+        self.log = log
+        self.streams = streams
+
+    def __repr__(self) -> str:
+        return f"<EventView: streams={self.streams}, log={self.log!r}>"
+
+    def write(self, chunk: bytes) -> None:
+        self.log.record(self.streams[0], chunk)
+
+    def __len__(self) -> int:
+        return self.log.size(self.streams)
+
+    def events(self) -> Iterator[Event]:
+        return self.log.events(self.streams)
+
+    def chunks(self, size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        for ev in self.events():
+            yield from output_chunks(ev.data, size)
+
+    def last_bytes(self, size: int) -> bytes:
+        return self.log.last_bytes(self.streams, size)
+
+    def close(self) -> None:
+        self.log.close()
+
+
+def output_chunks(
+    blob: bytes | CapturedOutput, size: int = CHUNK_SIZE
+) -> Iterator[bytes]:
+    """
+    Iterate over a blob of captured output — either a `bytes` object or a
+    `CapturedOutput` — in chunks of at most ``size`` bytes
+    """
+    if isinstance(blob, CapturedOutput):
+        yield from blob.chunks(size)
+    else:
+        for i in range(0, len(blob), size):
+            yield blob[i : i + size]
+
+
+def output_buffers(
+    blob: bytes | CapturedOutput, size: int = CHUNK_SIZE
+) -> Iterator[bytes | memoryview]:
+    """
+    Like `output_chunks()`, but a `CapturedOutput` is read with `buffers()`
+    instead of `chunks()`
+    """
+    if isinstance(blob, CapturedOutput):
+        yield from blob.buffers(size)
+    else:
+        yield from output_chunks(blob, size)
+
+
+def output_bytes(blob: bytes | CapturedOutput) -> bytes:
+    """Return the contents of a blob of captured output as `bytes`"""
+    if isinstance(blob, CapturedOutput):
+        return blob.getvalue()
+    else:
+        return blob
+
+
+class Compressor(Protocol):
+    def compress(self, data: bytes | memoryview, /) -> bytes: ...
+
+    def flush(self) -> bytes: ...
+
+
+#: Mapping from supported compression methods to the MIME types and filename
+#: extensions of their output
+COMPRESSION_TYPES = {
+    "gzip": ("application/gzip", ".gz"),
+    "xz": ("application/x-xz", ".xz"),
+    "zstd": ("application/zstd", ".zst"),
+}
+
+
+def get_compressor(method: str) -> Compressor:
+    """
+    Return a new compressor object for the given compression method.  Raises
+    `ImportError` if the method is ``"zstd"`` and zstd support is not
+    available.
+    """
+    if method == "gzip":
+        return zlib.compressobj(wbits=31)
+    elif method == "xz":
+        return lzma.LZMACompressor()
+    elif method == "zstd":
+        try:
+            from compression import zstd  # type: ignore[import-not-found,unused-ignore]
+        except ImportError:
+            import zstandard
+
+            return zstandard.ZstdCompressor().compressobj()
+        else:
+            return zstd.ZstdCompressor()  # type: ignore[no-any-return,unused-ignore]
+    else:
+        raise ValueError(f"Unknown compression method: {method!r}")
+
+
+def compress_chunks(
+    chunks: Iterable[bytes | memoryview], method: str
+) -> Iterator[bytes]:
+    """Compress an iterable of pieces of data one piece at a time"""
+    compressor = get_compressor(method)
+    for chunk in chunks:
+        if data := compressor.compress(chunk):
+            yield data
+    yield compressor.flush()
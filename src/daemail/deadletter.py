@@ -0,0 +1,386 @@
+"""
+The dead letter mbox and its index
+
+Messages that could not be sent are appended to an mbox file, and a line
+describing each one (its location in the mbox, Message-ID, when it was
+saved, and the command it reports on) is appended to a sidecar index file
+alongside it.  ``daemail-replay`` uses the index to find the messages that
+have not yet been delivered without parsing the whole mbox, and records
+deliveries by appending further lines to the index.  If the index is missing
+or out of date (e.g., because the mbox was written by an older version of
+daemail or edited by hand), it is rebuilt by scanning the mbox.
+"""
+
+from __future__ import annotations
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+import email
+from email import policy
+from email.message import EmailMessage
+from email.utils import make_msgid
+import fcntl
+import json
+import os
+import re
+import socket
+import tempfile
+import time
+from typing import IO, Any
+from .stream import append_mbox
+
+#: Header added to the MIME part describing why a message could not be sent,
+#: so that the part can be removed again before the message is resent
+ERROR_PART_HEADER = "X-Daemail-Send-Error"
+
+#: Format of the timestamps in mbox "From " lines
+FROM_TIME_FORMAT = "%a %b %d %H:%M:%S %Y"
+
+#: Number of bytes of the index to read at a time when looking for its last
+#: entry
+INDEX_BLOCK_SIZE = 4096
+
+
+@dataclass
+class DeadLetter:
+    """An index entry describing a message in the dead letter mbox"""
+
+    #: Offset in the mbox at which the message's "From " line starts
+    offset: int
+    #: Length of the message's entry in the mbox in bytes, including the
+    #: "From " line and the trailing blank line
+    length: int
+    message_id: str | None
+    #: When the message was saved to the mbox
+    timestamp: datetime | None  # aware
+    #: The command the message reports on, as shown in its subject
+    command: str | None
+    delivered: bool = False
+
+    @property
+    def end(self) -> int:
+        return self.offset + self.length
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> DeadLetter:
+        ts = data.get("timestamp")
+        return cls(
+            offset=data["offset"],
+            length=data["length"],
+            message_id=data.get("message_id"),
+            timestamp=datetime.fromisoformat(ts) if ts is not None else None,
+            command=data.get("command"),
+        )
+
+    def for_json(self) -> dict[str, Any]:
+        return {
+            "offset": self.offset,
+            "length": self.length,
+            "message_id": self.message_id,
+            "timestamp": (
+                self.timestamp.isoformat() if self.timestamp is not None else None
+            ),
+            "command": self.command,
+        }
+
+
+@dataclass
+class DeadLetterBox:
+    """
+    The dead letter mbox at ``path``, indexed by the file at ``path +
+    ".idx"``.  The index is only written while holding the same
+    :func:`fcntl.lockf` lock on the mbox that `mailbox.mbox.lock()` takes.
+    """
+
+    path: str
+
+    @property
+    def index_path(self) -> str:
+        return self.path + ".idx"
+
+    @contextmanager
+    def locked(self) -> Iterator[IO[bytes]]:
+        """
+        Hold an exclusive lock on the mbox (creating it if it does not exist)
+        and yield the file opened for appending
+        """
+        with open(self.path, "ab") as fp:
+            fcntl.lockf(fp, fcntl.LOCK_EX)
+            try:
+                yield fp
+            finally:
+                fcntl.lockf(fp, fcntl.LOCK_UN)
+
+    def add(self, msg: EmailMessage) -> DeadLetter:
+        """
+        Append ``msg`` to the mbox and record it in the index.  If ``msg``
+        does not have a Message-ID, one is added so that the message can be
+        recognized when it's resent.
+        """
+        if msg["Message-ID"] is None:
+            msg["Message-ID"] = make_msgid(domain=socket.gethostname())
+        now = datetime.now(timezone.utc).replace(microsecond=0)
+        from_line = "From MAILER-DAEMON " + now.strftime(FROM_TIME_FORMAT)
+        with self.locked() as fp:
+            up_to_date = self._tail_matches(fp)
+            start, end = append_mbox(fp, msg, from_line)
+            entry = DeadLetter(
+                offset=start,
+                length=end - start,
+                message_id=str(msg["Message-ID"]),
+                timestamp=now,
+                command=command_of(msg["Subject"]),
+            )
+            if up_to_date:
+                self._append_index(entry.for_json())
+            else:
+                # The index was missing or out of date, and now the new
+                # message has to be indexed along with the rest
+                self._rebuild()
+        return entry
+
+    def entries(self) -> list[DeadLetter]:
+        """Return the index entries for all messages in the mbox, in order"""
+        if not os.path.exists(self.path):
+            return []
+        with self.locked() as fp:
+            entries = self._load(fp)
+            if entries is None:
+                entries = self._rebuild()
+        return entries
+
+    def undelivered(self) -> list[DeadLetter]:
+        return [e for e in self.entries() if not e.delivered]
+
+    def read(self, entry: DeadLetter) -> EmailMessage:
+        """Read & parse the message described by ``entry``"""
+        with open(self.path, "rb") as fp:
+            fp.seek(entry.offset)
+            data = fp.read(entry.length)
+        _, _, content = data.partition(b"\n")
+        # Drop the blank line separating the message from the next one
+        if content.endswith(b"\n\n"):
+            content = content[:-1]
+        msg = email.message_from_bytes(
+            content,
+            # <https://github.com/python/typeshed/issues/13273>
+            policy=policy.default,  # type: ignore[arg-type]
+        )
+        assert isinstance(msg, EmailMessage)
+        return msg
+
+    def mark_delivered(self, entry: DeadLetter) -> None:
+        """Record in the index that the message described by ``entry`` was sent"""
+        with self.locked():
+            self._append_index({"delivered": entry.offset})
+        entry.delivered = True
+
+    def _load(self, fp: IO[bytes]) -> list[DeadLetter] | None:
+        """
+        Read the index, returning `None` if it is missing or does not match
+        the locked mbox ``fp``
+        """
+        entries: dict[int, DeadLetter] = {}
+        try:
+            with open(self.index_path, encoding="utf-8") as ifp:
+                for line in ifp:
+                    try:
+                        data = json.loads(line)
+                        if "delivered" in data:
+                            entries[data["delivered"]].delivered = True
+                        else:
+                            e = DeadLetter.from_json(data)
+                            entries[e.offset] = e
+                    except (ValueError, TypeError, KeyError, AttributeError):
+                        # Probably a partially-written line; if it mattered,
+                        # the check below will catch it
+                        continue
+        except FileNotFoundError:
+            return None
+        # Check that the entries cover the whole mbox, one after another:
+        pos = 0
+        for e in sorted(entries.values(), key=lambda e: e.offset):
+            if e.offset != pos:
+                return None
+            pos = e.end
+        if pos != fp.seek(0, 2):
+            return None
+        return sorted(entries.values(), key=lambda e: e.offset)
+
+    def _tail_matches(self, fp: IO[bytes]) -> bool:
+        """
+        Check whether the index is up to date with the locked mbox ``fp`` by
+        comparing the end of the last message it records to the size of the
+        mbox.  Unlike `_load()`, this only reads the end of the index, so
+        that appending to a large mbox doesn't get slower as it grows.
+        """
+        try:
+            last = self._last_entry()
+        except FileNotFoundError:
+            return False
+        return (last.end if last is not None else 0) == fp.seek(0, 2)
+
+    def _last_entry(self) -> DeadLetter | None:
+        """
+        Return the last message entry in the index (skipping over delivery
+        marks and damaged lines), reading the index backwards a block at a
+        time
+        """
+        with open(self.index_path, "rb") as ifp:
+            pos = ifp.seek(0, 2)
+            # Data read from the index that hasn't been parsed yet because it
+            # may be the end of a line that started before it
+            partial = b""
+            while pos > 0:
+                n = min(pos, INDEX_BLOCK_SIZE)
+                pos -= n
+                ifp.seek(pos)
+                lines = (ifp.read(n) + partial).split(b"\n")
+                if pos > 0:
+                    partial = lines.pop(0)
+                for line in reversed(lines):
+                    try:
+                        data = json.loads(line)
+                        if "delivered" not in data:
+                            return DeadLetter.from_json(data)
+                    except (ValueError, TypeError, KeyError, AttributeError):
+                        continue
+        return None
+
+    def _rebuild(self) -> list[DeadLetter]:
+        """
+        Reindex the mbox (which the caller must have locked) by scanning it,
+        keeping any delivery marks from the old index for messages that are
+        still at the same offsets
+        """
+        delivered = set()
+        try:
+            with open(self.index_path, encoding="utf-8") as ifp:
+                for line in ifp:
+                    try:
+                        data = json.loads(line)
+                        if "delivered" in data:
+                            delivered.add(data["delivered"])
+                    except (ValueError, TypeError):
+                        continue
+        except FileNotFoundError:
+            pass
+        entries = list(scan_mbox(self.path))
+        for e in entries:
+            e.delivered = e.offset in delivered
+        # Write to a temporary file and rename it into place so that readers
+        # never see a partially-written index
+        fd, tmppath = tempfile.mkstemp(
+            dir=os.path.dirname(self.index_path) or ".",
+            prefix=".deadletter-",
+            suffix=".tmp",
+        )
+        try:
+            with open(fd, "w", encoding="utf-8") as ifp:
+                for e in entries:
+                    print(json.dumps(e.for_json()), file=ifp)
+                    if e.delivered:
+                        print(json.dumps({"delivered": e.offset}), file=ifp)
+            os.replace(tmppath, self.index_path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+        return entries
+
+    def _append_index(self, data: dict[str, Any]) -> None:
+        # A single write on a file opened for appending, so that a line is
+        # never interleaved with another
+        line = (json.dumps(data) + "\n").encode("utf-8")
+        fd = os.open(self.index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+
+def scan_mbox(path: str) -> Iterator[DeadLetter]:
+    """
+    Scan the mbox at ``path`` and yield an index entry for each message in
+    it.  As in `mailbox.mbox`, a message starts at each "From " line that is
+    at the start of the file or follows a blank line.
+    """
+    with open(path, "rb") as fp:
+        start: int | None = None
+        from_line = b""
+        headers: list[bytes] = []
+        in_headers = False
+        pos = 0
+        prev_blank = True
+        for line in fp:
+            if line.startswith(b"From ") and prev_blank:
+                if start is not None:
+                    yield _entry(start, pos, from_line, headers)
+                start = pos
+                from_line = line
+                headers = []
+                in_headers = True
+            elif in_headers:
+                if line.strip(b"\r\n"):
+                    headers.append(line)
+                else:
+                    in_headers = False
+            prev_blank = line in (b"\n", b"\r\n")
+            pos += len(line)
+        if start is not None:
+            yield _entry(start, pos, from_line, headers)
+
+
+def _entry(start: int, end: int, from_line: bytes, headers: list[bytes]) -> DeadLetter:
+    msg = email.message_from_bytes(
+        b"".join(headers) + b"\n",
+        # <https://github.com/python/typeshed/issues/13273>
+        policy=policy.default,  # type: ignore[arg-type]
+    )
+    return DeadLetter(
+        offset=start,
+        length=end - start,
+        message_id=str(mid) if (mid := msg["Message-ID"]) is not None else None,
+        timestamp=parse_from_time(from_line),
+        command=command_of(msg["Subject"]),
+    )
+
+
+def parse_from_time(from_line: bytes) -> datetime | None:
+    """
+    Return the time in an mbox "From " line, which is in UTC when written by
+    daemail or `mailbox.mbox`
+    """
+    fields = from_line.decode("ascii", "replace").split()
+    try:
+        when = time.strptime(" ".join(fields[2:7]), FROM_TIME_FORMAT)
+    except ValueError:
+        return None
+    return datetime(*when[:6], tzinfo=timezone.utc)
+
+
+def command_of(subject: str | None) -> str | None:
+    """
+    Return the command shown in the subject of a report, i.e., the subject
+    without its leading status tag
+    """
+    if subject is None:
+        return None
+    m = re.fullmatch(r"\[[^]]*\] (.+)", str(subject), flags=re.S)
+    return m[1] if m else None
+
+
+def strip_error_parts(msg: EmailMessage) -> None:
+    """
+    Remove the parts describing sending errors that were added to ``msg``
+    when it was saved to the dead letter mbox
+    """
+    if not msg.is_multipart():
+        return
+    parts = list(msg.iter_parts())
+    kept = [p for p in parts if p[ERROR_PART_HEADER] is None]
+    if len(kept) < len(parts):
+        msg.set_payload([])
+        for p in kept:
+            assert isinstance(p, EmailMessage)
+            msg.attach(p)
@@ -0,0 +1,168 @@
+from __future__ import annotations
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from datetime import datetime
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+from typing import Any
+from .capture import STDERR, STDOUT, OutputSink, output_buffers
+from .runner import CommandResult
+from .sinks import Hasher
+from .util import show_argv
+
+#: Hash algorithm used for output digests
+HASH_ALGORITHM = "sha256"
+
+
+def hash_sinks(_stream: int) -> list[OutputSink]:
+    """
+    Sink factory for `CommandRunner.sinks` that computes a digest of each
+    stream as it's captured, for use by `output_digest()`
+    """
+    return [Hasher(HASH_ALGORITHM)]
+
+
+def output_digest(result: CommandResult) -> str:
+    """
+    Return a digest of a command's captured stdout & stderr.  Digests
+    computed during capture by `hash_sinks()` are used if available, so the
+    output normally doesn't have to be read again.
+    """
+    parts = []
+    for stream, output in ((STDOUT, result.stdout), (STDERR, result.stderr)):
+        hashers = [
+            s
+            for s in result.sinks.get(stream, [])
+            if isinstance(s, Hasher) and s.algorithm == HASH_ALGORITHM
+        ]
+        if hashers:
+            parts.append(hashers[0].hexdigest())
+        elif output is None:
+            parts.append("-")
+        else:
+            h = hashlib.new(HASH_ALGORITHM)
+            for buf in output_buffers(output):
+                h.update(buf)
+            parts.append(h.hexdigest())
+    return hashlib.new(HASH_ALGORITHM, ":".join(parts).encode("ascii")).hexdigest()
+
+
+@dataclass
+class RunRecord:
+    """What was recorded about the most recent run of a command"""
+
+    rc: int
+    #: `output_digest()` of the run
+    digest: str
+    #: Start time of the most recent run
+    last: datetime  # aware
+    #: Start time of the first of the consecutive runs with this exit status &
+    #: output
+    since: datetime  # aware
+    #: Number of consecutive runs with this exit status & output
+    count: int
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> RunRecord:
+        return cls(
+            rc=data["rc"],
+            digest=data["digest"],
+            last=datetime.fromisoformat(data["last"]),
+            since=datetime.fromisoformat(data["since"]),
+            count=data["count"],
+        )
+
+    def for_json(self) -> dict[str, Any]:
+        return {
+            **asdict(self),
+            "last": self.last.isoformat(),
+            "since": self.since.isoformat(),
+        }
+
+
+@dataclass
+class DedupStore:
+    """
+    Remembers the exit status & output digest of the most recent run of each
+    command (keyed by its `show_argv()` rendering) in a JSON file at ``path``
+    so that repeated identical failures can be detected
+    """
+
+    path: str
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        """Hold an exclusive lock on the store"""
+        with open(self.path + ".lock", "a") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def load(self) -> dict[str, RunRecord]:
+        try:
+            with open(self.path, encoding="utf-8") as fp:
+                data = json.load(fp)
+            return {k: RunRecord.from_json(v) for k, v in data.items()}
+        except FileNotFoundError:
+            return {}
+        except (ValueError, TypeError, KeyError, AttributeError):
+            # A damaged store only costs us one round of deduplication
+            return {}
+
+    def save(self, records: dict[str, RunRecord]) -> None:
+        # Write to a temporary file and rename it into place so that readers
+        # never see a partially-written store
+        fd, tmppath = tempfile.mkstemp(
+            dir=os.path.dirname(self.path) or ".", prefix=".dedup-", suffix=".tmp"
+        )
+        try:
+            with open(fd, "w", encoding="utf-8") as fp:
+                json.dump({k: v.for_json() for k, v in records.items()}, fp)
+            os.replace(tmppath, self.path)
+        except BaseException:
+            os.unlink(tmppath)
+            raise
+
+    def check(self, result: CommandResult) -> RunRecord | None:
+        """
+        If the most recently recorded run of ``result``'s command had the same
+        exit status & output, return the record of that run (or runs);
+        otherwise, return `None`.  ``result`` itself is not recorded; call
+        `record()` once its report has been delivered.
+        """
+        prev = self.load().get(show_argv(*result.argv))
+        if prev is not None and prev.rc == result.rc:
+            if prev.digest == output_digest(result):
+                return prev
+        return None
+
+    def record(self, result: CommandResult) -> None:
+        """Record ``result`` as the most recent run of its command"""
+        key = show_argv(*result.argv)
+        digest = output_digest(result)
+        with self.locked():
+            records = self.load()
+            prev = records.get(key)
+            if prev is not None and prev.rc == result.rc and prev.digest == digest:
+                records[key] = RunRecord(
+                    rc=result.rc,
+                    digest=digest,
+                    last=result.start,
+                    since=prev.since,
+                    count=prev.count + 1,
+                )
+            else:
+                records[key] = RunRecord(
+                    rc=result.rc,
+                    digest=digest,
+                    last=result.start,
+                    since=result.start,
+                    count=1,
+                )
+            self.save(records)
@@ -0,0 +1,154 @@
+from __future__ import annotations
+from contextlib import AbstractContextManager, nullcontext
+from dataclasses import dataclass
+from email.message import EmailMessage
+import os
+import re
+import time
+from typing import TYPE_CHECKING, Any
+from .spool import Spool
+
+if TYPE_CHECKING:
+    from .message import DraftMessage
+    from .senders import TryingSender
+
+#: Regex that digest keys must match, as they're used as directory names
+KEY_RGX = re.compile(r"[A-Za-z0-9][-A-Za-z0-9_.]*")
+
+
+@dataclass
+class Digest:
+    """
+    A batch of reports sharing the key ``key`` that are stored in a `Spool`
+    under ``digest_dir`` and sent together as a single e-mail once the oldest
+    report is ``window`` seconds old or the reports' combined size reaches
+    ``max_size`` bytes.
+
+    Nothing waits in the background for the window to close; instead, the
+    batch is sent by the first report added after it closes or by
+    ``daemail-spoold --digest-dir`` (see `flush_digests()`), whichever comes
+    first.
+    """
+
+    key: str
+    digest_dir: str
+    window: float
+    max_size: int
+
+    @property
+    def spool(self) -> Spool:
+        return Spool(os.path.join(self.digest_dir, self.key))
+
+    def add_report(
+        self,
+        msg: DraftMessage,
+        mailer: TryingSender,
+        send_lock: AbstractContextManager[Any] | None = None,
+    ) -> None:
+        """
+        Add ``msg`` to the digest, and then send the digest via ``mailer``
+        (while holding ``send_lock``, if given) if it's now due
+        """
+        self.spool.add(msg.compile(deferred=True))
+        self.flush(msg, mailer, send_lock)
+
+    def flush(
+        self,
+        template: DraftMessage | None,
+        mailer: TryingSender,
+        send_lock: AbstractContextManager[Any] | None = None,
+    ) -> bool:
+        """
+        If the batch is due to be sent, remove all of its reports from the
+        store and send them as a single e-mail with the same sender &
+        recipients as ``template`` (or, if that is `None`, as the batch's
+        first report) while holding ``send_lock`` (if given).  Returns `True`
+        if an e-mail was sent.
+        """
+        spool = self.spool
+        with spool.locked():
+            keys = spool.keys()
+            if not keys:
+                return False
+            size = sum(spool.size(k) for k in keys)
+            age = time.time() - spool.mtime(keys[0])
+            if size < self.max_size and age < self.window:
+                return False
+            reports = []
+            for k in keys:
+                reports.append(spool.get(k))
+                spool.remove(k)
+        if template is None:
+            template = report_template(reports[0])
+        digest = compose_digest(self.key, reports, template)
+        with send_lock if send_lock is not None else nullcontext():
+            mailer.send(digest)
+        return True
+
+
+def flush_digests(
+    digest_dir: str, window: float, max_size: int, mailer: TryingSender
+) -> int:
+    """
+    Send each digest stored under ``digest_dir`` that is due according to
+    ``window`` & ``max_size``, addressed like the digest's first report.
+    Returns the number of digests sent.
+    """
+    try:
+        keys = sorted(os.listdir(digest_dir))
+    except FileNotFoundError:
+        return 0
+    sent = 0
+    for key in keys:
+        if KEY_RGX.fullmatch(key) and os.path.isdir(os.path.join(digest_dir, key)):
+            if Digest(key, digest_dir, window, max_size).flush(None, mailer):
+                sent += 1
+    return sent
+
+
+def report_template(report: EmailMessage) -> DraftMessage:
+    """
+    Return an empty draft with the same sender & recipients as the stored
+    report ``report``
+    """
+    from .message import DraftMessage
+
+    sender = report["From"]
+    to = report["To"]
+    return DraftMessage(
+        from_addr=sender.addresses[0] if sender is not None else None,
+        to_addrs=list(to.addresses) if to is not None else [],
+        subject="",
+    )
+
+
+def compose_digest(
+    label: str,
+    reports: list[EmailMessage],
+    template: DraftMessage,
+    tag: str = "DIGEST",
+) -> DraftMessage:
+    """
+    Combine ``reports`` into a single e-mail, with the same sender & recipients
+    as ``template``, containing a summary of their subjects followed by each
+    report as an inline attachment
+    """
+    from .message import DraftMessage
+
+    failed = sum(
+        1 for r in reports if not str(r.get("Subject", "")).startswith("[DONE]")
+    )
+    subject = f"[{tag}] {label}: {len(reports)} report"
+    if len(reports) != 1:
+        subject += "s"
+    if failed:
+        subject += f" ({failed} failed)"
+    digest = DraftMessage(
+        from_addr=template.from_addr,
+        to_addrs=template.to_addrs,
+        subject=subject,
+    )
+    digest.addtext("".join(f"- {r.get('Subject', '')}\n" for r in reports))
+    for r in reports:
+        digest.addmessage(r)
+    return digest
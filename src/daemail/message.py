@@ -1,66 +1,477 @@
 from __future__ import annotations
+from collections.abc import Callable, Iterable, Iterator
 from dataclasses import dataclass, field
+from email import policy
 from email.headerregistry import Address
 from email.message import EmailMessage
-import platform
+from functools import cache, partial
 import eletter
-from eletter import BytesAttachment, MailItem, TextBody, reply_quote
-import outgoing
+from eletter import BytesAttachment, EmailAttachment, MailItem, TextBody
 from . import __url__, __version__
-
-USER_AGENT = "daemail/{} ({}) outgoing/{} eletter/{} {}/{}".format(
-    __version__,
-    __url__,
-    outgoing.__version__,
-    eletter.__version__,
-    platform.python_implementation(),
-    platform.python_version(),
+from .capture import (
+    COMPRESSION_TYPES,
+    CapturedOutput,
+    compress_chunks,
+    output_buffers,
+)
+from .stream import (
+    defer_encoded,
+    encode_base64,
+    encode_blob,
+    encode_qp,
+    expand_deferred,
+    normalize_newlines,
 )
+from .util import decode_chunks, reply_quote_chunks
+
+
+@cache
+def get_user_agent() -> str:
+    """
+    Return the value for the :mailheader:`User-Agent` header of outgoing
+    e-mails.  This is computed on first use rather than at import time so that
+    merely importing this module doesn't require loading ``outgoing`` or
+    `platform`.
+    """
+    import platform
+    import outgoing
+
+    return "daemail/{} ({}) outgoing/{} eletter/{} {}/{}".format(
+        __version__,
+        __url__,
+        outgoing.__version__,
+        eletter.__version__,
+        platform.python_implementation(),
+        platform.python_version(),
+    )
+
+
+def __getattr__(name: str) -> str:
+    if name == "USER_AGENT":
+        return get_user_agent()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 @dataclass
-class DraftMessage:
-    from_addr: Address | None
-    to_addrs: list[Address]
-    subject: str
-    # List of strings and/or attachments:
-    parts: list[str | MailItem] = field(init=False, default_factory=list)
+class DraftBody:
+    """
+    A collection of text and attachments to be composed into the body of an
+    e-mail
+    """
+
+    # List of strings, deferred text, and/or attachments.  Consecutive
+    # strings & deferred text are pieces of the same text part; they are only
+    # joined together when needed (e.g., by `compile()`) so that repeated
+    # calls to `addtext()` don't keep copying the text accumulated so far.
+    parts: list[str | DeferredText | MailItem] = field(init=False, default_factory=list)
 
     def addtext(self, txt: str) -> None:
-        if self.parts and isinstance(self.parts[-1], str):
-            self.parts[-1] += txt
-        else:
-            self.parts.append(txt)
+        self.parts.append(txt)
 
-    def addblobquote(self, blob: bytes, encoding: str, filename: str) -> None:
+    def adddeferredtext(self, render: Callable[[], Iterable[str]]) -> None:
+        """
+        Add text that is only generated, a piece at a time, by calling
+        ``render`` once the message is written out.  ``render`` is also called
+        once now in order to scan the text (without keeping it), so any
+        exception that generating the text raises (e.g., `UnicodeDecodeError`)
+        is raised here.
+        """
+        self.parts.append(DeferredText(render, TextStats.scan(render())))
+
+    def addblobquote(
+        self, blob: bytes | CapturedOutput, encoding: str, filename: str
+    ) -> None:
+        if isinstance(blob, CapturedOutput) and len(blob) >= DEFER_QUOTE_SIZE:
+            # Only check that the output can be decoded for now, and leave the
+            # quoting until the message is written out so that the quoted
+            # text is never held in full
+            try:
+                self.adddeferredtext(partial(quote_output, blob, encoding))
+            except UnicodeDecodeError:
+                self.parts.append(blob_attachment(blob, filename, BINARY_TYPE))
+            return
+        # Decode & quote the blob one chunk at a time so that the bytes, the
+        # decoded text, and the quoted text are never all held in full at once
         try:
-            txt = blob.decode(encoding)
+            pieces = list(quote_output(blob, encoding))
         except UnicodeDecodeError:
-            self.parts.append(BytesAttachment(blob, filename, inline=True))
+            self.parts.append(blob_attachment(blob, filename, BINARY_TYPE))
+        else:
+            self.parts.extend(pieces)
+
+    def addmimeblob(
+        self,
+        blob: bytes | CapturedOutput,
+        mimetype: str,
+        filename: str,
+        compress: str | None = None,
+    ) -> None:
+        """
+        Attach ``blob`` with the given MIME type & filename.  If ``compress``
+        is non-`None`, the blob is instead compressed chunk by chunk using the
+        given compression method and attached with the MIME type of the
+        compressed format and the format's extension appended to the filename.
+        A `CapturedOutput` is only compressed as the message is written out,
+        so that the compressed data is never held in full.
+        """
+        if compress is not None:
+            mimetype, ext = COMPRESSION_TYPES[compress]
+            filename += ext
+            if isinstance(blob, CapturedOutput):
+                self.parts.append(
+                    CompressedAttachment(
+                        blob,
+                        filename=filename,
+                        content_type=mimetype,
+                        inline=True,
+                        compress=compress,
+                    )
+                )
+                return
+            blob = b"".join(compress_chunks(output_buffers(blob), compress))
+        self.parts.append(blob_attachment(blob, filename, mimetype))
+
+    def addmessage(self, msg: EmailMessage) -> None:
+        """Attach a complete e-mail as an inline :mimetype:`message/rfc822` part"""
+        self.parts.append(EmailAttachment(msg, filename=None, inline=True))
+
+    def iterparts(self) -> Iterator[str | MailItem]:
+        """
+        Yield the message's parts with each run of consecutive text pieces
+        joined into a single string — or, if the run includes any deferred
+        text, into a single `DeferredTextBody`
+        """
+        text: list[str | DeferredText] = []
+        for p in self.parts:
+            if isinstance(p, (str, DeferredText)):
+                text.append(p)
+            else:
+                if text:
+                    yield join_text(text)
+                    text = []
+                yield p
+        if text:
+            yield join_text(text)
+
+    def mailitem(self) -> MailItem:
+        parts = list(self.iterparts())
+        item: MailItem
+        if isinstance(parts[0], str):
+            item = TextBody(parts[0])
+        else:
+            item = parts[0]
+        for p in parts[1:]:
+            item &= p
+        return item
+
+    def compose(self) -> EmailMessage:
+        """
+        Compose the body as a standalone MIME entity with no message headers
+        """
+        msg = self.mailitem().compose(to=[])
+        del msg["MIME-Version"]
+        expand_deferred(msg)
+        return msg
+
+
+#: Default MIME type of binary attachments
+BINARY_TYPE = "application/octet-stream"
+
+#: Captured output at least this many bytes long is decoded & quoted as the
+#: message is written out rather than when the report is composed
+DEFER_QUOTE_SIZE = 1 << 20
+
+
+class BlobAttachment(BytesAttachment):
+    """
+    A `BytesAttachment` whose content is captured output that is only
+    base64-encoded once the message is written out.  Compiling it produces a
+    deferred part (see `daemail.stream`), so the `CapturedOutput` must not be
+    closed until the compiled message has been sent or expanded.
+    """
+
+    def __init__(
+        self,
+        blob: CapturedOutput,
+        filename: str | None,
+        content_type: str,
+        inline: bool,
+    ) -> None:
+        super().__init__(b"", filename, content_type=content_type, inline=inline)
+        self.blob = blob
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, BlobAttachment):
+            return NotImplemented
+        return super().__eq__(other) and self.blob is other.blob
+
+    def _compile(self) -> EmailMessage:
+        # Let the superclass set the headers, including
+        # "Content-Transfer-Encoding: base64", and then swap in a placeholder
+        # for the payload
+        msg = super()._compile()
+        defer_encoded(msg, self.encode)
+        return msg
+
+    def encode(self, linesep: bytes) -> Iterator[bytes]:
+        return encode_blob(self.blob, linesep)
+
+
+class CompressedAttachment(BlobAttachment):
+    """
+    A `BlobAttachment` whose content is compressed with the compression
+    method ``compress`` a chunk at a time as it's base64-encoded when the
+    message is written out
+    """
+
+    def __init__(
+        self,
+        blob: CapturedOutput,
+        filename: str | None,
+        content_type: str,
+        inline: bool,
+        compress: str,
+    ) -> None:
+        super().__init__(blob, filename, content_type=content_type, inline=inline)
+        self.compress = compress
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, CompressedAttachment):
+            return NotImplemented
+        return super().__eq__(other) and self.compress == other.compress
+
+    def encode(self, linesep: bytes) -> Iterator[bytes]:
+        return encode_base64(
+            compress_chunks(output_buffers(self.blob), self.compress), linesep
+        )
+
+
+@dataclass(eq=False)
+class DeferredText:
+    """
+    A piece of text that is only generated, by calling ``render``, once the
+    message containing it is written out
+    """
+
+    render: Callable[[], Iterable[str]]
+    #: Statistics on the text, gathered when it was added to the message
+    stats: TextStats
+
+
+@dataclass
+class TextStats:
+    """
+    Statistics on the lines of a piece of text (after normalizing its line
+    endings and encoding it in UTF-8), from which the
+    :mailheader:`Content-Transfer-Encoding` of a text part can be chosen
+    without holding the part's text in full.  The statistics for
+    consecutive pieces of text are combined with ``+``.
+    """
+
+    #: Length of the first line, or of the whole text if it has no newlines
+    first: int = 0
+    #: Length of the longest line other than the first & last
+    longest: int = 0
+    #: Length of the text after the last newline, or of the whole text if it
+    #: has no newlines
+    last: int = 0
+    newline: bool = False
+    ascii_only: bool = True
+
+    @classmethod
+    def scan(cls, pieces: Iterable[str]) -> TextStats:
+        stats = cls()
+        for data in normalize_newlines(s.encode("utf-8") for s in pieces):
+            lines = data.split(b"\n")
+            if len(lines) == 1:
+                piece = cls(len(data), 0, len(data), False, data.isascii())
+            else:
+                piece = cls(
+                    first=len(lines[0]),
+                    longest=max(map(len, lines[1:-1]), default=0),
+                    last=len(lines[-1]),
+                    newline=True,
+                    ascii_only=data.isascii(),
+                )
+            stats += piece
+        return stats
+
+    def __add__(self, other: TextStats) -> TextStats:
+        ascii_only = self.ascii_only and other.ascii_only
+        if not self.newline and not other.newline:
+            n = self.first + other.first
+            return TextStats(n, 0, n, False, ascii_only)
+        elif not self.newline:
+            first = self.first + other.first
+            return TextStats(first, other.longest, other.last, True, ascii_only)
+        elif not other.newline:
+            last = self.last + other.first
+            return TextStats(self.first, self.longest, last, True, ascii_only)
+        else:
+            longest = max(self.longest, self.last + other.first, other.longest)
+            return TextStats(self.first, longest, other.last, True, ascii_only)
+
+    @property
+    def cte(self) -> str:
+        """
+        The :mailheader:`Content-Transfer-Encoding` that
+        `EmailMessage.set_content()` would use for the text, except that
+        quoted-printable is used for all text with lines too long for 7bit or
+        8bit, as base64 can be chosen over quoted-printable only by seeing how
+        much of the text would need escaping
+        """
+        limit = policy.default.max_line_length
+        if limit is not None and max(self.first, self.longest, self.last) > limit:
+            return "quoted-printable"
+        elif self.ascii_only:
+            return "7bit"
         else:
-            self.addtext(reply_quote(txt))
-
-    def addmimeblob(self, blob: bytes, mimetype: str, filename: str) -> None:
-        self.parts.append(
-            BytesAttachment(
-                blob,
-                filename=filename,
-                content_type=mimetype,
-                inline=True,
-            )
+            return "8bit"
+
+
+class DeferredTextBody(TextBody):
+    """
+    A `TextBody` whose text includes `DeferredText` that is only generated &
+    encoded once the message is written out.  Compiling it produces a
+    deferred part (see `daemail.stream`), so any `CapturedOutput` that the
+    text is generated from must not be closed until the compiled message has
+    been sent or expanded.
+    """
+
+    def __init__(self, pieces: list[str | DeferredText]) -> None:
+        super().__init__("")
+        self.pieces = pieces
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, DeferredTextBody):
+            return NotImplemented
+        return self.pieces == other.pieces
+
+    def _compile(self) -> EmailMessage:
+        # Let the superclass set the headers, and then fix the CTE and swap in
+        # a placeholder for the payload
+        msg = super()._compile()
+        stats = sum(
+            (
+                p.stats if isinstance(p, DeferredText) else TextStats.scan([p])
+                for p in self.pieces
+            ),
+            TextStats(),
         )
+        msg.replace_header("Content-Transfer-Encoding", stats.cte)
+        defer_encoded(msg, partial(self.encode, stats.cte))
+        return msg
+
+    def chunks(self) -> Iterator[str]:
+        for p in self.pieces:
+            if isinstance(p, DeferredText):
+                yield from p.render()
+            else:
+                yield p
+
+    def encode(self, cte: str, linesep: bytes) -> Iterator[bytes]:
+        """
+        Generate the text and encode it a piece at a time in the same way
+        that `EmailMessage.set_content()` encodes text
+        """
+
+        def lines() -> Iterator[bytes]:
+            last = b""
+            for data in normalize_newlines(s.encode("utf-8") for s in self.chunks()):
+                last = data[-1:]
+                yield data
+            if last != b"\n":
+                yield b"\n"
 
-    def compile(self) -> EmailMessage:  # noqa: A003
-        msg: MailItem
-        if isinstance(self.parts[0], str):
-            msg = TextBody(self.parts[0])
+        if cte == "quoted-printable":
+            yield from encode_qp(lines(), linesep)
+        elif linesep == b"\n":
+            yield from lines()
         else:
-            msg = self.parts[0]
-        for p in self.parts[1:]:
-            msg &= p
-        return msg.compose(
+            for chunk in lines():
+                yield chunk.replace(b"\n", linesep)
+
+
+def join_text(pieces: list[str | DeferredText]) -> str | MailItem:
+    """
+    Join consecutive text pieces into a single string or, if any of them are
+    deferred, into a `DeferredTextBody` in which runs of strings are joined
+    """
+    strings = [p for p in pieces if isinstance(p, str)]
+    if len(strings) == len(pieces):
+        return "".join(strings)
+    joined: list[str | DeferredText] = []
+    text: list[str] = []
+    for p in pieces:
+        if isinstance(p, str):
+            text.append(p)
+        else:
+            if text:
+                joined.append("".join(text))
+                text = []
+            joined.append(p)
+    if text:
+        joined.append("".join(text))
+    return DeferredTextBody(joined)
+
+
+def quote_output(blob: bytes | CapturedOutput, encoding: str) -> Iterator[str]:
+    """
+    Decode ``blob`` and quote it as a reply, a chunk at a time.  Raises
+    `UnicodeDecodeError` (once iteration reaches the problem) if ``blob`` is
+    not valid in the given encoding.
+    """
+    return reply_quote_chunks(decode_chunks(output_buffers(blob), encoding))
+
+
+def blob_attachment(
+    blob: bytes | CapturedOutput, filename: str, mimetype: str
+) -> BytesAttachment:
+    """
+    Return an inline attachment containing ``blob``.  A `CapturedOutput` is
+    attached as a `BlobAttachment` so that it's encoded straight from where
+    it's stored (memory-mapping it if it's on disk) when the message is
+    written out.
+    """
+    if isinstance(blob, CapturedOutput):
+        return BlobAttachment(
+            blob, filename=filename, content_type=mimetype, inline=True
+        )
+    else:
+        return BytesAttachment(
+            blob, filename=filename, content_type=mimetype, inline=True
+        )
+
+
+@dataclass
+class DraftMessage(DraftBody):
+    from_addr: Address | None
+    to_addrs: list[Address]
+    subject: str
+
+    def compile(self, deferred: bool = False) -> EmailMessage:  # noqa: A003
+        """
+        Compose the message.  If ``deferred`` is true, captured output
+        attachments are left as deferred parts that are only encoded when
+        the message is written out with `daemail.stream.write_message()`.
+        """
+        msg = self.mailitem().compose(
             subject=self.subject,
             from_=self.from_addr,
             to=self.to_addrs,
-            headers={"User-Agent": USER_AGENT},
+            headers={"User-Agent": get_user_agent()},
         )
+        if not deferred:
+            expand_deferred(msg)
+        return msg
+
+
+def append_part(msg: EmailMessage, part: EmailMessage) -> None:
+    """
+    Append ``part`` to the already-composed message ``msg`` (converting
+    ``msg`` to :mimetype:`multipart/mixed` first if necessary) without
+    re-encoding any of ``msg``'s existing contents
+    """
+    if msg.get_content_type() != "multipart/mixed":
+        msg.make_mixed()
+    msg.attach(part)
@@ -0,0 +1,123 @@
+from __future__ import annotations
+from dataclasses import asdict, dataclass
+from datetime import datetime
+import json
+import os
+import socket
+import stat
+from typing import Any
+from .capture import CapturedOutput, TruncatedOutput
+from .runner import CommandError, CommandResult, ResourceUsage
+
+
+@dataclass
+class JobMetrics:
+    """Measurements of a single command run and the sending of its report"""
+
+    argv: list[str]
+    start: datetime  # aware
+    end: datetime  # aware
+    #: `None` if the command could not be run
+    rc: int | None
+    timed_out: bool
+    #: Number of bytes of output that the command produced (including any
+    #: discarded by ``--max-output``), or `None` if not captured
+    stdout_bytes: int | None
+    stderr_bytes: int | None
+    rusage: ResourceUsage | None
+    #: Seconds spent composing the report
+    compose_time: float
+    #: Seconds spent sending the report, or `None` if there was nothing to
+    #: send
+    send_time: float | None = None
+    #: How the report was handled: one of the values returned by
+    #: `TryingSender.send()`, ``"digest"`` if it was added to a digest, or
+    #: ``"skipped"`` if no report was sent
+    send_outcome: str = "skipped"
+
+    @classmethod
+    def from_result(
+        cls, result: CommandResult | CommandError, compose_time: float
+    ) -> JobMetrics:
+        if isinstance(result, CommandError):
+            return cls(
+                argv=result.argv,
+                start=result.start,
+                end=result.end,
+                rc=None,
+                timed_out=False,
+                stdout_bytes=None,
+                stderr_bytes=None,
+                rusage=None,
+                compose_time=compose_time,
+            )
+        else:
+            return cls(
+                argv=result.argv,
+                start=result.start,
+                end=result.end,
+                rc=result.rc,
+                timed_out=result.timed_out,
+                stdout_bytes=output_size(result.stdout),
+                stderr_bytes=output_size(result.stderr),
+                rusage=result.rusage,
+                compose_time=compose_time,
+            )
+
+    def as_record(self) -> dict[str, Any]:
+        """Return the metrics as a JSON-serializable `dict`"""
+        return {
+            "argv": self.argv,
+            "start": self.start.isoformat(),
+            "end": self.end.isoformat(),
+            "duration": (self.end - self.start).total_seconds(),
+            "rc": self.rc,
+            "timed_out": self.timed_out,
+            "stdout_bytes": self.stdout_bytes,
+            "stderr_bytes": self.stderr_bytes,
+            "rusage": asdict(self.rusage) if self.rusage is not None else None,
+            "compose_time": self.compose_time,
+            "send_time": self.send_time,
+            "send_outcome": self.send_outcome,
+        }
+
+
+def output_size(output: bytes | CapturedOutput | None) -> int | None:
+    """Return the number of bytes of output a command produced"""
+    if output is None:
+        return None
+    elif isinstance(output, TruncatedOutput):
+        return output.total
+    else:
+        return len(output)
+
+
+@dataclass
+class MetricsSink:
+    """
+    Writes records as newline-delimited JSON to ``path``.  If ``path`` is a
+    Unix socket, each record is sent over a new stream connection to it;
+    otherwise, records are appended to the file at ``path``.
+    """
+
+    path: str
+
+    def write(self, record: dict[str, Any]) -> None:
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        try:
+            is_socket = stat.S_ISSOCK(os.stat(self.path).st_mode)
+        except FileNotFoundError:
+            is_socket = False
+        if is_socket:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(self.path)
+                sock.sendall(line)
+        else:
+            # Write each record with a single write() to an O_APPEND file
+            # descriptor so that records from concurrent daemail processes
+            # don't get interleaved
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
@@ -0,0 +1,76 @@
+from __future__ import annotations
+from collections.abc import Callable
+from email.message import EmailMessage
+import socket
+import struct
+from .stream import write_message
+
+#: Reply sent by ``daemail-relayd`` when a message was delivered successfully;
+#: on failure, the reply is ``b"ERR "`` followed by a description of the error
+RELAY_OK = b"OK\n"
+
+
+#: Header preceding each frame of a message sent to the relay, giving the
+#: number of bytes in the frame
+FRAME_HEADER = struct.Struct("!I")
+
+
+class RelayError(Exception):
+    """
+    Raised when ``daemail-relayd`` accepted a message but failed to deliver it
+    """
+
+    pass
+
+
+def relay_send(path: str, msg: EmailMessage) -> None:
+    """
+    Hand a message to the ``daemail-relayd`` instance listening on the Unix
+    socket at ``path`` and wait for it to be delivered.  Raises `OSError` if
+    the relay could not be reached or `RelayError` if delivery failed.
+
+    The protocol is as simple as can be: the client writes the message as a
+    series of frames, each consisting of a `FRAME_HEADER` giving the length
+    of the data that follows, ending with an empty frame, and then shuts down
+    its side of the connection.  The relay replies with a single line once it
+    has finished trying to send the message.  The end frame lets the relay
+    tell a complete message from one cut short by the client dying.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+
+        def write(data: bytes) -> None:
+            if data:
+                s.sendall(FRAME_HEADER.pack(len(data)) + data)
+
+        write_message(msg, write)
+        s.sendall(FRAME_HEADER.pack(0))
+        s.shutdown(socket.SHUT_WR)
+        reply = b""
+        while chunk := s.recv(4096):
+            reply += chunk
+    if reply != RELAY_OK:
+        if reply.startswith(b"ERR "):
+            raise RelayError(reply[4:].decode("utf-8", "replace").strip())
+        else:
+            raise RelayError(f"Invalid reply from relay: {reply!r}")
+
+
+def read_frames(read: Callable[[int], bytes]) -> bytes | None:
+    """
+    Read a message sent by `relay_send()` using ``read``, which must behave
+    like a blocking binary file's ``read()``.  Returns `None` if the
+    connection ended before the end frame.
+    """
+    parts: list[bytes] = []
+    while True:
+        header = read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            return None
+        (size,) = FRAME_HEADER.unpack(header)
+        if size == 0:
+            return b"".join(parts)
+        data = read(size)
+        if len(data) < size:
+            return None
+        parts.append(data)
@@ -0,0 +1,215 @@
+from __future__ import annotations
+from collections.abc import Callable
+from contextlib import suppress
+from dataclasses import dataclass, field
+import email
+from email import policy
+from email.message import EmailMessage
+import logging
+import os
+from pathlib import Path
+import smtplib
+import socketserver
+import threading
+import time
+import click
+from outgoing import Sender, from_config_file, get_default_configpath
+from . import __version__
+from .relay import RELAY_OK, read_frames
+from .util import DurationParamType
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class SenderPool:
+    """
+    A pool of up to ``size`` open ("warm") senders created by calling
+    ``factory``.  For SMTP, this means that the connection, TLS, and
+    authentication handshakes are only performed once per pooled connection
+    rather than once per message.  Senders that have been idle for longer than
+    ``idle_timeout`` seconds are closed & replaced rather than reused, as the
+    server has likely hung up on them by then.
+    """
+
+    factory: Callable[[], Sender]
+    size: int = 4
+    idle_timeout: float = 300
+    #: Open senders not currently in use, along with the times at which they
+    #: were last used, most recently used last
+    idle: list[tuple[Sender, float]] = field(init=False, default_factory=list)
+    lock: threading.Lock = field(init=False, default_factory=threading.Lock)
+    slots: threading.BoundedSemaphore = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.slots = threading.BoundedSemaphore(self.size)
+
+    def send(self, msg: EmailMessage) -> None:
+        """
+        Send a message using a pooled sender, blocking until one is available.
+        If the pooled connection turns out to have been closed by the server,
+        the message is retried once on a fresh connection.
+        """
+        with self.slots:
+            sender, fresh = self._acquire()
+            try:
+                sender.send(msg)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                self._discard(sender)
+                if fresh:
+                    raise
+                log.debug("Pooled connection went stale; reconnecting")
+                sender = self._open()
+                try:
+                    sender.send(msg)
+                except BaseException:
+                    self._discard(sender)
+                    raise
+            except BaseException:
+                # After an error, we don't know what state the connection is
+                # in, so don't reuse it.
+                self._discard(sender)
+                raise
+            with self.lock:
+                self.idle.append((sender, time.monotonic()))
+
+    def _acquire(self) -> tuple[Sender, bool]:
+        now = time.monotonic()
+        with self.lock:
+            while self.idle:
+                sender, last_used = self.idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return (sender, False)
+                self._discard(sender)
+        return (self._open(), True)
+
+    def _open(self) -> Sender:
+        sender = self.factory()
+        try:
+            sender.__enter__()
+        except BaseException:
+            self._discard(sender)
+            raise
+        return sender
+
+    def _discard(self, sender: Sender) -> None:
+        with suppress(Exception):
+            sender.__exit__(None, None, None)
+
+    def close(self) -> None:
+        """Close all idle senders"""
+        with self.lock:
+            while self.idle:
+                self._discard(self.idle.pop()[0])
+
+
+class RelayHandler(socketserver.StreamRequestHandler):
+    server: RelayServer
+
+    def handle(self) -> None:
+        data = read_frames(self.rfile.read)
+        if data is None:
+            log.warning("Discarding incomplete message")
+            self.wfile.write(b"ERR Incomplete message\n")
+            return
+        msg = email.message_from_bytes(
+            data,
+            # <https://github.com/python/typeshed/issues/13273>
+            policy=policy.default,  # type: ignore[arg-type]
+        )
+        try:
+            self.server.pool.send(msg)
+        except Exception as e:
+            log.warning("Failed to send %r: %s", msg.get("Subject"), e)
+            reply = f"ERR {type(e).__name__}: {e}".replace("\n", " ")
+            self.wfile.write(reply.encode("utf-8") + b"\n")
+        else:
+            log.info("Sent %r", msg.get("Subject"))
+            self.wfile.write(RELAY_OK)
+
+
+class RelayServer(socketserver.ThreadingUnixStreamServer):
+    """
+    A server that accepts messages from `relay_send()` on a Unix socket at
+    ``path`` and sends them using a `SenderPool`
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path: str, pool: SenderPool) -> None:
+        self.pool = pool
+        with suppress(FileNotFoundError):
+            os.unlink(path)
+        # Only allow the current user to connect:
+        oldmask = os.umask(0o077)
+        try:
+            super().__init__(path, RelayHandler)
+        finally:
+            os.umask(oldmask)
+
+    def server_close(self) -> None:
+        super().server_close()
+        assert isinstance(self.server_address, str)
+        with suppress(FileNotFoundError):
+            os.unlink(self.server_address)
+        self.pool.close()
+
+
+@click.command(
+    name="daemail-relayd",
+    context_settings={"help_option_names": ["-h", "--help"]},
+)
+@click.version_option(
+    __version__,
+    "-V",
+    "--version",
+    message="%(prog)s %(version)s",
+)
+@click.option(
+    "-c",
+    "--config",
+    type=click.Path(dir_okay=False),
+    default=get_default_configpath,
+    help="Specify the configuration file to use",
+)
+@click.option(
+    "--idle-timeout",
+    type=DurationParamType(),
+    default="5m",
+    show_default=True,
+    help="Reconnect instead of reusing connections idle for this long",
+)
+@click.option(
+    "--pool-size",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Maximum number of simultaneous connections",
+)
+@click.argument("socket_path", type=click.Path(dir_okay=False, resolve_path=True))
+def main(
+    socket_path: str, config: Path | str, idle_timeout: float, pool_size: int
+) -> None:
+    """Send mail for `daemail --relay-socket` over pooled connections"""
+    logging.basicConfig(
+        format="%(asctime)s [%(levelname)-8s] %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S%z",
+        level=logging.INFO,
+    )
+    # Check the configuration before listening:
+    from_config_file(config, fallback=False)
+    pool = SenderPool(
+        factory=lambda: from_config_file(config, fallback=False),
+        size=pool_size,
+        idle_timeout=idle_timeout,
+    )
+    with RelayServer(socket_path, pool) as server:
+        log.info("Listening on %s", socket_path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
@@ -0,0 +1,154 @@
+from __future__ import annotations
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.message import EmailMessage
+import logging
+from pathlib import Path
+import sys
+import click
+from outgoing import from_config_file, get_default_configpath
+from outgoing.senders.smtp import SMTPSender
+from . import __version__
+from .deadletter import DeadLetter, DeadLetterBox, strip_error_parts
+from .relayd import SenderPool
+
+log = logging.getLogger(__name__)
+
+
+def replay(
+    box: DeadLetterBox,
+    entries: list[DeadLetter],
+    send: Callable[[EmailMessage], object],
+    workers: int = 1,
+) -> int:
+    """
+    Resend the messages in ``box`` described by ``entries`` by passing them
+    to ``send`` from up to ``workers`` threads at once, marking each one as
+    delivered in the index once it's sent.  The error descriptions added to
+    the messages when they were saved are removed before sending.  Returns
+    the number of messages that could not be sent.
+    """
+
+    def resend(entry: DeadLetter) -> None:
+        msg = box.read(entry)
+        strip_error_parts(msg)
+        send(msg)
+
+    failures = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(resend, e): e for e in entries}
+        for fut in as_completed(futures):
+            entry = futures[fut]
+            try:
+                fut.result()
+            except Exception as e:
+                log.warning("Failed to resend %s: %s", describe(entry), e)
+                failures += 1
+            else:
+                log.info("Resent %s", describe(entry))
+                box.mark_delivered(entry)
+    return failures
+
+
+def describe(entry: DeadLetter) -> str:
+    s = entry.message_id or f"message at offset {entry.offset}"
+    if entry.command is not None:
+        s += f" ({entry.command})"
+    return s
+
+
+@click.command(
+    name="daemail-replay",
+    context_settings={"help_option_names": ["-h", "--help"]},
+)
+@click.version_option(
+    __version__,
+    "-V",
+    "--version",
+    message="%(prog)s %(version)s",
+)
+@click.option(
+    "-c",
+    "--config",
+    type=click.Path(dir_okay=False),
+    default=get_default_configpath,
+    help="Specify the configuration file to use",
+)
+@click.option(
+    "--limit",
+    type=click.IntRange(min=1),
+    help="Resend at most this many messages",
+)
+@click.option(
+    "-l",
+    "--list",
+    "list_only",
+    is_flag=True,
+    help="List the undelivered messages instead of resending them",
+)
+@click.option(
+    "--pool-size",
+    type=click.IntRange(min=1),
+    help=(
+        "Maximum number of simultaneous connections  [default: 4 for SMTP,"
+        " otherwise 1]"
+    ),
+)
+@click.argument(
+    "mbox",
+    type=click.Path(exists=True, dir_okay=False, resolve_path=True),
+)
+def main(
+    mbox: str,
+    config: Path | str,
+    limit: int | None,
+    list_only: bool,
+    pool_size: int | None,
+) -> None:
+    """Resend the undelivered messages in a daemail dead letter mbox"""
+    logging.basicConfig(
+        format="%(asctime)s [%(levelname)-8s] %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S%z",
+        level=logging.INFO,
+    )
+    box = DeadLetterBox(mbox)
+    entries = box.undelivered()
+    if limit is not None:
+        entries = entries[:limit]
+    if list_only:
+        for e in entries:
+            when = e.timestamp.isoformat() if e.timestamp is not None else "-"
+            click.echo(f"{e.offset}\t{when}\t{e.message_id or '-'}\t{e.command or ''}")
+        return
+    if not entries:
+        log.info("No undelivered messages in %s", mbox)
+        return
+    # Check the configuration before sending anything, and then let the
+    # pool use the sender we loaded for its first connection:
+    loaded = [from_config_file(config, fallback=False)]
+    # Only SMTP senders can safely be used from several threads at once;
+    # other senders (e.g., mbox) write to local files that concurrent
+    # connections would clobber
+    if not isinstance(loaded[0], SMTPSender):
+        if pool_size is not None and pool_size > 1:
+            raise click.UsageError("--pool-size must be 1 when not sending via SMTP")
+        pool_size = 1
+    elif pool_size is None:
+        pool_size = 4
+    pool = SenderPool(
+        factory=lambda: (
+            loaded.pop() if loaded else from_config_file(config, fallback=False)
+        ),
+        size=pool_size,
+    )
+    try:
+        failures = replay(box, entries, pool.send, workers=pool_size)
+    finally:
+        pool.close()
+    log.info("Resent %d of %d messages", len(entries) - failures, len(entries))
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
@@ -1,11 +1,19 @@
 from __future__ import annotations
+from codecs import IncrementalDecoder, getincrementaldecoder
+from collections.abc import Iterable, Iterator
 from dataclasses import dataclass
+from datetime import timedelta
 from email.headerregistry import Address
-from eletter import reply_quote
+import os
+from typing import TYPE_CHECKING
 from . import util  # Access `show_argv()` through `util` for mocking purposes
-from .message import DraftMessage
-from .runner import CommandError, CommandResult
-from .util import dt2stamp, rc_with_signal
+from .capture import STDERR, STDOUT, CapturedOutput, Event, EventView, TruncatedOutput
+from .runner import CommandError, CommandResult, Progress, ResourceUsage
+from .util import dt2stamp, rc_with_signal, reply_quote_chunks
+
+if TYPE_CHECKING:
+    from .dedup import DedupStore, RunRecord
+    from .message import DraftMessage
 
 
 @dataclass
@@ -19,8 +27,45 @@ class CommandReporter:
     stdout_filename: str | None  # non-None iff mime_type is non-None
     to_addrs: list[Address]
     utc: bool
+    #: Compression method to apply to stdout when it is sent as an attachment
+    compress: str | None = None
+    #: Only compress stdout if it is at least this many bytes long
+    compress_threshold: int = 0
+    #: Whether to prefix each line of quoted output with the time at which it
+    #: was received, if the output was captured in an event log
+    timestamps: bool = False
+    #: If non-`None`, failure reports whose exit status & output are the same
+    #: as those of the previous run of the command are shrunk to a short
+    #: notice (or, if `dedup_suppress` is true, not sent at all)
+    dedup: DedupStore | None = None
+    dedup_suppress: bool = False
 
     def report(self, result: CommandResult | CommandError) -> DraftMessage | None:
+        repeat: RunRecord | None = None
+        if (
+            self.dedup is not None
+            and isinstance(result, CommandResult)
+            and status(result) != "DONE"
+        ):
+            repeat = self.dedup.check(result)
+            if repeat is not None and self.dedup_suppress:
+                return None
+        if (
+            isinstance(result, CommandResult)
+            and result.rc == 0
+            and not result.timed_out
+            and (
+                self.failure_only
+                or self.nonempty
+                and not (result.stdout or result.stderr)
+            )
+        ):
+            return None
+        # Don't load the message-composition libraries until we know there's a
+        # message to compose
+        from eletter import reply_quote
+        from .message import DraftMessage
+
         if isinstance(result, CommandError):
             msg = DraftMessage(
                 from_addr=self.from_addr,
@@ -33,17 +78,11 @@ class CommandReporter:
             )
             return msg
         else:
-            if result.rc == 0 and (
-                self.failure_only
-                or self.nonempty
-                and not (result.stdout or result.stderr)
-            ):
-                return None
             msg = DraftMessage(
                 from_addr=self.from_addr,
                 to_addrs=self.to_addrs,
                 subject="[{}] {}".format(
-                    "DONE" if result.rc == 0 else "FAILED",
+                    status(result),
                     util.show_argv(*result.argv),
                 ),
             )
@@ -52,20 +91,236 @@ class CommandReporter:
                 f"End Time:    {dt2stamp(result.end, self.utc)}\n"
                 f"Exit Status: {rc_with_signal(result.rc)}\n"
             )
+            if result.timed_out:
+                msg.addtext("Timed Out:   yes\n")
+            if result.rusage is not None:
+                msg.addtext("\nResource Usage:\n" + show_rusage(result.rusage))
+            if repeat is not None:
+                msg.addtext(
+                    "\nOutput identical to the previous run at"
+                    f" {dt2stamp(repeat.last, self.utc)}"
+                )
+                if repeat.count > 1:
+                    msg.addtext(
+                        f" ({repeat.count + 1} identical runs in a row since"
+                        f" {dt2stamp(repeat.since, self.utc)})"
+                    )
+                msg.addtext("\n")
+                return msg
             # An empty byte string is always an empty character string and vice
             # versa, right?
             if result.stdout:
                 msg.addtext("\nOutput:\n")
                 if self.mime_type is not None:
                     assert self.stdout_filename is not None
-                    msg.addmimeblob(result.stdout, self.mime_type, self.stdout_filename)
+                    if len(result.stdout) >= self.compress_threshold:
+                        compress = self.compress
+                    else:
+                        compress = None
+                    addoutput(
+                        msg,
+                        result.stdout,
+                        self.stdout_filename,
+                        mime_type=self.mime_type,
+                        compress=compress,
+                    )
+                elif self.timestamps and isinstance(result.stdout, EventView):
+                    addevents(msg, result.stdout, "stdout", encoding=self.encoding)
                 else:
-                    msg.addblobquote(result.stdout, self.encoding, "stdout")
+                    addoutput(msg, result.stdout, "stdout", encoding=self.encoding)
             elif result.stdout is not None:
                 msg.addtext("\nOutput: none\n")
             if result.stderr:
                 # If stderr was captured separately but is still empty, don't
                 # bother saying "Error Output: none".
                 msg.addtext("\nError Output:\n")
-                msg.addblobquote(result.stderr, self.stderr_encoding, "stderr")
+                if self.timestamps and isinstance(result.stderr, EventView):
+                    addevents(
+                        msg, result.stderr, "stderr", encoding=self.stderr_encoding
+                    )
+                else:
+                    addoutput(
+                        msg, result.stderr, "stderr", encoding=self.stderr_encoding
+                    )
             return msg
+
+    def record(self, result: CommandResult | CommandError) -> None:
+        """
+        Record a run in the deduplication store (if any) once its report (if
+        any) has been delivered.  Every run is recorded so that a success in
+        between two identical failures keeps the second from being treated as
+        a repeat.
+        """
+        if self.dedup is not None and isinstance(result, CommandResult):
+            self.dedup.record(result)
+
+    def heartbeat(self, progress: Progress) -> DraftMessage:
+        """Compose a ``[RUNNING]`` report on a command that is still running"""
+        from .message import DraftMessage
+
+        msg = DraftMessage(
+            from_addr=self.from_addr,
+            to_addrs=self.to_addrs,
+            subject="[RUNNING] " + util.show_argv(*progress.argv),
+        )
+        elapsed = timedelta(
+            seconds=int((progress.now - progress.start).total_seconds())
+        )
+        msg.addtext(
+            f"Start Time:  {dt2stamp(progress.start, self.utc)}\n"
+            f"Elapsed:     {elapsed}\n"
+        )
+        if progress.rusage is not None:
+            msg.addtext("\nResource Usage So Far:\n" + show_rusage(progress.rusage))
+        # Binary output that would be attached to the final report is left out
+        # entirely, as a piece of it is of little use.
+        if progress.stdout and self.mime_type is None:
+            msg.addtext("\nRecent Output:\n")
+            msg.addblobquote(progress.stdout, self.encoding, "stdout")
+        if progress.stderr:
+            msg.addtext("\nRecent Error Output:\n")
+            msg.addblobquote(progress.stderr, self.stderr_encoding, "stderr")
+        return msg
+
+
+def addoutput(
+    msg: DraftMessage,
+    output: bytes | CapturedOutput,
+    filename: str,
+    encoding: str | None = None,
+    mime_type: str | None = None,
+    compress: str | None = None,
+) -> None:
+    """
+    Add captured output to ``msg``, either as an attachment with the given
+    MIME type (if ``mime_type`` is non-`None`), optionally compressed with the
+    compression method ``compress``, or as a quotation of the output decoded
+    with ``encoding``.  If ``output`` is a `TruncatedOutput` from which
+    data was discarded, the head & tail are added separately with a marker
+    stating the number of omitted bytes in between them; if they end up as
+    attachments, "-head" and "-tail" are inserted into their filenames.
+    """
+    pieces: list[bytes | CapturedOutput]
+    if isinstance(output, TruncatedOutput) and output.omitted:
+        head, tail = output.head, output.tail
+        if mime_type is None:
+            # Don't let a character split by the cut keep the rest of the
+            # text from being quoted
+            assert encoding is not None
+            head, tail = util.trim_split_chars(head, tail, encoding)
+        pieces = [head, tail]
+        omitted = output.total - len(head) - len(tail)
+        marker = f"[... {omitted} bytes omitted ...]\n"
+        stem, ext = os.path.splitext(filename)
+        filenames = [f"{stem}-head{ext}", f"{stem}-tail{ext}"]
+    else:
+        pieces = [output]
+        filenames = [filename]
+    for i, (blob, fname) in enumerate(zip(pieces, filenames)):
+        if i:
+            msg.addtext(marker)
+        if mime_type is not None:
+            msg.addmimeblob(blob, mime_type, fname, compress=compress)
+        else:
+            assert encoding is not None
+            msg.addblobquote(blob, encoding, fname)
+
+
+def addevents(msg: DraftMessage, view: EventView, filename: str, encoding: str) -> None:
+    """
+    Add the output in ``view`` to ``msg`` as a quotation in which each line
+    is prefixed with the time at which it was received (and, if the view
+    covers more than one stream, which stream it came from).  If the output
+    can't be decoded, it is added with `addoutput()` instead.
+
+    If the output is at least `DEFER_QUOTE_SIZE` bytes long, it is only
+    checked here, and the quotation is added as deferred text that is only
+    generated as the message is written out.
+    """
+    from .message import DEFER_QUOTE_SIZE
+
+    def quote() -> Iterator[str]:
+        return reply_quote_chunks(
+            timestamped_lines(view.events(), encoding, len(view.streams) > 1)
+        )
+
+    try:
+        if len(view) >= DEFER_QUOTE_SIZE:
+            msg.adddeferredtext(quote)
+            return
+        pieces = list(quote())
+    except UnicodeDecodeError:
+        addoutput(msg, view, filename, encoding=encoding)
+    else:
+        for p in pieces:
+            msg.addtext(p)
+
+
+#: Labels used for streams when output from several streams is shown together
+STREAM_LABELS = {STDOUT: "out", STDERR: "err"}
+
+
+def timestamped_lines(
+    events: Iterable[Event], encoding: str, labelled: bool
+) -> Iterator[str]:
+    """
+    Decode the output in ``events`` and yield it a line at a time, with each
+    line prefixed by the number of seconds from the start of the log to the
+    arrival of the line's first byte and, if ``labelled`` is true, by the
+    name of the line's stream.  Lines from different streams are yielded in
+    the order in which they were completed.  Raises `UnicodeDecodeError` if
+    the output is not valid in the given encoding.
+    """
+
+    def stamp(offset: float, stream: int) -> str:
+        if labelled:
+            return f"[+{offset:.3f}s {STREAM_LABELS.get(stream, stream)}] "
+        else:
+            return f"[+{offset:.3f}s] "
+
+    decoders: dict[int, IncrementalDecoder] = {}
+    # Mapping from streams to the arrival times & pieces of their incomplete
+    # last lines
+    partial: dict[int, tuple[float, list[str]]] = {}
+    for ev in events:
+        if (decoder := decoders.get(ev.stream)) is None:
+            decoder = decoders[ev.stream] = getincrementaldecoder(encoding)()
+        text = decoder.decode(ev.data)
+        if not text:
+            continue
+        start, pieces = partial.pop(ev.stream, (ev.offset, []))
+        *lines, rest = text.split("\n")
+        for ln in lines:
+            pieces.append(ln)
+            yield stamp(start, ev.stream) + "".join(pieces) + "\n"
+            start, pieces = ev.offset, []
+        if rest:
+            pieces.append(rest)
+            partial[ev.stream] = (start, pieces)
+    for stream, decoder in decoders.items():
+        if text := decoder.decode(b"", final=True):
+            partial.setdefault(stream, (0.0, []))[1].append(text)
+    for stream, (start, pieces) in sorted(partial.items(), key=lambda kv: kv[1][0]):
+        yield stamp(start, stream) + "".join(pieces) + "\n"
+
+
+def status(result: CommandResult) -> str:
+    """Return the status tag for the subject of a report on ``result``"""
+    if result.timed_out:
+        return "TIMEOUT"
+    elif result.rc == 0:
+        return "DONE"
+    else:
+        return "FAILED"
+
+
+def show_rusage(ru: ResourceUsage) -> str:
+    return (
+        f"  Max RSS:                       {ru.maxrss / 1048576:.1f} MiB\n"
+        f"  User CPU Time:                 {ru.utime:.3f} s\n"
+        f"  System CPU Time:               {ru.stime:.3f} s\n"
+        f"  Block Input Operations:        {ru.inblock}\n"
+        f"  Block Output Operations:       {ru.oublock}\n"
+        f"  Voluntary Context Switches:    {ru.nvcsw}\n"
+        f"  Involuntary Context Switches:  {ru.nivcsw}\n"
+    )
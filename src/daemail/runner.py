@@ -1,9 +1,35 @@
 from __future__ import annotations
-from dataclasses import dataclass
+from collections.abc import Callable
+from contextlib import ExitStack, suppress
+from dataclasses import dataclass, field
 from datetime import datetime
+import os
+import selectors
+import signal
 import subprocess
+import sys
+import time
 import traceback
+from typing import TYPE_CHECKING, Any
 from . import util  # Access dtnow through util for mocking purposes
+from .capture import (
+    CHUNK_SIZE,
+    STDERR,
+    STDOUT,
+    CapturedOutput,
+    EventLog,
+    OutputSink,
+    SpooledOutput,
+    TruncatedOutput,
+)
+
+if TYPE_CHECKING:
+    import asyncio
+    import resource
+
+#: Maximum number of bytes of recent output to include in each `Progress`
+#: snapshot
+PROGRESS_TAIL = 8192
 
 
 @dataclass
@@ -11,45 +37,679 @@ class CommandRunner:
     no_stderr: bool
     no_stdout: bool
     split: bool
+    #: If non-`None`, captured output is streamed into `SpooledOutput`
+    #: instances that move to disk once they exceed this many bytes
+    spool_size: int | None = None
+    #: If non-`None`, only the first and last parts of the output, totalling
+    #: at most this many bytes, are kept (using `TruncatedOutput`); this takes
+    #: precedence over `spool_size`
+    max_output: int | None = None
+    #: Whether to record the command's resource usage
+    rusage: bool = False
+    #: If non-`None`, the command (along with the rest of its process group)
+    #: is sent `timeout_signal` once it has run for this many seconds, and
+    #: then it is sent ``SIGKILL`` if it's still running `kill_after` seconds
+    #: later
+    timeout: float | None = None
+    timeout_signal: int = signal.SIGTERM
+    kill_after: float = 10
+    #: If non-`None`, `on_heartbeat` is called with a `Progress` snapshot of
+    #: the command every this many seconds while it runs.  The callback is
+    #: called from the thread that drains the command's output, so it should
+    #: return quickly.
+    heartbeat: float | None = None
+    on_heartbeat: Callable[[Progress], None] | None = None
+    #: If non-`None`, captured output is also copied, as it arrives, to the
+    #: file at this path (appending to it), or to daemail's own standard
+    #: output if this is ``"-"``
+    tee: str | None = None
+    #: Whether to capture stdout and stderr as a single `EventLog` recording
+    #: when each chunk of output arrived.  The streams are still reported
+    #: merged or split as set by `split`, but, either way, they're read
+    #: separately so that the log can tell them apart.
+    events: bool = False
+    #: If non-`None`, this is called with the stream ID (`STDOUT` or
+    #: `STDERR`) of each captured stream when the command is started, and
+    #: the stream's output is also written to each of the sinks it returns
+    #: as it arrives.  (When stdout & stderr are merged, only `STDOUT` is
+    #: passed.)  The sinks are closed once the command has finished, and
+    #: they are then available as `CommandResult.sinks`.
+    sinks: Callable[[int], list[OutputSink]] | None = None
 
     def run(self, command: str, *args: str) -> CommandResult | CommandError:
-        stdout: int | None
-        stderr: int | None
+        argv = [command, *args]
+        stdout, stderr = self.stdio()
+        start = util.dtnow()
+        try:
+            if self.streaming:
+                return self._capture(argv, start, stdout, stderr)
+            else:
+                r = subprocess.run(argv, stdout=stdout, stderr=stderr)
+        except Exception:
+            return CommandError(
+                argv=argv,
+                start=start,
+                end=util.dtnow(),
+                tb=traceback.format_exc(),
+            )
+        end = util.dtnow()
+        return CommandResult(
+            argv=argv,
+            rc=r.returncode,
+            start=start,
+            end=end,
+            stdout=r.stdout,
+            stderr=r.stderr,
+        )
+
+    def stdio(self) -> tuple[int | None, int | None]:
+        """
+        Return the values to pass as the ``stdout`` and ``stderr`` arguments
+        when starting the command
+        """
         if self.split or self.no_stdout or self.no_stderr:
             stdout = None if self.no_stdout else subprocess.PIPE
             stderr = None if self.no_stderr else subprocess.PIPE
+            return (stdout, stderr)
+        else:
+            return (subprocess.PIPE, subprocess.STDOUT)
+
+    @property
+    def streaming(self) -> bool:
+        """
+        Whether output needs to be drained from the command's pipes chunk by
+        chunk rather than read all at once by `subprocess.run()`.  This is
+        also needed for collecting resource usage, as `subprocess.run()`
+        provides no way to get at the child's `os.wait4()` results, and for
+        timeouts, as `subprocess.run()` only kills the immediate child and
+        discards the output captured so far, and for heartbeats, ``tee``,
+        event logs, and extra sinks, as they need access to the output while
+        the command is still running.
+        """
+        return (
+            self.spool_size is not None
+            or self.max_output is not None
+            or self.rusage
+            or self.timeout is not None
+            or self.heartbeat is not None
+            or self.tee is not None
+            or self.events
+            or self.sinks is not None
+        )
+
+    def popen_group_kwargs(self) -> dict[str, Any]:
+        """
+        Return the `subprocess.Popen` arguments for running the command.  When
+        there's a timeout, the command is put in its own process group so
+        that any processes it spawns can be signalled along with it.  Unlike
+        starting a new session, this leaves the command attached to the
+        controlling terminal.
+
+        Before Python 3.11, the only way to do that is with ``preexec_fn``,
+        which isn't safe to use when other threads are running (as they are
+        under ``--batch``), so the command is put in a new session instead.
+        """
+        if self.timeout is None:
+            return {}
+        elif sys.version_info >= (3, 11):
+            return {"process_group": 0}
+        else:
+            return {"start_new_session": True}
+
+    def new_sinks(self, stream: int) -> list[OutputSink]:
+        """Return the extra sinks to also write the output of ``stream`` to"""
+        return self.sinks(stream) if self.sinks is not None else []
+
+    def new_output(self) -> CapturedOutput:
+        if self.max_output is not None:
+            return TruncatedOutput(self.max_output)
         else:
-            stdout = subprocess.PIPE
-            stderr = subprocess.STDOUT
+            # A max_size of None means the data is never moved to disk
+            return SpooledOutput(self.spool_size)
+
+    def _capture(
+        self,
+        argv: list[str],
+        start: datetime,
+        stdout: int | None,
+        stderr: int | None,
+    ) -> CommandResult:
+        log: EventLog | None = None
+        # `out` and `err` are what's reported; output is read into `out_sink`
+        # and `err_sink`
+        out: CapturedOutput | None
+        err: CapturedOutput | None
+        out_sink: CapturedOutput | None
+        err_sink: CapturedOutput | None
+        if self.events:
+            log = EventLog(self.spool_size)
+            # Read the streams into separate views of the log, but report
+            # them merged if they would otherwise be merged
+            out_sink = log.view(STDOUT) if stdout == subprocess.PIPE else None
+            err_sink = log.view(STDERR) if stderr is not None else None
+            if stderr == subprocess.STDOUT:
+                stderr = subprocess.PIPE
+                out, err = log.view(STDOUT, STDERR), None
+            else:
+                out, err = out_sink, err_sink
+        else:
+            out = self.new_output() if stdout == subprocess.PIPE else None
+            err = self.new_output() if stderr == subprocess.PIPE else None
+            out_sink, err_sink = out, err
+        tee: Tee | None = None
+        extras: dict[int, list[OutputSink]] = {}
+        try:
+            if self.tee is not None:
+                tee = Tee.open(self.tee)
+            # Each stream's output is fanned out to its capture, its extra
+            # sinks, and the tee
+            fanouts: dict[int, list[OutputSink]] = {}
+            for stream, sink in ((STDOUT, out_sink), (STDERR, err_sink)):
+                if sink is not None:
+                    extras[stream] = self.new_sinks(stream)
+                    fanouts[stream] = [sink, *extras[stream]]
+                    if tee is not None:
+                        fanouts[stream].append(tee)
+            with subprocess.Popen(
+                argv,
+                stdout=stdout,
+                stderr=stderr,
+                **self.popen_group_kwargs(),
+            ) as p:
+                if self.timeout is not None:
+                    timer = Timer(
+                        pgid=p.pid,
+                        timeout=self.timeout,
+                        signal=self.timeout_signal,
+                        kill_after=self.kill_after,
+                    )
+                else:
+                    timer = None
+                if self.heartbeat is not None and self.on_heartbeat is not None:
+
+                    def snapshot() -> Progress:
+                        return Progress(
+                            argv=argv,
+                            start=start,
+                            now=util.dtnow(),
+                            stdout=recent_output(out),
+                            stderr=recent_output(err),
+                            rusage=proc_usage(p.pid),
+                        )
+
+                    beat = Heartbeat(
+                        interval=self.heartbeat,
+                        snapshot=snapshot,
+                        callback=self.on_heartbeat,
+                    )
+                else:
+                    beat = None
+                with selectors.DefaultSelector() as sel:
+                    if out_sink is not None:
+                        assert p.stdout is not None
+                        sel.register(p.stdout, selectors.EVENT_READ, fanouts[STDOUT])
+                    if err_sink is not None:
+                        assert p.stderr is not None
+                        sel.register(p.stderr, selectors.EVENT_READ, fanouts[STDERR])
+                    while sel.get_map():
+                        for key, _ in sel.select(next_wait(timer, beat)):
+                            chunk = os.read(key.fd, CHUNK_SIZE)
+                            if chunk:
+                                for sink in key.data:
+                                    sink.write(chunk)
+                            else:
+                                sel.unregister(key.fileobj)
+                        if timer is not None:
+                            timer.check()
+                        if beat is not None:
+                            beat.check()
+                rc, usage = self._wait(p, timer, beat)
+            close_sinks(extras)
+        except BaseException:
+            for o in (out, err, log):
+                if o is not None:
+                    o.close()
+            with suppress(Exception):
+                close_sinks(extras)
+            raise
+        finally:
+            if tee is not None:
+                tee.close()
+        return CommandResult(
+            argv=argv,
+            rc=rc,
+            start=start,
+            end=util.dtnow(),
+            stdout=out,
+            stderr=err,
+            rusage=usage,
+            timed_out=timer is not None and timer.timed_out,
+            events=log,
+            sinks=extras,
+        )
+
+    def _wait(
+        self, p: subprocess.Popen[bytes], timer: Timer | None, beat: Heartbeat | None
+    ) -> tuple[int, ResourceUsage | None]:
+        """
+        Wait for the command to exit (continuing to enforce the timeout and
+        send heartbeats, if any) and return its exit status and, if requested,
+        resource usage
+        """
+        while True:
+            wait = next_wait(timer, beat)
+            if self.rusage:
+                # Popen.wait() would reap the process and discard its rusage,
+                # so call wait4() ourselves, polling if there's a deadline.
+                flags = 0 if wait is None else os.WNOHANG
+                pid, status, ru = os.wait4(p.pid, flags)
+                if pid:
+                    p.returncode = rc = os.waitstatus_to_exitcode(status)
+                    return (rc, ResourceUsage.from_rusage(ru))
+                time.sleep(min(0.05, wait or 0.05))
+            else:
+                try:
+                    return (p.wait(wait), None)
+                except subprocess.TimeoutExpired:
+                    pass
+            if timer is not None:
+                timer.check()
+            if beat is not None:
+                beat.check()
+
+
+def close_sinks(sinks: dict[int, list[OutputSink]]) -> None:
+    """Close all of the given sinks, even if closing some of them fails"""
+    with ExitStack() as stack:
+        for stream_sinks in sinks.values():
+            for sink in stream_sinks:
+                stack.callback(sink.close)
+
+
+@dataclass
+class Tee(OutputSink):
+    """
+    Copies captured output to a file descriptor as it arrives.  Failures to
+    write (e.g., because the reader of a pipe went away) are not allowed to
+    interfere with capturing the output; once a write fails, further output
+    is no longer copied.
+    """
+
+    fd: int
+    #: Whether to close ``fd`` when done
+    owned: bool
+    failed: bool = False
+
+    @classmethod
+    def open(cls, path: str) -> Tee:
+        """
+        Open the file at ``path`` for appending, or use standard output if
+        ``path`` is ``"-"``
+        """
+        if path == "-":
+            sys.stdout.flush()
+            return cls(fd=sys.stdout.fileno(), owned=False)
+        else:
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            return cls(fd=fd, owned=True)
+
+    def write(self, data: bytes) -> None:
+        if self.failed:
+            return
+        view = memoryview(data)
+        try:
+            while view:
+                view = view[os.write(self.fd, view) :]
+        except OSError:
+            self.failed = True
+
+    def close(self) -> None:
+        if self.owned:
+            os.close(self.fd)
+
+
+@dataclass
+class Timer:
+    """
+    Tracks a command's deadline and, once it passes, signals the command's
+    process group ``pgid`` with ``signal`` and then with ``SIGKILL`` after a
+    further ``kill_after`` seconds
+    """
+
+    pgid: int
+    timeout: float
+    signal: int
+    kill_after: float
+    deadline: float = field(init=False)
+    #: Whether the deadline has passed and ``signal`` has been sent
+    timed_out: bool = field(init=False, default=False)
+    #: Whether ``SIGKILL`` has been sent
+    killed: bool = field(init=False, default=False)
+
+    def __post_init__(self) -> None:
+        self.deadline = time.monotonic() + self.timeout
+
+    def remaining(self) -> float | None:
+        """
+        Return the number of seconds until the next escalation, or `None` if
+        there are no escalations left
+        """
+        if self.killed:
+            return None
+        return max(self.deadline - time.monotonic(), 0)
+
+    def check(self) -> None:
+        """Send the next signal if its time has come"""
+        if self.killed or time.monotonic() < self.deadline:
+            return
+        if not self.timed_out:
+            self.timed_out = True
+            killpg(self.pgid, self.signal)
+            self.deadline = time.monotonic() + self.kill_after
+        else:
+            self.killed = True
+            killpg(self.pgid, signal.SIGKILL)
+
+
+def killpg(pgid: int, sig: int) -> None:
+    with suppress(ProcessLookupError, PermissionError):
+        os.killpg(pgid, sig)
+
+
+@dataclass
+class Heartbeat:
+    """
+    Calls ``callback`` with the result of ``snapshot()`` every ``interval``
+    seconds
+    """
+
+    interval: float
+    snapshot: Callable[[], Progress]
+    callback: Callable[[Progress], None]
+    next_beat: float = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.next_beat = time.monotonic() + self.interval
+
+    def remaining(self) -> float:
+        """Return the number of seconds until the next heartbeat"""
+        return max(self.next_beat - time.monotonic(), 0)
+
+    def check(self) -> None:
+        """Call the callback if the time for the next heartbeat has come"""
+        now = time.monotonic()
+        if now < self.next_beat:
+            return
+        self.callback(self.snapshot())
+        # If we've fallen behind, skip the missed heartbeats rather than
+        # sending them all at once:
+        self.next_beat = now + self.interval - (now - self.next_beat) % self.interval
+
+
+def next_wait(timer: Timer | None, beat: Heartbeat | None) -> float | None:
+    """
+    Return the number of seconds until the timer or heartbeat next needs
+    attention, or `None` if neither does
+    """
+    waits = []
+    if timer is not None and (w := timer.remaining()) is not None:
+        waits.append(w)
+    if beat is not None:
+        waits.append(beat.remaining())
+    return min(waits, default=None)
+
+
+def recent_output(output: CapturedOutput | None) -> bytes | None:
+    """
+    Return the last `PROGRESS_TAIL` bytes of ``output``, starting at a line
+    boundary if any earlier output was cut off
+    """
+    if output is None:
+        return None
+    blob = output.last_bytes(PROGRESS_TAIL)
+    if len(blob) < len(output) and (i := blob.find(b"\n")) != -1:
+        blob = blob[i + 1 :]
+    return blob
+
+
+def proc_usage(pid: int) -> ResourceUsage | None:
+    """
+    Return the resource usage so far of the still-running process ``pid``, as
+    read from :file:`/proc`, or `None` if it can't be determined (e.g., on
+    systems without :file:`/proc`).  Unlike the figures from `os.wait4()`,
+    these cover only the process itself and not any of its children, and the
+    block operation counts are estimated from the bytes read from & written
+    to storage.
+    """
+    try:
+        with open(f"/proc/{pid}/stat", encoding="utf-8") as fp:
+            stat = fp.read()
+        with open(f"/proc/{pid}/status", encoding="utf-8") as fp:
+            status = dict(line.split(":", 1) for line in fp if ":" in line)
+    except OSError:
+        return None
+    io: dict[str, str] = {}
+    with suppress(OSError):
+        with open(f"/proc/{pid}/io", encoding="utf-8") as fp:
+            io = dict(line.split(":", 1) for line in fp if ":" in line)
+    # The command name (field 2) can contain spaces and parentheses, so split
+    # the remaining fields off after the last close paren; field 3 is then at
+    # index 0.
+    fields = stat[stat.rindex(")") + 2 :].split()
+    ticks = os.sysconf("SC_CLK_TCK")
+    # Zombie processes have no memory statistics
+    hwm = status.get("VmHWM", "0 kB").split()
+    return ResourceUsage(
+        maxrss=int(hwm[0]) * 1024,
+        utime=int(fields[11]) / ticks,
+        stime=int(fields[12]) / ticks,
+        inblock=int(io.get("read_bytes", 0)) // 512,
+        oublock=int(io.get("write_bytes", 0)) // 512,
+        nvcsw=int(status.get("voluntary_ctxt_switches", 0)),
+        nivcsw=int(status.get("nonvoluntary_ctxt_switches", 0)),
+    )
+
+
+@dataclass
+class AsyncCommandRunner(CommandRunner):
+    """
+    A `CommandRunner` that runs commands with `asyncio`, draining their output
+    into sinks as it arrives so that many commands can be supervised at once
+    from a single event loop.  Resource usage is not recorded, even if
+    `rusage` is set, as `asyncio` reaps its child processes itself, and
+    `heartbeat` and `events` are ignored.
+    """
+
+    #: Function for creating the `CapturedOutput` sinks that output is
+    #: drained into.  If `None`, `new_output()` is used.
+    sink_factory: Callable[[], CapturedOutput] | None = None
+
+    def run(self, command: str, *args: str) -> CommandResult | CommandError:
+        import asyncio
+
+        return asyncio.run(self.run_async(command, *args))
+
+    async def run_async(self, command: str, *args: str) -> CommandResult | CommandError:
+        # Imported here so that the synchronous code path doesn't have to pay
+        # for loading asyncio
+        import asyncio
+
+        stdout, stderr = self.stdio()
         start = util.dtnow()
+        out = self.new_sink() if stdout == subprocess.PIPE else None
+        err = self.new_sink() if stderr == subprocess.PIPE else None
+        proc: asyncio.subprocess.Process | None = None
+        task: asyncio.Future[int] | None = None
+        tee: Tee | None = None
+        extras: dict[int, list[OutputSink]] = {}
+        timed_out = False
         try:
-            r = subprocess.run([command, *args], stdout=stdout, stderr=stderr)
-        except Exception:
+            if self.tee is not None:
+                tee = Tee.open(self.tee)
+            fanouts: dict[int, list[OutputSink]] = {}
+            for stream, sink in ((STDOUT, out), (STDERR, err)):
+                if sink is not None:
+                    extras[stream] = self.new_sinks(stream)
+                    fanouts[stream] = [sink, *extras[stream]]
+                    if tee is not None:
+                        fanouts[stream].append(tee)
+            proc = await asyncio.create_subprocess_exec(
+                command,
+                *args,
+                stdout=stdout,
+                stderr=stderr,
+                **self.popen_group_kwargs(),
+            )
+
+            async def supervise(p: asyncio.subprocess.Process) -> int:
+                await asyncio.gather(
+                    drain(p.stdout, fanouts.get(STDOUT, [])),
+                    drain(p.stderr, fanouts.get(STDERR, [])),
+                )
+                return await p.wait()
+
+            task = asyncio.ensure_future(supervise(proc))
+            if self.timeout is not None:
+                done, _ = await asyncio.wait({task}, timeout=self.timeout)
+                if not done:
+                    timed_out = True
+                    killpg(proc.pid, self.timeout_signal)
+                    done, _ = await asyncio.wait({task}, timeout=self.kill_after)
+                    if not done:
+                        killpg(proc.pid, signal.SIGKILL)
+            rc = await task
+            close_sinks(extras)
+        except BaseException as e:
+            for o in (out, err):
+                if o is not None:
+                    o.close()
+            with suppress(Exception):
+                close_sinks(extras)
+            if task is not None:
+                task.cancel()
+            if proc is not None and proc.returncode is None:
+                with suppress(ProcessLookupError):
+                    proc.kill()
+                # Reap the child, as Popen.__exit__() does for the synchronous
+                # runner, so that it isn't left as a zombie
+                await proc.wait()
+            if not isinstance(e, Exception):
+                # Don't swallow cancellation or KeyboardInterrupt
+                raise
             return CommandError(
                 argv=[command, *args],
                 start=start,
                 end=util.dtnow(),
                 tb=traceback.format_exc(),
             )
+        finally:
+            if tee is not None:
+                tee.close()
         end = util.dtnow()
         return CommandResult(
             argv=[command, *args],
-            rc=r.returncode,
+            rc=rc,
             start=start,
             end=end,
-            stdout=r.stdout,
-            stderr=r.stderr,
+            stdout=out,
+            stderr=err,
+            timed_out=timed_out,
+            sinks=extras,
+        )
+
+    def new_sink(self) -> CapturedOutput:
+        if self.sink_factory is not None:
+            return self.sink_factory()
+        else:
+            return self.new_output()
+
+
+async def drain(stream: asyncio.StreamReader | None, sinks: list[OutputSink]) -> None:
+    """Copy data from ``stream`` to each of ``sinks`` until EOF"""
+    if stream is None:
+        return
+    while chunk := await stream.read(CHUNK_SIZE):
+        for sink in sinks:
+            sink.write(chunk)
+
+
+@dataclass
+class ResourceUsage:
+    """
+    Resource usage of a command, as reported by `os.wait4()` once it has
+    finished or by `proc_usage()` while it's running
+    """
+
+    #: Maximum resident set size in bytes
+    maxrss: int
+    #: User CPU time in seconds
+    utime: float
+    #: System CPU time in seconds
+    stime: float
+    #: Number of block input operations
+    inblock: int
+    #: Number of block output operations
+    oublock: int
+    #: Number of voluntary context switches
+    nvcsw: int
+    #: Number of involuntary context switches
+    nivcsw: int
+
+    @classmethod
+    def from_rusage(cls, ru: resource.struct_rusage) -> ResourceUsage:
+        # ru_maxrss is in kilobytes everywhere but macOS, where it's in bytes
+        maxrss = ru.ru_maxrss if sys.platform == "darwin" else ru.ru_maxrss * 1024
+        return cls(
+            maxrss=maxrss,
+            utime=ru.ru_utime,
+            stime=ru.ru_stime,
+            inblock=ru.ru_inblock,
+            oublock=ru.ru_oublock,
+            nvcsw=ru.ru_nvcsw,
+            nivcsw=ru.ru_nivcsw,
         )
 
 
+@dataclass
+class Progress:
+    """A snapshot of a command that is still running"""
+
+    argv: list[str]
+    start: datetime  # aware
+    now: datetime  # aware
+    #: The most recent output captured so far, or `None` if not captured
+    stdout: bytes | None
+    stderr: bytes | None
+    #: The resource usage so far, if available
+    rusage: ResourceUsage | None
+
+
 @dataclass
 class CommandResult:
     argv: list[str]
     rc: int
     start: datetime  # aware
     end: datetime  # aware
-    stdout: bytes | None
-    stderr: bytes | None
+    stdout: bytes | CapturedOutput | None
+    stderr: bytes | CapturedOutput | None
+    #: Only set if resource usage was requested
+    rusage: ResourceUsage | None = None
+    #: Whether the command was killed for running past its timeout
+    timed_out: bool = False
+    #: Only set if an event log was requested, in which case `stdout` and
+    #: `stderr` are views of it
+    events: EventLog | None = None
+    #: The extra sinks (see `CommandRunner.sinks`) that each stream's output
+    #: was written to, keyed by stream ID
+    sinks: dict[int, list[OutputSink]] = field(default_factory=dict)
+
+    def close(self) -> None:
+        """Release any resources held by captured output"""
+        for out in (self.stdout, self.stderr):
+            if isinstance(out, CapturedOutput):
+                out.close()
+        if self.events is not None:
+            self.events.close()
 
 
 @dataclass
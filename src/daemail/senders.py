@@ -1,53 +1,174 @@
+from __future__ import annotations
 from dataclasses import dataclass
+from email.message import EmailMessage
+import json
 import locale
+from pathlib import Path
 from subprocess import CalledProcessError
+import sys
 import traceback
-from eletter import reply_quote
-from outgoing import Sender, from_dict
-from .message import DraftMessage
+from typing import TYPE_CHECKING
+from .deadletter import ERROR_PART_HEADER, DeadLetterBox
+from .relay import relay_send
+from .spool import Spool
+from .stream import send_with
 from .util import rc_with_signal
 
+if TYPE_CHECKING:
+    from outgoing import Sender
+    from .message import DraftMessage
+
 
 @dataclass
 class TryingSender:
     """
     Tries to send a message via the given sender object, falling back to
-    sending to the mbox at ``dead_letter_path`` if that fails
+    saving it in the `DeadLetterBox` at ``dead_letter_path`` if that fails.  If
+    ``spool_dir`` is set, messages are instead queued in the `Spool` at that
+    path for later delivery by ``daemail-spoold``.  If ``relay_socket`` is
+    set, messages are sent via the ``daemail-relayd`` instance listening on
+    that socket, falling back to ``sender`` if the relay is not running.
+
+    If ``sender`` is `None`, it is loaded from the ``outgoing`` configuration
+    file at ``configpath`` (or from the default configuration file if that is
+    also `None`) when first needed, so that ``outgoing`` is not imported
+    until there is something to send.
     """
 
-    sender: Sender
+    sender: Sender | None
     dead_letter_path: str
+    spool_dir: str | None = None
+    relay_socket: str | None = None
+    configpath: str | Path | None = None
+
+    def check_config(self) -> None:
+        """
+        Cheaply check that the ``outgoing`` configuration file at
+        ``configpath`` (or the default configuration file if that is `None`)
+        can be read, parsed, and contains an ``outgoing`` table, without
+        loading the sender, so that mistakes can be reported before
+        daemonizing rather than after the command has run.  Raises
+        `ValueError` if there's a problem.  The sender specification itself
+        is only validated once it's loaded.
+        """
+        if self.sender is not None:
+            return
+        if self.configpath is None:
+            from outgoing import get_default_configpath
 
-    def send(self, msg: DraftMessage) -> None:
-        msgobj = msg.compile()
+            path = get_default_configpath()
+        else:
+            path = Path(self.configpath)
+        if path.suffix not in (".toml", ".json"):
+            raise ValueError(f"{path}: unsupported configuration file extension")
         try:
-            self.sender.send(msgobj)
-        except Exception as e:
-            msg.addtext(
-                "\nAdditionally, an error occurred while trying to send"
-                " this e-mail:\n\n"
-            )
-            if isinstance(e, CalledProcessError):
-                msg.addtext(f"Command: {e.cmd}\n")
-                msg.addtext(f"Exit Status: {rc_with_signal(e.returncode)}\n")
-                if e.output:
-                    msg.addtext("\nOutput:\n")
-                    msg.addblobquote(
-                        e.output,
-                        locale.getpreferredencoding(True),
-                        "sendmail-output",
-                    )
+            with path.open("rb") as fp:
+                if path.suffix == ".json":
+                    data = json.load(fp)
+                elif sys.version_info >= (3, 11):
+                    import tomllib
+
+                    data = tomllib.load(fp)
                 else:
-                    msg.addtext("\nOutput: none\n")
-                if e.stderr:
-                    msg.addtext("\nStderr:\n")
-                    msg.addblobquote(
-                        e.stderr,
-                        locale.getpreferredencoding(True),
-                        "sendmail-stderr",
-                    )
+                    # Leave checking the syntax to outgoing
+                    return
+        except OSError as e:
+            raise ValueError(f"{path}: could not read configuration: {e.strerror}")
+        except ValueError as e:
+            # TOMLDecodeError and JSONDecodeError are both ValueErrors
+            raise ValueError(f"{path}: invalid configuration: {e}")
+        if not isinstance(data, dict) or not isinstance(data.get("outgoing"), dict):
+            raise ValueError(f"{path}: no outgoing configuration found")
+
+    def get_sender(self) -> Sender:
+        if self.sender is None:
+            from outgoing import from_config_file
+
+            self.sender = from_config_file(self.configpath, fallback=False)
+        return self.sender
+
+    def send(self, msg: DraftMessage) -> str:
+        """
+        Send ``msg`` and return how it was handled: ``"spooled"``,
+        ``"relayed"``, ``"sent"``, or ``"dead-letter"``
+        """
+        return self.send_message(msg.compile(deferred=True))
+
+    def send_message(self, msgobj: EmailMessage) -> str:
+        """
+        Like `send()`, but for an already-composed message, which may contain
+        deferred parts
+        """
+        if self.spool_dir is not None:
+            try:
+                Spool(self.spool_dir).add(msgobj)
+            except Exception:
+                # Fall back to sending directly
+                pass
+            else:
+                return "spooled"
+        return self.deliver(msgobj)
+
+    def deliver(self, msgobj: EmailMessage) -> str:
+        """
+        Send an already-composed message, saving it to the dead letter mbox if
+        that fails.  Returns ``"relayed"``, ``"sent"``, or ``"dead-letter"``
+        to indicate what happened.
+        """
+        try:
+            if self.relay_socket is not None:
+                try:
+                    relay_send(self.relay_socket, msgobj)
+                except OSError:
+                    # The relay isn't running; send the message ourselves
+                    send_with(self.get_sender(), msgobj)
+                else:
+                    return "relayed"
+            else:
+                send_with(self.get_sender(), msgobj)
+        except Exception as e:
+            self.save_dead_letter(msgobj, e)
+            return "dead-letter"
+        return "sent"
+
+    def save_dead_letter(self, msgobj: EmailMessage, e: Exception) -> None:
+        """
+        Append ``msgobj`` to the dead letter mbox along with a description of
+        the exception ``e`` that occurred while trying to send it
+        """
+        from eletter import reply_quote
+        from .message import DraftBody, append_part
+
+        # Describe the error in a new part appended to the already-composed
+        # message rather than adding it to the draft and compiling everything
+        # all over again
+        annex = DraftBody()
+        annex.addtext(
+            "Additionally, an error occurred while trying to send this e-mail:\n\n"
+        )
+        if isinstance(e, CalledProcessError):
+            annex.addtext(f"Command: {e.cmd}\n")
+            annex.addtext(f"Exit Status: {rc_with_signal(e.returncode)}\n")
+            if e.output:
+                annex.addtext("\nOutput:\n")
+                annex.addblobquote(
+                    e.output,
+                    locale.getpreferredencoding(True),
+                    "sendmail-output",
+                )
             else:
-                msg.addtext(reply_quote(traceback.format_exc()))
-            ### TODO: Handle failures here!
-            with from_dict({"method": "mbox", "path": self.dead_letter_path}) as sender:
-                sender.send(msg.compile())
+                annex.addtext("\nOutput: none\n")
+            if e.stderr:
+                annex.addtext("\nStderr:\n")
+                annex.addblobquote(
+                    e.stderr,
+                    locale.getpreferredencoding(True),
+                    "sendmail-stderr",
+                )
+        else:
+            annex.addtext(reply_quote("".join(traceback.format_exception(e))))
+        part = annex.compose()
+        part[ERROR_PART_HEADER] = type(e).__name__
+        append_part(msgobj, part)
+        ### TODO: Handle failures here!
+        DeadLetterBox(self.dead_letter_path).add(msgobj)
@@ -0,0 +1,82 @@
+"""
+`OutputSink` implementations for inspecting a command's output as it's
+captured, without storing it or reading it back afterwards.  Any number of
+these can be attached to each of a command's streams via
+`CommandRunner.sinks`.
+"""
+
+from __future__ import annotations
+import hashlib
+from .capture import COMPRESSION_TYPES, OutputSink, get_compressor
+
+
+class LineCounter(OutputSink):
+    """Counts the bytes and lines of output"""
+
+    def __init__(self) -> None:
+        #: Total number of bytes written
+        self.nbytes = 0
+        #: Number of newline characters written
+        self.newlines = 0
+        self._last = b"\n"
+
+    def __repr__(self) -> str:
+        return f"<LineCounter: {self.lines} lines, {self.nbytes} bytes>"
+
+    def write(self, chunk: bytes) -> None:
+        if chunk:
+            self.nbytes += len(chunk)
+            self.newlines += chunk.count(b"\n")
+            self._last = chunk[-1:]
+
+    @property
+    def lines(self) -> int:
+        """The number of lines, counting a final line without a newline"""
+        return self.newlines + (self._last != b"\n")
+
+
+class Hasher(OutputSink):
+    """Computes a digest of the output using a `hashlib` algorithm"""
+
+    def __init__(self, algorithm: str = "sha256") -> None:
+        self.algorithm = algorithm
+        self._hash = hashlib.new(algorithm)
+
+    def __repr__(self) -> str:
+        return f"<Hasher: {self.algorithm}:{self.hexdigest()}>"
+
+    def write(self, chunk: bytes) -> None:
+        self._hash.update(chunk)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+
+class CompressedFile(OutputSink):
+    """
+    Compresses the output with the given compression method (one of the keys
+    of `COMPRESSION_TYPES`) and writes it to the file at ``path``.  The file
+    is complete once the sink is closed.
+    """
+
+    def __init__(self, path: str, method: str) -> None:
+        if method not in COMPRESSION_TYPES:
+            raise ValueError(f"Unknown compression method: {method!r}")
+        self.path = path
+        self.method = method
+        self._compressor = get_compressor(method)
+        self._fp = open(path, "wb")
+
+    def __repr__(self) -> str:
+        return f"<CompressedFile: {self.path!r}, method={self.method!r}>"
+
+    def write(self, chunk: bytes) -> None:
+        if data := self._compressor.compress(chunk):
+            self._fp.write(data)
+
+    def close(self) -> None:
+        if not self._fp.closed:
+            try:
+                self._fp.write(self._compressor.flush())
+            finally:
+                self._fp.close()
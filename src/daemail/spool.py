@@ -0,0 +1,96 @@
+from __future__ import annotations
+from collections.abc import Iterator
+from contextlib import contextmanager, suppress
+from dataclasses import dataclass
+import email
+from email import policy
+from email.message import EmailMessage
+import fcntl
+from itertools import count
+import os
+import socket
+import time
+from .stream import write_message
+
+_counter = count()
+
+
+@dataclass
+class Spool:
+    """
+    A maildir-style directory of composed messages awaiting delivery by
+    ``daemail-spoold``.  Each message is stored in a file of its own, which is
+    written under :file:`tmp/` and then renamed into :file:`new/` so that
+    partially-written messages are never seen by the worker.
+    """
+
+    path: str
+
+    def __post_init__(self) -> None:
+        for subdir in ("tmp", "new"):
+            os.makedirs(os.path.join(self.path, subdir), exist_ok=True)
+
+    def add(self, msg: EmailMessage) -> str:
+        """
+        Atomically add a message (which may contain deferred parts) to the
+        spool and return its key
+        """
+        key = "{}.P{}Q{}.{}".format(
+            time.time_ns(), os.getpid(), next(_counter), socket.gethostname()
+        )
+        tmppath = os.path.join(self.path, "tmp", key)
+        try:
+            with open(tmppath, "wb") as fp:
+                write_message(msg, fp.write)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.rename(tmppath, self._path(key))
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.unlink(tmppath)
+            raise
+        return key
+
+    def keys(self) -> list[str]:
+        """Return the keys of all spooled messages, oldest first"""
+        return sorted(
+            (k for k in os.listdir(os.path.join(self.path, "new")) if k[0] != "."),
+            key=self.mtime,
+        )
+
+    def get(self, key: str) -> EmailMessage:
+        """Read the message with the given key from the spool"""
+        with open(self._path(key), "rb") as fp:
+            return email.message_from_binary_file(
+                fp,
+                # <https://github.com/python/typeshed/issues/13273>
+                policy=policy.default,  # type: ignore[arg-type]
+            )
+
+    def mtime(self, key: str) -> float:
+        """Return the time at which the given message was spooled"""
+        return os.stat(self._path(key)).st_mtime
+
+    def size(self, key: str) -> int:
+        """Return the size in bytes of the given message"""
+        return os.stat(self._path(key)).st_size
+
+    def remove(self, key: str) -> None:
+        """Delete the message with the given key from the spool"""
+        os.unlink(self._path(key))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.path, "new", key)
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        """
+        Hold an exclusive lock on the spool so that only one worker delivers
+        from it at a time
+        """
+        with open(os.path.join(self.path, ".lock"), "a") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
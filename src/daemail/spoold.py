@@ -0,0 +1,225 @@
+from __future__ import annotations
+from dataclasses import dataclass, field, replace
+import logging
+from pathlib import Path
+import time
+import click
+from outgoing import from_config_file, get_default_configpath
+from . import __version__
+from .digest import flush_digests
+from .senders import TryingSender
+from .spool import Spool
+from .util import DurationParamType, SizeParamType
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class SpoolWorker:
+    """
+    Delivers the messages in a `Spool` via ``mailer``'s sender, retrying
+    failed deliveries with exponential backoff (starting at ``min_delay``
+    seconds and doubling up to ``max_delay`` seconds) and moving messages that
+    still can't be delivered after ``max_age`` seconds to ``mailer``'s dead
+    letter mbox.
+
+    If ``digest_dir`` is set, each pass first sends any digests stored there
+    (by ``daemail --digest``) that are due according to ``digest_window`` &
+    ``digest_size``, queueing them in the spool so that they're retried like
+    any other message.
+    """
+
+    spool: Spool
+    mailer: TryingSender
+    max_age: float
+    min_delay: float = 60
+    max_delay: float = 3600
+    digest_dir: str | None = None
+    digest_window: float = 600
+    digest_size: int = 5 << 20
+    #: Mapping from keys of messages that failed to send to the number of
+    #: consecutive failures and the time at which to next try sending
+    retries: dict[str, tuple[int, float]] = field(init=False, default_factory=dict)
+
+    def drain(self) -> int:
+        """
+        Make a single pass over the spool, trying to deliver each message whose
+        retry time has arrived.  Returns the number of messages left in the
+        spool afterwards.
+        """
+        if self.digest_dir is not None:
+            flush_digests(
+                self.digest_dir,
+                self.digest_window,
+                self.digest_size,
+                replace(self.mailer, spool_dir=self.spool.path),
+            )
+        remaining = 0
+        with self.spool.locked():
+            for key in self.spool.keys():
+                failures, next_try = self.retries.get(key, (0, 0))
+                now = time.time()
+                if next_try > now:
+                    remaining += 1
+                    continue
+                msg = self.spool.get(key)
+                try:
+                    self.mailer.get_sender().send(msg)
+                except Exception as e:
+                    failures += 1
+                    if now - self.spool.mtime(key) >= self.max_age:
+                        log.error(
+                            "Delivery of %s failed %d times; giving up: %s",
+                            key,
+                            failures,
+                            e,
+                        )
+                        self.mailer.save_dead_letter(msg, e)
+                        self.spool.remove(key)
+                        self.retries.pop(key, None)
+                    else:
+                        delay = min(
+                            self.min_delay * 2 ** (failures - 1), self.max_delay
+                        )
+                        log.warning(
+                            "Delivery of %s failed; retrying in %gs: %s",
+                            key,
+                            delay,
+                            e,
+                        )
+                        self.retries[key] = (failures, now + delay)
+                        remaining += 1
+                else:
+                    log.info("Delivered %s", key)
+                    self.spool.remove(key)
+                    self.retries.pop(key, None)
+        return remaining
+
+    def run(self, interval: float) -> None:
+        """Drain the spool every ``interval`` seconds forever"""
+        while True:
+            self.drain()
+            time.sleep(interval)
+
+
+@click.command(
+    name="daemail-spoold",
+    context_settings={"help_option_names": ["-h", "--help"]},
+)
+@click.version_option(
+    __version__,
+    "-V",
+    "--version",
+    message="%(prog)s %(version)s",
+)
+@click.option(
+    "-c",
+    "--config",
+    type=click.Path(dir_okay=False),
+    default=get_default_configpath,
+    help="Specify the configuration file to use",
+)
+@click.option(
+    "-D",
+    "--dead-letter",
+    metavar="MBOX",
+    default="dead.letter",
+    type=click.Path(writable=True, dir_okay=False, resolve_path=True),
+    help="Append undeliverable mail to this file",
+)
+@click.option(
+    "--interval",
+    type=DurationParamType(),
+    default="30s",
+    show_default=True,
+    help="How often to check the spool for new mail",
+)
+@click.option(
+    "--max-age",
+    type=DurationParamType(),
+    default="5d",
+    show_default=True,
+    help="Give up on delivering mail after this long",
+)
+@click.option(
+    "--min-retry-delay",
+    type=DurationParamType(),
+    default="1m",
+    show_default=True,
+    help="Wait this long before first retrying a failed delivery",
+)
+@click.option(
+    "--max-retry-delay",
+    type=DurationParamType(),
+    default="1h",
+    show_default=True,
+    help="Wait no more than this long between retries",
+)
+@click.option(
+    "--digest-dir",
+    metavar="DIR",
+    type=click.Path(file_okay=False, resolve_path=True),
+    help="Send digests stored in this directory once they're due",
+)
+@click.option(
+    "--digest-size",
+    type=SizeParamType(),
+    default="5M",
+    show_default=True,
+    metavar="SIZE",
+    help="Send a digest early once its reports total this many bytes",
+)
+@click.option(
+    "--digest-window",
+    type=DurationParamType(),
+    default="10m",
+    show_default=True,
+    metavar="DURATION",
+    help="Send a digest this long after its first report",
+)
+@click.option(
+    "--once",
+    is_flag=True,
+    help="Make a single delivery pass over the spool and exit",
+)
+@click.argument("spool_dir", type=click.Path(file_okay=False, resolve_path=True))
+def main(
+    spool_dir: str,
+    config: Path | str,
+    dead_letter: str,
+    interval: float,
+    max_age: float,
+    min_retry_delay: float,
+    max_retry_delay: float,
+    digest_dir: str | None,
+    digest_size: int,
+    digest_window: float,
+    once: bool,
+) -> None:
+    """Deliver mail spooled by `daemail --spool-dir`"""
+    logging.basicConfig(
+        format="%(asctime)s [%(levelname)-8s] %(message)s",
+        datefmt="%Y-%m-%dT%H:%M:%S%z",
+        level=logging.INFO,
+    )
+    worker = SpoolWorker(
+        spool=Spool(spool_dir),
+        mailer=TryingSender(
+            sender=from_config_file(config, fallback=False),
+            dead_letter_path=dead_letter,
+        ),
+        max_age=max_age,
+        min_delay=min_retry_delay,
+        max_delay=max_retry_delay,
+        digest_dir=digest_dir,
+        digest_window=digest_window,
+        digest_size=digest_size,
+    )
+    if once:
+        worker.drain()
+    else:
+        worker.run(interval)
+
+
+if __name__ == "__main__":
+    main()  # pragma: no cover
@@ -0,0 +1,478 @@
+"""
+Writing composed messages out without holding them in memory in full
+
+Large captured output is attached or quoted in a message as a *deferred*
+part: when the message is compiled, the part's payload is just a placeholder
+token, and the output is only encoded (and, for quotes, decoded & quoted), a
+chunk at a time, as the message is written to its destination by
+`write_message()`.  Code that needs a complete `EmailMessage` instead must
+first call `expand_deferred()`.
+"""
+
+from __future__ import annotations
+import base64
+import binascii
+from collections.abc import Callable, Iterable, Iterator
+import copy
+from email.generator import BytesGenerator
+from email.message import EmailMessage
+from email.utils import getaddresses
+import fcntl
+import re
+import time
+from typing import IO, TYPE_CHECKING
+from uuid import uuid4
+from .capture import CapturedOutput
+
+if TYPE_CHECKING:
+    import smtplib
+    from outgoing import Sender
+    from outgoing.senders.smtp import SMTPSender
+
+#: Number of bytes to base64-encode at a time; this is a multiple of 57, the
+#: number of bytes encoded on each 76-character line, so that the encoded
+#: chunks can simply be concatenated
+BASE64_CHUNK_SIZE = 57 * 1024
+
+#: Length of a line beyond which `encode_qp()` encodes it a piece at a time
+#: rather than waiting for the end of the line
+QP_CHUNK_SIZE = 64 * 1024
+
+# Placeholder payloads consist of this prefix followed by 32 hex digits.
+# Since "-" is not in the base64 alphabet, a placeholder can't be mistaken
+# for part of a real base64 payload.
+TOKEN_PREFIX = "daemail-deferred-"
+
+TOKEN_RGX = re.compile(rb"daemail-deferred-([0-9a-f]{32})(?:\r\n|\n)")
+
+#: Name of the attribute of a deferred part's `EmailMessage` that holds the
+#: function producing the part's encoded payload
+DEFERRED_ATTR = "_daemail_deferred"
+
+#: A function that yields the encoded payload of a deferred part, a piece at a
+#: time, using the given line separator
+Encoder = Callable[[bytes], Iterable[bytes]]
+
+#: Name of the attribute of an `EmailMessage` in which `write_message()`
+#: records how many bytes it wrote
+SIZE_ATTR = "_daemail_size"
+
+
+def defer_encoded(part: EmailMessage, encode: Encoder) -> None:
+    """
+    Replace the payload of ``part`` with a placeholder for the output of
+    ``encode``, which is called with the line separator to use each time the
+    message is written out and must yield the payload a piece at a time,
+    already encoded with the part's :mailheader:`Content-Transfer-Encoding`
+    """
+    token = TOKEN_PREFIX + uuid4().hex
+    part.set_payload(token + "\n")
+    setattr(part, DEFERRED_ATTR, (token.encode("ascii"), encode))
+
+
+def deferred_parts(msg: EmailMessage) -> Iterator[EmailMessage]:
+    """Yield all deferred parts of ``msg``, including in attached messages"""
+    for part in msg.walk():
+        if hasattr(part, DEFERRED_ATTR):
+            assert isinstance(part, EmailMessage)
+            yield part
+
+
+def has_deferred(msg: EmailMessage) -> bool:
+    return any(True for _ in deferred_parts(msg))
+
+
+def expand_deferred(msg: EmailMessage) -> None:
+    """Replace the placeholders in ``msg`` with the encoded output in full"""
+    for part in deferred_parts(msg):
+        _, encode = getattr(part, DEFERRED_ATTR)
+        # 8bit payloads are stored surrogate-escaped, as `set_content()` does
+        part.set_payload(
+            "".join(b.decode("ascii", "surrogateescape") for b in encode(b"\n"))
+        )
+        delattr(part, DEFERRED_ATTR)
+
+
+def encode_blob(blob: CapturedOutput, linesep: bytes = b"\n") -> Iterator[bytes]:
+    """Base64-encode ``blob`` a chunk at a time, wrapping lines with ``linesep``"""
+    for buf in blob.buffers(BASE64_CHUNK_SIZE):
+        yield _base64_lines(buf, linesep)
+
+
+def encode_base64(chunks: Iterable[bytes], linesep: bytes = b"\n") -> Iterator[bytes]:
+    """
+    Base64-encode data given as an iterable of pieces of any size, wrapping
+    lines with ``linesep``
+    """
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        if len(pending) >= BASE64_CHUNK_SIZE:
+            # Only encode whole lines' worth of data so that the encoded
+            # pieces can simply be concatenated
+            n = len(pending) - len(pending) % 57
+            yield _base64_lines(pending[:n], linesep)
+            del pending[:n]
+    if pending:
+        yield _base64_lines(pending, linesep)
+
+
+def _base64_lines(data: bytes | bytearray | memoryview, linesep: bytes) -> bytes:
+    encoded = base64.encodebytes(data)
+    if linesep != b"\n":
+        encoded = encoded.replace(b"\n", linesep)
+    return encoded
+
+
+def encode_qp(chunks: Iterable[bytes], linesep: bytes = b"\n") -> Iterator[bytes]:
+    """
+    Quoted-printable-encode LF-terminated text given as an iterable of pieces
+    of any size, a line at a time, ending lines with ``linesep``
+    """
+    pending = bytearray()
+    for chunk in chunks:
+        pending += chunk
+        if (end := pending.rfind(b"\n") + 1) > 0:
+            yield _qp_lines(binascii.b2a_qp(pending[:end], istext=True), linesep)
+            del pending[:end]
+        elif len(pending) >= QP_CHUNK_SIZE:
+            # Encode as much of the line as ends in a soft line break, and
+            # keep the data after that break for the next round
+            encoded = binascii.b2a_qp(pending, istext=True)
+            if (cut := encoded.rfind(b"=\n") + 2) > 1:
+                rest = binascii.a2b_qp(encoded[cut:])
+                yield _qp_lines(encoded[:cut], linesep)
+                del pending[: len(pending) - len(rest)]
+    if pending:
+        yield _qp_lines(binascii.b2a_qp(pending, istext=True), linesep)
+
+
+def _qp_lines(encoded: bytes, linesep: bytes) -> bytes:
+    if linesep != b"\n":
+        encoded = encoded.replace(b"\n", linesep)
+    return encoded
+
+
+def escape_from_lines(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Escape lines beginning with "``From ``" in data given as an iterable of
+    pieces by prepending "``>``", as `BytesGenerator` does for mbox files.
+    The data is assumed to start at the beginning of a line.
+    """
+    at_bol = True
+    # The start of the current line, if it could be the start of "From "
+    held = b""
+    for chunk in chunks:
+        data = held + chunk
+        held = b""
+        if not data:
+            continue
+        data = data.replace(b"\nFrom ", b"\n>From ")
+        if at_bol and data.startswith(b"From "):
+            data = b">" + data
+        start = data.rfind(b"\n") + 1
+        last = data[start:]
+        if (start or at_bol) and 0 < len(last) < 5 and b"From ".startswith(last):
+            held = last
+            data = data[:start]
+        if data:
+            at_bol = data.endswith(b"\n")
+            yield data
+    if held:
+        yield held
+
+
+def normalize_newlines(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Convert the CR LF and lone CR line endings in data given as an iterable
+    of pieces to LF
+    """
+    after_cr = False
+    for chunk in chunks:
+        if after_cr and chunk.startswith(b"\n"):
+            # The second half of a CR LF split between pieces
+            chunk = chunk[1:]
+        if chunk:
+            after_cr = chunk.endswith(b"\r")
+            yield chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+
+def write_message(
+    msg: EmailMessage,
+    write: Callable[[bytes], object],
+    linesep: str = "\n",
+    mangle_from: bool = False,
+) -> int:
+    """
+    Serialize ``msg`` using the line separator ``linesep``, passing the output
+    to ``write`` a piece at a time.  Deferred parts are encoded as they're
+    written.  If ``mangle_from`` is true, lines in text parts that begin with
+    "``From ``" are escaped by prepending "``>``", as required for mbox files.
+
+    Returns the number of bytes written, which is also recorded on ``msg``
+    for retrieval with `written_size()`.
+    """
+    encoders = {}
+    for part in deferred_parts(msg):
+        token, encode = getattr(part, DEFERRED_ATTR)
+        encoders[token] = encode
+    expander = _Expander(write, encoders, linesep.encode("ascii"), mangle_from)
+    gen = BytesGenerator(
+        expander,
+        mangle_from_=mangle_from,
+        policy=msg.policy.clone(linesep=linesep),
+    )
+    gen.flatten(msg)
+    setattr(msg, SIZE_ATTR, expander.nbytes)
+    return expander.nbytes
+
+
+def written_size(msg: EmailMessage) -> int | None:
+    """
+    Return the number of bytes written the last time ``msg`` was passed to
+    `write_message()`, or `None` if it never was (e.g., because it was sent
+    by a sender that serializes messages itself)
+    """
+    size = getattr(msg, SIZE_ATTR, None)
+    assert size is None or isinstance(size, int)
+    return size
+
+
+class _Expander:
+    """
+    A binary file-like object that passes data written to it on to
+    ``write``, replacing placeholder tokens with the output of the
+    corresponding encoders.  If ``mangle_from`` is true, the encoders' output
+    is From-mangled, as `BytesGenerator` only sees the placeholders.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[bytes], object],
+        encoders: dict[bytes, Encoder],
+        linesep: bytes,
+        mangle_from: bool = False,
+    ) -> None:
+        self._write = write
+        self.encoders = encoders
+        self.linesep = linesep
+        self.mangle_from = mangle_from
+        #: Number of bytes passed to ``write`` so far
+        self.nbytes = 0
+
+    def write(self, data: bytes) -> None:
+        if not self.encoders:
+            self._emit(data)
+            return
+        pos = 0
+        for m in TOKEN_RGX.finditer(data):
+            token = m[0].rstrip(b"\r\n")
+            if (encode := self.encoders.get(token)) is None:
+                continue
+            if m.start() > pos:
+                self._emit(data[pos : m.start()])
+            chunks = encode(self.linesep)
+            if self.mangle_from:
+                chunks = escape_from_lines(chunks)
+            for chunk in chunks:
+                self._emit(chunk)
+            pos = m.end()
+        if pos < len(data):
+            self._emit(data[pos:])
+
+    def _emit(self, data: bytes) -> None:
+        self.nbytes += len(data)
+        self._write(data)
+
+
+def write_mbox(path: str, msg: EmailMessage) -> None:
+    """
+    Append ``msg`` to the mbox at ``path`` in the same format as
+    `mailbox.mbox`, holding the same :func:`fcntl.lockf` lock that
+    `mailbox.mbox.lock()` takes while doing so
+    """
+    with open(path, "ab") as fp:
+        fcntl.lockf(fp, fcntl.LOCK_EX)
+        try:
+            append_mbox(fp, msg)
+        finally:
+            fcntl.lockf(fp, fcntl.LOCK_UN)
+
+
+def append_mbox(
+    fp: IO[bytes], msg: EmailMessage, from_line: str | None = None
+) -> tuple[int, int]:
+    """
+    Append ``msg`` to the mbox open as ``fp``, which the caller must have
+    locked, and return the offsets at which the message's entry (including
+    its "From " line) starts & ends.  If ``from_line`` is not given, the
+    message's own unixfrom line is used, if any.  If writing fails, the file
+    is truncated back to its previous length.
+    """
+    # Someone else may have appended to the file while we were waiting for
+    # the lock
+    start = fp.seek(0, 2)
+    try:
+        if from_line is None:
+            from_line = msg.get_unixfrom()
+        if from_line is None:
+            from_line = "From MAILER-DAEMON " + time.asctime(time.gmtime())
+        fp.write(from_line.encode("ascii") + b"\n")
+        last = b""
+
+        def write(data: bytes) -> None:
+            nonlocal last
+            if data:
+                fp.write(data)
+                last = data[-1:]
+
+        write_message(msg, write, mangle_from=True)
+        # Every message must end with a newline, followed by a blank line
+        # separating it from the next message
+        fp.write(b"\n\n" if last != b"\n" else b"\n")
+        fp.flush()
+    except BaseException:
+        fp.truncate(start)
+        raise
+    return (start, fp.tell())
+
+
+def smtp_send_message(client: smtplib.SMTP, msg: EmailMessage) -> None:
+    """
+    Send ``msg`` over the connected SMTP client ``client`` the way
+    `smtplib.SMTP.send_message()` does, but write the message to the
+    connection a piece at a time instead of first serializing it in full.
+    Addresses with non-ASCII characters (which would require the
+    ``SMTPUTF8`` extension) are not supported.
+    """
+    import smtplib
+
+    from_addr, to_addrs = envelope(msg)
+    client.ehlo_or_helo_if_needed()
+    code, resp = client.mail(from_addr)
+    if code != 250:
+        client.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+    refused = {}
+    for addr in to_addrs:
+        code, resp = client.rcpt(addr)
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+    if len(refused) == len(to_addrs):
+        client.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)  # type: ignore[arg-type]
+    client.putcmd("data")
+    code, resp = client.getreply()
+    if code != 354:
+        client.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    # As with `smtplib.SMTP.send_message()`, Bcc headers are used for the
+    # envelope but not transmitted.  Deleting a header from a shallow copy
+    # leaves the original message (which may yet be saved as a dead letter)
+    # untouched.
+    data = msg
+    if msg["Bcc"] is not None or msg["Resent-Bcc"] is not None:
+        data = copy.copy(msg)
+        del data["Bcc"]
+        del data["Resent-Bcc"]
+    stuffer = _DotStuffer(client.send)
+    setattr(msg, SIZE_ATTR, write_message(data, stuffer.write, linesep="\r\n"))
+    stuffer.finish()
+    code, resp = client.getreply()
+    if code != 250:
+        client.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    if refused:
+        raise smtplib.SMTPRecipientsRefused(refused)  # type: ignore[arg-type]
+
+
+def envelope(msg: EmailMessage) -> tuple[str, list[str]]:
+    """
+    Return the envelope sender & recipients for ``msg`` as determined by
+    `smtplib.SMTP.send_message()`
+    """
+    sender = msg["Sender"] or msg["From"]
+    from_addr = getaddresses([str(sender)])[0][1] if sender is not None else ""
+    fields = [str(v) for f in ("To", "Cc", "Bcc") for v in msg.get_all(f, [])]
+    return (from_addr, [addr for _, addr in getaddresses(fields)])
+
+
+class _DotStuffer:
+    """
+    Applies SMTP "dot-stuffing" to CRLF-terminated message data written
+    piece by piece, doubling any period at the start of a line
+    """
+
+    def __init__(self, send: Callable[[bytes], object]) -> None:
+        self.send = send
+        self.at_bol = True
+        self.last = b""
+
+    def write(self, data: bytes) -> None:
+        if not data:
+            return
+        data = data.replace(b"\n.", b"\n..")
+        if self.at_bol and data.startswith(b"."):
+            data = b"." + data
+        self.at_bol = data.endswith(b"\n")
+        self.last = data[-2:]
+        self.send(data)
+
+    def finish(self) -> None:
+        """Send the end-of-data marker"""
+        if self.last.endswith(b"\r\n"):
+            self.send(b".\r\n")
+        else:
+            self.send(b"\r\n.\r\n")
+
+
+def send_with(sender: Sender, msg: EmailMessage) -> None:
+    """
+    Send ``msg`` via ``sender``.  If the message has deferred parts and
+    ``sender`` is an SMTP or mbox sender, the message is streamed to the
+    server or file; otherwise, the deferred parts are expanded and the
+    message is passed to the sender as usual.
+    """
+    if has_deferred(msg):
+        from outgoing.senders.mailboxes import MboxSender
+        from outgoing.senders.smtp import SMTPSender
+
+        if isinstance(sender, MboxSender):
+            write_mbox(str(sender.path), msg)
+            return
+        elif isinstance(sender, SMTPSender) and ascii_envelope(msg):
+            with smtp_connect(sender) as client:
+                smtp_send_message(client, msg)
+            return
+        expand_deferred(msg)
+    sender.send(msg)
+
+
+def smtp_connect(sender: SMTPSender) -> smtplib.SMTP:
+    """
+    Connect & log in to the SMTP server described by ``sender``'s
+    configuration the same way that `SMTPSender.open()` does.  (The
+    connection that ``sender`` itself opens isn't exposed publicly.)
+    """
+    import smtplib
+
+    client: smtplib.SMTP
+    if sender.ssl is True:
+        client = smtplib.SMTP_SSL(sender.host, sender.port)
+    else:
+        client = smtplib.SMTP(sender.host, sender.port)
+    try:
+        if sender.ssl == "starttls":
+            client.starttls()
+        if sender.username is not None:
+            assert sender.password is not None
+            client.login(sender.username, sender.password.get_secret_value())
+    except BaseException:
+        client.close()
+        raise
+    return client
+
+
+def ascii_envelope(msg: EmailMessage) -> bool:
+    from_addr, to_addrs = envelope(msg)
+    return from_addr.isascii() and all(a.isascii() for a in to_addrs)
@@ -0,0 +1,76 @@
+from __future__ import annotations
+from collections.abc import Iterator
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from dataclasses import dataclass
+import time
+
+
+@dataclass
+class Stage:
+    """The monotonic start & end times of a stage of handling a command"""
+
+    name: str
+    start: float
+    end: float = 0.0
+    #: Number of bytes produced by the stage, if relevant
+    nbytes: int | None = None
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    def __str__(self) -> str:
+        s = f"{self.name}={self.duration:.6f}s"
+        if self.nbytes is not None:
+            s += f"/{self.nbytes}B"
+        return s
+
+
+class Timings:
+    """
+    Records how long each stage of running a command, composing its report,
+    and sending the report takes
+    """
+
+    #: Whether timings are actually being recorded.  Callers can check this
+    #: before computing values (such as byte counts) that are only needed for
+    #: the timings.
+    enabled = True
+
+    def __init__(self) -> None:
+        self.stages: list[Stage] = []
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__}: {self}>"
+
+    def __str__(self) -> str:
+        return "; ".join(map(str, self.stages))
+
+    def stage(self, name: str) -> AbstractContextManager[Stage]:
+        """
+        Return a context manager that records the time spent inside it as a
+        stage with the given name.  The `Stage` is returned by ``__enter__``
+        so that the caller can fill in a byte count.
+        """
+        return self._stage(name)
+
+    @contextmanager
+    def _stage(self, name: str) -> Iterator[Stage]:
+        st = Stage(name, time.monotonic())
+        try:
+            yield st
+        finally:
+            st.end = time.monotonic()
+            self.stages.append(st)
+
+
+class NullTimings(Timings):
+    """A `Timings` that records nothing, for use when timings are disabled"""
+
+    enabled = False
+
+    def stage(self, name: str) -> AbstractContextManager[Stage]:  # noqa: U100
+        return nullcontext(_NULL_STAGE)
+
+
+_NULL_STAGE = Stage("", 0.0)
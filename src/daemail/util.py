@@ -1,10 +1,12 @@
 from __future__ import annotations
+from codecs import getincrementaldecoder
+from collections.abc import Iterable, Iterator
 from datetime import datetime, timezone
 from email.headerregistry import Address
 from mimetypes import guess_type
 import os
 import re
-from shlex import quote
+from shlex import quote, split
 from signal import Signals
 import click
 from mailbits import parse_address
@@ -90,6 +92,111 @@ def multiline822(s: str) -> str:
     return re.sub("^", "  ", re.sub("^$", ".", s.strip("\r\n"), flags=re.M), flags=re.M)
 
 
+# The characters on which `str.splitlines()` splits:
+LINE_BREAKS = "\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+
+
+def reply_quote_chunks(chunks: Iterable[str], prefix: str = "> ") -> Iterator[str]:
+    """
+    Like `eletter.reply_quote()`, but the text is given as an iterable of
+    pieces, and the quoted text is likewise yielded in pieces, so that the full
+    text never needs to be held in memory at once.  Joining the output gives
+    the same result as calling `eletter.reply_quote()` on the joined input.
+    """
+
+    def quote(line: str) -> str:
+        if line.startswith(prefix):
+            return prefix.rstrip() + line
+        else:
+            return prefix + line
+
+    # The part of the current line that has not been output yet:
+    pending = ""
+    # Whether the start of the current line (and thus its prefix) has already
+    # been output:
+    midline = False
+    last = ""
+    for chunk in chunks:
+        if not chunk:
+            continue
+        lines = (pending + chunk).splitlines(True)
+        if lines[-1][-1] not in LINE_BREAKS or lines[-1].endswith("\r"):
+            # The last line is either incomplete or ends in a CR that may be
+            # followed by an LF in the next chunk.
+            pending = lines.pop()
+        else:
+            pending = ""
+        out = []
+        for ln in lines:
+            out.append(ln if midline else quote(ln))
+            midline = False
+        if pending and (midline or len(pending) >= len(prefix)):
+            # Output as much of the incomplete line as possible now rather than
+            # accumulating an arbitrarily long line in `pending`
+            start = pending.removesuffix("\r")
+            if start:
+                out.append(start if midline else quote(start))
+                midline = True
+                pending = pending[len(start) :]
+        if out:
+            last = "".join(out)
+            yield last
+    if pending:
+        last = pending if midline else quote(pending)
+        yield last
+    elif not last:
+        last = prefix
+        yield last
+    if not last.endswith(("\n", "\r")):
+        yield "\n"
+
+
+#: The largest number of bytes that a single character takes up in any
+#: supported encoding
+MAX_CHAR_BYTES = 4
+
+
+def decode_chunks(chunks: Iterable[bytes | memoryview], encoding: str) -> Iterator[str]:
+    """
+    Decode an iterable of pieces of encoded text one piece at a time.  Raises
+    `UnicodeDecodeError` if the text is not valid in the given encoding.
+    """
+    decoder = getincrementaldecoder(encoding)()
+    for chunk in chunks:
+        if txt := decoder.decode(chunk):
+            yield txt
+    if txt := decoder.decode(b"", final=True):
+        yield txt
+
+
+def trim_split_chars(head: bytes, tail: bytes, encoding: str) -> tuple[bytes, bytes]:
+    """
+    Given the ``head`` & ``tail`` of text in the given encoding from which the
+    middle has been cut out, remove the bytes of any characters that the cut
+    split in two: an incomplete character at the end of ``head`` and the
+    remainder of a character at the start of ``tail``.  Text that is not
+    valid in the encoding for any other reason is left alone.
+    """
+    decoder = getincrementaldecoder(encoding)()
+    try:
+        decoder.decode(head)
+    except UnicodeDecodeError:
+        pass
+    else:
+        if partial := decoder.getstate()[0]:
+            head = head[: -len(partial)]
+    for skip in range(MAX_CHAR_BYTES):
+        try:
+            # Only the first few bytes of the tail need to be decoded to tell
+            # whether it starts in the middle of a character
+            getincrementaldecoder(encoding)().decode(tail[skip : skip + 16])
+        except UnicodeDecodeError as e:
+            if e.start == 0:
+                continue
+        return (head, tail[skip:])
+    return (head, tail)
+
+
 class AddressParamType(click.ParamType):
     name = "address"
 
@@ -105,6 +212,137 @@ class AddressParamType(click.ParamType):
             self.fail(f"{value!r}: invalid address", param, ctx)
 
 
+SIZE_SUFFIXES = {"": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+
+
+def parse_size(s: str) -> int:
+    """
+    Parse a size in bytes given as an integer with an optional binary
+    multiplier suffix, e.g., ``"512"``, ``"64K"``, ``"10MiB"``, or ``"1G"``
+    """
+    m = re.fullmatch(r"\s*(\d+)\s*([kmgt]?)(?:i?b)?\s*", s, flags=re.I)
+    if not m:
+        raise ValueError(f"Invalid size: {s!r}")
+    return int(m[1]) * SIZE_SUFFIXES[m[2].lower()]
+
+
+class SizeParamType(click.ParamType):
+    name = "size"
+
+    def convert(
+        self,
+        value: str | int,
+        param: click.Parameter | None,
+        ctx: click.Context | None,
+    ) -> int:
+        if isinstance(value, int):
+            return value
+        try:
+            return parse_size(value)
+        except ValueError:
+            self.fail(f"{value!r}: invalid size", param, ctx)
+
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_duration(s: str) -> float:
+    """
+    Parse a duration given as a number of seconds or as one or more numbers
+    each followed by a unit of ``s``, ``m``, ``h``, or ``d``, e.g., ``"90"``,
+    ``"10m"``, ``"1.5h"``, or ``"1h30m"``, and return the number of seconds
+    """
+    s = s.strip().lower()
+    if re.fullmatch(r"\d+(?:\.\d+)?", s):
+        return float(s)
+    if not re.fullmatch(r"(?:\d+(?:\.\d+)?\s*[smhd]\s*)+", s):
+        raise ValueError(f"Invalid duration: {s!r}")
+    return sum(
+        float(n) * DURATION_UNITS[unit]
+        for n, unit in re.findall(r"(\d+(?:\.\d+)?)\s*([smhd])", s)
+    )
+
+
+class DurationParamType(click.ParamType):
+    """
+    A click parameter type for durations as accepted by `parse_duration()`.
+    If ``positive`` is true, a duration of zero is rejected.
+    """
+
+    name = "duration"
+
+    def __init__(self, positive: bool = False) -> None:
+        self.positive = positive
+
+    def convert(
+        self,
+        value: str | float,
+        param: click.Parameter | None,
+        ctx: click.Context | None,
+    ) -> float:
+        if isinstance(value, (int, float)):
+            secs = float(value)
+        else:
+            try:
+                secs = parse_duration(value)
+            except ValueError:
+                self.fail(f"{value!r}: invalid duration", param, ctx)
+        if secs < 0 or (self.positive and secs == 0):
+            self.fail(f"{value!r}: duration must be positive", param, ctx)
+        return secs
+
+
+def parse_signal(s: str) -> Signals:
+    """
+    Parse a signal given as a name (with or without a "SIG" prefix, in any
+    case) or number
+    """
+    if s.isdigit():
+        return Signals(int(s))
+    name = s.upper()
+    if not name.startswith("SIG"):
+        name = "SIG" + name
+    try:
+        return Signals[name]
+    except KeyError:
+        raise ValueError(f"Invalid signal: {s!r}")
+
+
+class SignalParamType(click.ParamType):
+    name = "signal"
+
+    def convert(
+        self,
+        value: str | Signals,
+        param: click.Parameter | None,
+        ctx: click.Context | None,
+    ) -> Signals:
+        if isinstance(value, Signals):
+            return value
+        try:
+            return parse_signal(value)
+        except ValueError:
+            self.fail(f"{value!r}: invalid signal", param, ctx)
+
+
+def parse_batch(s: str) -> list[list[str]]:
+    """
+    Parse the contents of a ``--batch`` file into a list of commands.  Each
+    line is split into arguments using shell-like syntax; blank lines and
+    comments beginning with ``#`` are ignored.  Raises `ValueError` on invalid
+    syntax.
+    """
+    commands = []
+    for lineno, line in enumerate(s.splitlines(), start=1):
+        try:
+            argv = split(line, comments=True)
+        except ValueError as e:
+            raise ValueError(f"line {lineno}: {e}")
+        if argv:
+            commands.append(argv)
+    return commands
+
+
 def get_mime_type(filename: str) -> str:
     """
     Like `mimetypes.guess_type()`, except that if the file is compressed, the
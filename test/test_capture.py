@@ -0,0 +1,232 @@
+from __future__ import annotations
+from collections.abc import Callable
+import gzip
+import lzma
+import pytest
+from daemail.capture import (
+    STDERR,
+    STDOUT,
+    Event,
+    EventLog,
+    SpooledOutput,
+    TruncatedOutput,
+    compress_chunks,
+    output_bytes,
+    output_chunks,
+)
+
+
+def test_spooled_output_in_memory() -> None:
+    out = SpooledOutput(1024)
+    assert not out
+    out.write(b"foo\n")
+    out.write(b"bar\n")
+    assert out
+    assert len(out) == 8
+    assert not out.rolled_over
+    assert out.getvalue() == b"foo\nbar\n"
+    out.close()
+
+
+def test_spooled_output_rolled_over() -> None:
+    out = SpooledOutput(16)
+    for i in range(10):
+        out.write(b"%d\n" % i)
+    out.write(b"x" * 20)
+    assert out.rolled_over
+    assert len(out) == 40
+    assert list(out.chunks(16)) == [
+        b"0\n1\n2\n3\n4\n5\n6\n7\n",
+        b"8\n9\nxxxxxxxxxxxx",
+        b"xxxxxxxx",
+    ]
+    # Reading does not interfere with further writes
+    out.write(b"\n")
+    assert out.getvalue() == b"0\n1\n2\n3\n4\n5\n6\n7\n8\n9\n" + b"x" * 20 + b"\n"
+    out.close()
+
+
+def test_spooled_output_zero_max_size() -> None:
+    # A max_size of 0 means "always spool to disk", not "never"
+    out = SpooledOutput(0)
+    try:
+        assert out._fp._rolled  # type: ignore[attr-defined]
+        assert out.getvalue() == b""
+        out.write(b"foo\n")
+        assert out.rolled_over
+        assert out.getvalue() == b"foo\n"
+    finally:
+        out.close()
+
+
+@pytest.mark.parametrize(
+    "chunks,head,tail,omitted",
+    [
+        ([], b"", b"", 0),
+        ([b"abc"], b"abc", b"", 0),
+        ([b"abcdef"], b"abcde", b"f", 0),
+        ([b"abcdefghij"], b"abcde", b"fghij", 0),
+        ([b"abcdefghijk"], b"abcde", b"ghijk", 1),
+        ([b"abc", b"defg", b"hij", b"klm"], b"abcde", b"ijklm", 3),
+        ([b"abcde", b"f", b"g", b"h", b"i", b"j", b"k", b"l"], b"abcde", b"hijkl", 2),
+        ([b"abcdefgh", b"ijklmnopqrstuvwxyz"], b"abcde", b"vwxyz", 16),
+        ([b"abcde", b"fghijklmnopq", b"rs"], b"abcde", b"opqrs", 9),
+    ],
+)
+def test_truncated_output(
+    chunks: list[bytes], head: bytes, tail: bytes, omitted: int
+) -> None:
+    out = TruncatedOutput(10)
+    for c in chunks:
+        out.write(c)
+    assert out.head == head
+    assert out.tail == tail
+    assert out.omitted == omitted
+    assert out.total == sum(map(len, chunks))
+    assert len(out) == len(head) + len(tail)
+    assert out.getvalue() == head + tail
+
+
+def test_truncated_output_odd_budget() -> None:
+    out = TruncatedOutput(5)
+    assert (out.head_size, out.tail_size) == (2, 3)
+    out.write(b"0123456789")
+    assert out.head == b"01"
+    assert out.tail == b"789"
+    assert out.omitted == 5
+
+
+@pytest.mark.parametrize(
+    "max_size,rolled_over", [(None, False), (0, True), (16, True), (64, False)]
+)
+def test_spooled_output_buffers(max_size: int | None, rolled_over: bool) -> None:
+    out = SpooledOutput(max_size)
+    out.write(b"0123456789" * 4)
+    assert out.rolled_over is rolled_over
+    views = []
+    for buf in out.buffers(16):
+        assert isinstance(buf, memoryview)
+        assert buf.readonly
+        views.append(bytes(buf))
+    assert views == [b"0123456789012345", b"6789012345678901", b"23456789"]
+    out.write(b"x")
+    assert out.getvalue() == b"0123456789" * 4 + b"x"
+    out.close()
+
+
+def test_spooled_output_buffers_released() -> None:
+    out = SpooledOutput(4)
+    out.write(b"abcdefghij")
+    views = list(out.buffers(4))
+    assert len(views) == 3
+    # Each view is released once iteration moves past it, so that the mapping
+    # can be closed
+    for v in views:
+        with pytest.raises(ValueError):
+            bytes(v)
+    out.close()
+
+
+def test_last_bytes() -> None:
+    spooled = SpooledOutput(4)
+    spooled.write(b"abcdefghij")
+    assert spooled.last_bytes(3) == b"hij"
+    assert spooled.last_bytes(20) == b"abcdefghij"
+    spooled.write(b"k")
+    assert spooled.getvalue() == b"abcdefghijk"
+    spooled.close()
+    truncated = TruncatedOutput(10)
+    truncated.write(b"abcdefg")
+    assert truncated.last_bytes(4) == b"defg"
+    truncated.write(b"hijklm")
+    assert truncated.last_bytes(4) == b"jklm"
+    assert truncated.last_bytes(20) == b"ijklm"
+
+
+@pytest.mark.parametrize("spooled", [False, True])
+def test_output_helpers(spooled: bool) -> None:
+    blob: bytes | SpooledOutput
+    if spooled:
+        blob = SpooledOutput(4)
+        blob.write(b"abcdefghij")
+    else:
+        blob = b"abcdefghij"
+    assert list(output_chunks(blob, 4)) == [b"abcd", b"efgh", b"ij"]
+    assert output_bytes(blob) == b"abcdefghij"
+    if isinstance(blob, SpooledOutput):
+        blob.close()
+
+
+@pytest.mark.parametrize("max_size", [0, 16])
+def test_event_log(max_size: int) -> None:
+    log = EventLog(max_size)
+    out = log.view(STDOUT)
+    err = log.view(STDERR)
+    merged = log.view(STDOUT, STDERR)
+    try:
+        out.write(b"out 1\n")
+        err.write(b"err 1\n")
+        out.write(b"out 2\n" * 3)
+        events = list(log.events())
+        assert [(ev.stream, ev.data) for ev in events] == [
+            (STDOUT, b"out 1\n"),
+            (STDERR, b"err 1\n"),
+            (STDOUT, b"out 2\n" * 3),
+        ]
+        offsets = [ev.offset for ev in events]
+        assert offsets == sorted(offsets)
+        assert offsets[0] >= 0
+        assert out.getvalue() == b"out 1\n" + b"out 2\n" * 3
+        assert err.getvalue() == b"err 1\n"
+        assert merged.getvalue() == b"out 1\nerr 1\n" + b"out 2\n" * 3
+        assert (len(out), len(err), len(merged)) == (24, 6, 30)
+        assert list(out.chunks(10)) == [
+            b"out 1\n",
+            b"out 2\nout ",
+            b"2\nout 2\n",
+        ]
+        assert [ev.data for ev in err.events()] == [b"err 1\n"]
+        assert out.last_bytes(8) == b"2\nout 2\n"
+        assert merged.last_bytes(13) == b"\nout 2\nout 2\n"
+        assert err.last_bytes(100) == b"err 1\n"
+    finally:
+        merged.close()
+        out.close()
+        err.close()
+
+
+def test_event_log_interleaved_reads() -> None:
+    # Iterating over two views at once doesn't mix up their reads
+    log = EventLog(1)
+    try:
+        for i in range(100):
+            log.record(STDOUT if i % 2 else STDERR, b"%03d" % i)
+        it1 = log.events([STDOUT])
+        it2 = log.events([STDERR])
+        pairs = list(zip(it1, it2))
+        assert pairs[0] == (Event(pairs[0][0].offset, STDOUT, b"001"), pairs[0][1])
+        assert [b.data for _, b in pairs] == [b"%03d" % i for i in range(0, 100, 2)]
+    finally:
+        log.close()
+
+
+@pytest.mark.parametrize(
+    "method,decompress",
+    [
+        ("gzip", gzip.decompress),
+        ("xz", lzma.decompress),
+    ],
+)
+def test_compress_chunks(method: str, decompress: Callable[[bytes], bytes]) -> None:
+    chunks = [b"This is line %d.\n" % i for i in range(1000)]
+    compressed = b"".join(compress_chunks(chunks, method))
+    assert len(compressed) < len(b"".join(chunks))
+    assert decompress(compressed) == b"".join(chunks)
+
+
+def test_compress_chunks_zstd() -> None:
+    zstandard = pytest.importorskip("zstandard")
+    chunks = [b"This is line %d.\n" % i for i in range(1000)]
+    compressed = b"".join(compress_chunks(chunks, "zstd"))
+    dctx = zstandard.ZstdDecompressor()
+    assert dctx.decompressobj().decompress(compressed) == b"".join(chunks)
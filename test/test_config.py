@@ -1,5 +1,8 @@
+from __future__ import annotations
 import locale
 from pathlib import Path
+import signal
+import sys
 from unittest.mock import MagicMock
 from click.testing import CliRunner
 from outgoing import get_default_configpath
@@ -85,6 +88,45 @@ def test_double_dash_command(mocker: MockerFixture) -> None:
     run.assert_called_once_with(mocker.ANY, "-l", "true.log", "false")
 
 
+@pytest.mark.parametrize(
+    "filename,content,errmsg",
+    [
+        ("missing.toml", None, "could not read configuration"),
+        ("bad.toml", "[outgoing\n", "invalid configuration"),
+        ("bad.json", '{"outgoing": ', "invalid configuration"),
+        ("empty.toml", '[other]\nmethod = "null"\n', "no outgoing configuration"),
+        ("config.yaml", "outgoing:\n  method: null\n", "unsupported"),
+    ],
+)
+def test_bad_config(
+    capture_cfg: MagicMock,
+    tmp_path: Path,
+    filename: str,
+    content: str | None,
+    errmsg: str,
+) -> None:
+    if sys.version_info < (3, 11) and filename == "bad.toml":
+        pytest.skip("TOML syntax is only checked up front on Python 3.11+")
+    path = tmp_path / filename
+    if content is not None:
+        path.write_text(content)
+    r = CliRunner().invoke(
+        main, ["--foreground", "-t", "null@test.test", "-c", str(path), "true"]
+    )
+    assert r.exit_code != 0
+    assert errmsg in r.output
+    assert not capture_cfg.called
+
+
+def test_missing_default_config(capture_cfg: MagicMock) -> None:
+    get_default_configpath().unlink()
+    r = CliRunner().invoke(main, ["--foreground", "-t", "null@test.test", "true"])
+    assert r.exit_code != 0
+    assert "could not read configuration" in r.output
+    assert str(get_default_configpath()) in r.output
+    assert not capture_cfg.called
+
+
 def test_bad_encoding(capture_cfg: MagicMock) -> None:
     r = CliRunner().invoke(
         main,
@@ -335,3 +377,337 @@ def test_bad_from_addr(capture_cfg: MagicMock, from_addr: str) -> None:
     assert r.exit_code != 0
     assert f"{from_addr!r}: invalid address" in r.output
     assert not capture_cfg.called
+
+
+def test_spool_size(capture_cfg: MagicMock) -> None:
+    r = CliRunner().invoke(
+        main,
+        [
+            "--foreground",
+            "-t",
+            "null@test.test",
+            "--spool-size",
+            "64M",
+            "true",
+        ],
+    )
+    assert r.exit_code == 0, r.output
+    assert capture_cfg.call_count == 1
+    runner = capture_cfg.call_args[1]["runner"]
+    assert runner.spool_size == 64 << 20
+
+
+def test_zero_spool_size(capture_cfg: MagicMock) -> None:
+    r = CliRunner().invoke(
+        main,
+        ["--foreground", "-t", "null@test.test", "--spool-size", "0", "true"],
+    )
+    assert r.exit_code == 0, r.output
+    runner = capture_cfg.call_args[1]["runner"]
+    assert runner.spool_size == 0
+    out = runner.new_output()
+    try:
+        out.write(b"x")
+        assert out.rolled_over
+    finally:
+        out.close()
+
+
+def test_bad_spool_size(capture_cfg: MagicMock) -> None:
+    r = CliRunner().invoke(
+        main,
+        [
+            "--foreground",
+            "-t",
+            "null@test.test",
+            "--spool-size",
+            "lots",
+            "true",
+        ],
+    )
+    assert r.exit_code != 0
+    assert "'lots': invalid size" in r.output
+    assert not capture_cfg.called
+
+
+def test_spool_dir(capture_cfg: MagicMock, tmp_path: Path) -> None:
+    r = CliRunner().invoke(
+        main,
+        [
+            "--foreground",
+            "-t",
+            "null@test.test",
+            "--spool-dir",
+            str(tmp_path / "spool"),
+            "true",
+        ],
+    )
+    assert r.exit_code == 0, r.output
+    assert capture_cfg.call_count == 1
+    mailer = capture_cfg.call_args[1]["mailer"]
+    assert mailer.spool_dir == str(tmp_path / "spool")
+
+
+def test_relay_socket(capture_cfg: MagicMock, tmp_path: Path) -> None:
+    r = CliRunner().invoke(
+        main,
+        [
+            "--foreground",
+            "-t",
+            "null@test.test",
+            "--relay-socket",
+            str(tmp_path / "relay.sock"),
+            "true",
+        ],
+    )
+    assert r.exit_code == 0, r.output
+    assert capture_cfg.call_count == 1
+    mailer = capture_cfg.call_args[1]["mailer"]
+    assert mailer.relay_socket == str(tmp_path / "relay.sock")
+
+
+def test_digest(capture_cfg: MagicMock, tmp_path: Path) -> None:
+    r = CliRunner().invoke(
+        main,
+        [
+            "--foreground",
+            "-t",
+            "null@test.test",
+            "--digest",
+            "nightly",
+            "--digest-dir",
+            str(tmp_path / "digests"),
+            "--digest-window=1h",
+            "--digest-size=64K",
+            "true",
+        ],
+    )
+    assert r.exit_code == 0, r.output
+    assert capture_cfg.call_count == 1
+    digest = capture_cfg.call_args[1]["digest"]
+    assert digest.key == "nightly"
+    assert digest.digest_dir == str(tmp_path / "digests")
+    assert digest.window == 3600
+    assert digest.max_size == 65536
+
+
+def test_no_digest(capture_cfg: MagicMock) -> None:
+    r = CliRunner().invoke(main, ["--foreground", "-t", "null@test.test", "true"])
+    assert r.exit_code == 0, r.output
+    assert capture_cfg.call_count == 1
+    assert capture_cfg.call_args[1]["digest"] is None
+
+
+@pytest.mark.parametrize("key", ["", "../etc", "a/b", ".hidden"])
+def test_bad_digest_key(capture_cfg: MagicMock, key: str) -> None:
+    r = CliRunner().invoke(
+        main,
+        ["--foreground", "-t", "null@test.test", "--digest", key, "true"],
+    )
+    assert r.exit_code != 0
+    assert "digest keys must consist of" in r.output
+    assert not capture_cfg.called
+
+
+def test_batch_with_command(capture_cfg: MagicMock, tmp_path: Path) -> None:
+    (tmp_path / "jobs.txt").write_text("true\n")
+    r = CliRunner().invoke(
+        main,
+        [
+            "--foreground",
+            "-t",
+            "null@test.test",
+            "--batch",
+            str(tmp_path / "jobs.txt"),
+            "true",
+        ],
+    )
+    assert r.exit_code != 0
+    assert "COMMAND cannot be given with --batch" in r.output
+    assert not capture_cfg.called
+
+
+@pytest.mark.parametrize(
+    "content,errmsg",
+    [
+        ("", "no commands in file"),
+        ("# Nothing here\n\n", "no commands in file"),
+        ("true\necho 'unclosed\n", "line 2: No closing quotation"),
+    ],
+)
+def test_bad_batch(
+    capture_cfg: MagicMock, tmp_path: Path, content: str, errmsg: str
+) -> None:
+    (tmp_path / "jobs.txt").write_text(content)
+    r = CliRunner().invoke(
+        main,
+        [
+            "--foreground",
+            "-t",
+            "null@test.test",
+            "--batch",
+            str(tmp_path / "jobs.txt"),
+        ],
+    )
+    assert r.exit_code != 0
+    assert errmsg in r.output
+    assert not capture_cfg.called
+
+
+@pytest.mark.parametrize("opts", [[], ["--combine"], ["--jobs", "4"]])
+def test_batch_options_without_batch(capture_cfg: MagicMock, opts: list[str]) -> None:
+    r = CliRunner().invoke(main, ["--foreground", "-t", "null@test.test", *opts])
+    assert r.exit_code != 0
+    assert not capture_cfg.called
+    if not opts:
+        assert "Missing argument 'COMMAND'" in r.output
+
+
+@pytest.mark.parametrize("opts,rusage", [([], False), (["--rusage"], True)])
+def test_rusage(capture_cfg: MagicMock, opts: list[str], rusage: bool) -> None:
+    r = CliRunner().invoke(
+        main, ["--foreground", "-t", "null@test.test", *opts, "true"]
+    )
+    assert r.exit_code == 0, r.output
+    assert capture_cfg.call_count == 1
+    assert capture_cfg.call_args[1]["runner"].rusage is rusage
+
+
+def test_timeout(capture_cfg: MagicMock) -> None:
+    r = CliRunner().invoke(
+        main,
+        [
+            "--foreground",
+            "-t",
+            "null@test.test",
+            "--timeout",
+            "1h30m",
+            "--timeout-signal",
+            "INT",
+            "--kill-after=1m",
+            "true",
+        ],
+    )
+    assert r.exit_code == 0, r.output
+    assert capture_cfg.call_count == 1
+    runner = capture_cfg.call_args[1]["runner"]
+    assert runner.timeout == 5400
+    assert runner.timeout_signal is signal.SIGINT
+    assert runner.kill_after == 60
+
+
+def test_timeout_defaults(capture_cfg: MagicMock) -> None:
+    r = CliRunner().invoke(main, ["--foreground", "-t", "null@test.test", "true"])
+    assert r.exit_code == 0, r.output
+    assert capture_cfg.call_count == 1
+    runner = capture_cfg.call_args[1]["runner"]
+    assert runner.timeout is None
+    assert runner.timeout_signal is signal.SIGTERM
+    assert runner.kill_after == 10
+
+
+def test_bad_timeout_signal(capture_cfg: MagicMock) -> None:
+    r = CliRunner().invoke(
+        main,
+        [
+            "--foreground",
+            "-t",
+            "null@test.test",
+            "--timeout=10s",
+            "--timeout-signal=SIGFOO",
+            "true",
+        ],
+    )
+    assert r.exit_code != 0
+    assert "'SIGFOO': invalid signal" in r.output
+    assert not capture_cfg.called
+
+
+@pytest.mark.parametrize("interval", ["0", "0s"])
+def test_bad_heartbeat(capture_cfg: MagicMock, interval: str) -> None:
+    r = CliRunner().invoke(
+        main,
+        ["--foreground", "-t", "null@test.test", "--heartbeat", interval, "true"],
+    )
+    assert r.exit_code != 0
+    assert f"{interval!r}: duration must be positive" in r.output
+    assert not capture_cfg.called
+
+
+def test_max_output(capture_cfg: MagicMock) -> None:
+    r = CliRunner().invoke(
+        main,
+        [
+            "--foreground",
+            "-t",
+            "null@test.test",
+            "--max-output=1M",
+            "true",
+        ],
+    )
+    assert r.exit_code == 0, r.output
+    assert capture_cfg.call_count == 1
+    runner = capture_cfg.call_args[1]["runner"]
+    assert runner.max_output == 1 << 20
+    assert runner.spool_size is None
+
+
+def test_compress(capture_cfg: MagicMock) -> None:
+    r = CliRunner().invoke(
+        main,
+        [
+            "--foreground",
+            "-t",
+            "null@test.test",
+            "--stdout-filename=report.csv",
+            "--compress=xz",
+            "--compress-threshold=64K",
+            "true",
+        ],
+    )
+    assert r.exit_code == 0, r.output
+    assert capture_cfg.call_count == 1
+    reporter = capture_cfg.call_args[1]["reporter"]
+    assert reporter.compress == "xz"
+    assert reporter.compress_threshold == 65536
+
+
+def test_compress_defaults(capture_cfg: MagicMock) -> None:
+    r = CliRunner().invoke(
+        main,
+        ["--foreground", "-t", "null@test.test", "true"],
+    )
+    assert r.exit_code == 0, r.output
+    assert capture_cfg.call_count == 1
+    reporter = capture_cfg.call_args[1]["reporter"]
+    assert reporter.compress is None
+    assert reporter.compress_threshold == 1 << 20
+
+
+def test_compress_without_attachment(capture_cfg: MagicMock) -> None:
+    r = CliRunner().invoke(
+        main,
+        ["--foreground", "-t", "null@test.test", "--compress=gzip", "true"],
+    )
+    assert r.exit_code != 0
+    assert "--compress requires --mime-type or --stdout-filename" in r.output
+    assert not capture_cfg.called
+
+
+def test_compress_zstd_unavailable(
+    mocker: MockerFixture, capture_cfg: MagicMock
+) -> None:
+    mocker.patch.dict("sys.modules", {"compression": None, "zstandard": None})
+    r = CliRunner().invoke(
+        main,
+        [
+            "--foreground",
+            "-t",
+            "null@test.test",
+            "--compress=zstd",
+            "true",
+        ],
+    )
+    assert r.exit_code != 0
+    assert "zstd compression requires the zstandard package" in r.output
+    assert not capture_cfg.called
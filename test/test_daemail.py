@@ -2,19 +2,25 @@ from __future__ import annotations
 from datetime import datetime, timedelta, timezone
 import email
 from email import policy
+import json
 import mailbox
 import os
 from pathlib import Path
+import re
+import shlex
 import subprocess
+import sys
 from traceback import format_exception
 from types import SimpleNamespace
 from typing import Any
+from unittest.mock import MagicMock
 from click.testing import CliRunner, Result
 from mailbits import email2dict
 import pytest
 from pytest_mock import MockerFixture
-from daemail.__main__ import main
+from daemail.__main__ import Daemail, main
 from daemail.message import USER_AGENT
+from daemail.util import show_argv
 
 w4 = timezone(timedelta(hours=-4))
 
@@ -576,7 +582,11 @@ def test_sendmail_failure(mocker: MockerFixture) -> None:
             "epilogue": None,
         }
         assert dtnow_mock.call_count == 2
-        assert sorted(os.listdir()) == ["config.toml", "dead.letter"]
+        assert sorted(os.listdir()) == [
+            "config.toml",
+            "dead.letter",
+            "dead.letter.idx",
+        ]
         mbox = mailbox.mbox("dead.letter")
         mbox.lock()
         dead_msgs = list(mbox)
@@ -584,6 +594,7 @@ def test_sendmail_failure(mocker: MockerFixture) -> None:
     assert len(dead_msgs) == 1
     msgdict = email2dict(dead_msgs[0])
     msgdict["unixfrom"] = None
+    assert msgdict["headers"].pop("message-id")
     assert msgdict == {
         "unixfrom": None,
         "headers": {
@@ -592,28 +603,55 @@ def test_sendmail_failure(mocker: MockerFixture) -> None:
             "subject": "[DONE] not-a-real-command -x foo.txt",
             "user-agent": [USER_AGENT],
             "content-type": {
-                "content_type": "text/plain",
+                "content_type": "multipart/mixed",
                 "params": {},
             },
         },
         "preamble": None,
-        "content": (
-            "Start Time:  2020-03-11 16:22:32.010203-04:00\n"
-            "End Time:    2020-03-11 16:24:19.102030-04:00\n"
-            "Exit Status: 0\n"
-            "\n"
-            "Output:\n"
-            "> This is the output.\n"
-            "\n"
-            "Additionally, an error occurred while trying to send this e-mail:\n"
-            "\n"
-            "Command: ['sendmail', '-i', '-t']\n"
-            "Exit Status: 1\n"
-            "\n"
-            "Output:\n"
-            "> All the foos are bar when they should be baz.\n"
-        ),
-        "epilogue": None,
+        "content": [
+            {
+                "unixfrom": None,
+                "headers": {
+                    "content-type": {
+                        "content_type": "text/plain",
+                        "params": {},
+                    },
+                },
+                "preamble": None,
+                "content": (
+                    "Start Time:  2020-03-11 16:22:32.010203-04:00\n"
+                    "End Time:    2020-03-11 16:24:19.102030-04:00\n"
+                    "Exit Status: 0\n"
+                    "\n"
+                    "Output:\n"
+                    "> This is the output.\n"
+                ),
+                "epilogue": None,
+            },
+            {
+                "unixfrom": None,
+                "headers": {
+                    "content-type": {
+                        "content_type": "text/plain",
+                        "params": {},
+                    },
+                    "x-daemail-send-error": ["CalledProcessError"],
+                },
+                "preamble": None,
+                "content": (
+                    "Additionally, an error occurred while trying to send"
+                    " this e-mail:\n"
+                    "\n"
+                    "Command: ['sendmail', '-i', '-t']\n"
+                    "Exit Status: 1\n"
+                    "\n"
+                    "Output:\n"
+                    "> All the foos are bar when they should be baz.\n"
+                ),
+                "epilogue": None,
+            },
+        ],
+        "epilogue": "",
     }
 
 
@@ -621,3 +659,375 @@ def test_sendmail_failure(mocker: MockerFixture) -> None:
 # daemail printf '%s\n' $'foo\xe2bar'
 # daemail printf '%s\n' $'go\xf0\x9f\x90\x90at'
 # daemail printf '%s\n' $'baaaad \xed\xa0\xbd\xed\xb0\x90 goat'
+
+
+def test_daemail_spooled(mocker: MockerFixture) -> None:
+    daemon_mock = mocker.patch("daemon.DaemonContext", autospec=True)
+    dtnow_mock = mocker.patch(
+        "daemail.util.dtnow",
+        side_effect=[MOCK_START, MOCK_END],
+    )
+    argv = [
+        sys.executable,
+        "-c",
+        "import sys; sys.stdout.write('This is the output.\\n' * 3)",
+    ]
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        Path("config.toml").write_text(
+            "[outgoing]\n" 'method = "mbox"\n' 'path = "daemail.mbox"\n'
+        )
+        r = runner.invoke(
+            main,
+            [
+                "-t",
+                "null@test.test",
+                "--spool-size",
+                "16",
+                "--config",
+                "config.toml",
+                *argv,
+            ],
+        )
+        assert r.exit_code == 0, show_result(r)
+        assert daemon_mock.call_count == 1
+        assert dtnow_mock.call_count == 2
+        mbox = mailbox.mbox("daemail.mbox")
+        mbox.lock()
+        msgs = list(mbox)
+        mbox.close()
+    assert len(msgs) == 1
+    msgdict = email2dict(msgs[0])
+    assert msgdict["content"] == (
+        "Start Time:  2020-03-11 16:22:32.010203-04:00\n"
+        "End Time:    2020-03-11 16:24:19.102030-04:00\n"
+        "Exit Status: 0\n"
+        "\n"
+        "Output:\n"
+        "> This is the output.\n"
+        "> This is the output.\n"
+        "> This is the output.\n"
+    )
+
+
+def write_batch(path: str) -> None:
+    py = shlex.quote(sys.executable)
+    Path(path).write_text(
+        "# Comments and blank lines are ignored\n"
+        "\n"
+        f"{py} -c 'print(\"one\")'\n"
+        f"{py} -c 'import sys; sys.exit(\"two\")'\n"
+        f"{py} -c 'print(\"three\")'\n"
+    )
+
+
+def test_daemail_batch(mocker: MockerFixture) -> None:
+    daemon_mock = mocker.patch("daemon.DaemonContext", autospec=True)
+    mocker.patch("daemail.util.dtnow", return_value=MOCK_START)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        Path("config.toml").write_text(
+            "[outgoing]\n" 'method = "mbox"\n' 'path = "daemail.mbox"\n'
+        )
+        write_batch("jobs.txt")
+        r = runner.invoke(
+            main,
+            [
+                "-t",
+                "null@test.test",
+                "--config",
+                "config.toml",
+                "--batch",
+                "jobs.txt",
+                "--jobs",
+                "2",
+            ],
+        )
+        assert r.exit_code == 0, show_result(r)
+        assert daemon_mock.call_count == 1
+        mbox = mailbox.mbox("daemail.mbox")
+        mbox.lock()
+        msgs = list(mbox)
+        mbox.close()
+    subjects = sorted(str(m["Subject"]) for m in msgs)
+    assert [s.split()[0] for s in subjects] == ["[DONE]", "[DONE]", "[FAILED]"]
+    outputs = sorted(email2dict(m)["content"].split("Output:\n")[1] for m in msgs)
+    assert outputs == ["> one\n", "> three\n", "> two\n"]
+
+
+def test_daemail_batch_combined(mocker: MockerFixture) -> None:
+    mocker.patch("daemail.util.dtnow", return_value=MOCK_START)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        Path("config.toml").write_text(
+            "[outgoing]\n" 'method = "mbox"\n' 'path = "daemail.mbox"\n'
+        )
+        write_batch("jobs.txt")
+        r = runner.invoke(
+            main,
+            [
+                "--foreground",
+                "-t",
+                "null@test.test",
+                "--config",
+                "config.toml",
+                "--batch",
+                "jobs.txt",
+                "-j3",
+                "--combine",
+            ],
+        )
+        assert r.exit_code == 0, show_result(r)
+        with open("daemail.mbox", "rb") as fp:
+            # Strip the mbox "From " line:
+            fp.readline()
+            msg = email.message_from_binary_file(
+                fp,
+                # <https://github.com/python/typeshed/issues/13273>
+                policy=policy.default,  # type: ignore[arg-type]
+            )
+    assert msg["Subject"] == "[BATCH] jobs.txt: 3 reports (1 failed)"
+    summary, *reports = msg.iter_parts()
+    py = show_argv(sys.executable)
+    # Reports are listed in the order of the commands in the batch file:
+    assert summary.get_content() == (
+        f"- [DONE] {py} -c 'print(\"one\")'\n"
+        f"- [FAILED] {py} -c 'import sys; sys.exit(\"two\")'\n"
+        f"- [DONE] {py} -c 'print(\"three\")'\n"
+    )
+    assert len(reports) == 3
+
+
+@pytest.mark.parametrize("combine_as", [None, "jobs.txt"])
+def test_run_batch_job_error(mocker: MockerFixture, combine_as: str | None) -> None:
+    jobs: list[MagicMock] = []
+
+    def run_job(argv: list[str]) -> MagicMock:
+        if argv == ["two"]:
+            raise RuntimeError("Job failed")
+        job = MagicMock(msg=None)
+        job.__enter__.return_value = job
+        jobs.append(job)
+        return job
+
+    dispatch = mocker.patch.object(Daemail, "dispatch")
+    daemail = Daemail(
+        runner=MagicMock(heartbeat=None), reporter=MagicMock(), mailer=MagicMock()
+    )
+    mocker.patch.object(daemail, "run_job", side_effect=run_job)
+    with pytest.raises(RuntimeError, match="Job failed"):
+        daemail.run_batch([["one"], ["two"], ["three"]], 2, combine_as)
+    # The other jobs are still closed (and, if not combining, reported on):
+    assert len(jobs) == 2
+    for job in jobs:
+        job.__exit__.assert_called_once()
+    assert dispatch.call_count == (2 if combine_as is None else 0)
+
+
+def test_daemail_heartbeat(mocker: MockerFixture) -> None:
+    mocker.patch("daemail.util.dtnow", return_value=MOCK_START)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        Path("config.toml").write_text(
+            "[outgoing]\n" 'method = "mbox"\n' 'path = "daemail.mbox"\n'
+        )
+        r = runner.invoke(
+            main,
+            [
+                "--foreground",
+                "-t",
+                "null@test.test",
+                "--config",
+                "config.toml",
+                "--heartbeat",
+                "0.2",
+                sys.executable,
+                "-c",
+                "import time; print('working', flush=True); time.sleep(1)",
+            ],
+        )
+        assert r.exit_code == 0, show_result(r)
+        mbox = mailbox.mbox("daemail.mbox")
+        mbox.lock()
+        msgs = list(mbox)
+        mbox.close()
+    subjects = [str(m["Subject"]).split()[0] for m in msgs]
+    assert len(subjects) >= 2
+    assert set(subjects[:-1]) == {"[RUNNING]"}
+    assert subjects[-1] == "[DONE]"
+    assert "Recent Output:\n> working\n" in email2dict(msgs[-2])["content"]
+
+
+def test_daemail_tee(mocker: MockerFixture) -> None:
+    mocker.patch("daemail.util.dtnow", return_value=MOCK_START)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        Path("config.toml").write_text(
+            "[outgoing]\n" 'method = "mbox"\n' 'path = "daemail.mbox"\n'
+        )
+        r = runner.invoke(
+            main,
+            [
+                "--foreground",
+                "-t",
+                "null@test.test",
+                "--config",
+                "config.toml",
+                "--tee",
+                "live.log",
+                sys.executable,
+                "-c",
+                "print('live output')",
+            ],
+        )
+        assert r.exit_code == 0, show_result(r)
+        assert Path("live.log").read_text() == "live output\n"
+        mbox = mailbox.mbox("daemail.mbox")
+        mbox.lock()
+        (msg,) = list(mbox)
+        mbox.close()
+    assert "> live output\n" in email2dict(msg)["content"]
+
+
+def test_daemail_metrics(mocker: MockerFixture) -> None:
+    mocker.patch("daemail.util.dtnow", return_value=MOCK_START)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        Path("config.toml").write_text(
+            "[outgoing]\n" 'method = "mbox"\n' 'path = "daemail.mbox"\n'
+        )
+        write_batch("jobs.txt")
+        r = runner.invoke(
+            main,
+            [
+                "--foreground",
+                "-t",
+                "null@test.test",
+                "--config",
+                "config.toml",
+                "--failure-only",
+                "--metrics",
+                "metrics.ndjson",
+                "--batch",
+                "jobs.txt",
+            ],
+        )
+        assert r.exit_code == 0, show_result(r)
+        with open("metrics.ndjson", encoding="utf-8") as fp:
+            records = [json.loads(line) for line in fp]
+    assert len(records) == 3
+    records.sort(key=lambda rec: rec["argv"][-1])
+    assert [rec["rc"] for rec in records] == [1, 0, 0]
+    assert [rec["send_outcome"] for rec in records] == ["sent", "skipped", "skipped"]
+    assert [rec["stdout_bytes"] for rec in records] == [4, 4, 6]
+    for rec in records:
+        assert rec["start"] == MOCK_START.isoformat()
+        assert rec["duration"] == 0
+        assert rec["compose_time"] >= 0
+    assert records[0]["send_time"] >= 0
+    assert records[1]["send_time"] is None
+
+
+def test_daemail_debug_timings(mocker: MockerFixture) -> None:
+    mocker.patch("daemail.util.dtnow", return_value=MOCK_START)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        Path("config.toml").write_text(
+            "[outgoing]\n" 'method = "mbox"\n' 'path = "daemail.mbox"\n'
+        )
+        r = runner.invoke(
+            main,
+            [
+                "--foreground",
+                "-t",
+                "null@test.test",
+                "--config",
+                "config.toml",
+                "--debug-timings",
+                sys.executable,
+                "-c",
+                "print('Hello')",
+            ],
+        )
+        assert r.exit_code == 0, show_result(r)
+        mbox = mailbox.mbox("daemail.mbox")
+        mbox.lock()
+        (msg,) = list(mbox)
+        mbox.close()
+        log = Path("daemail.log").read_text()
+    header = msg["X-Daemail-Timings"]
+    assert re.fullmatch(
+        r"run=\d+\.\d{6}s/6B; report=\d+\.\d{6}s; compile=\d+\.\d{6}s", header
+    )
+    m = re.search(r"^Timings: (.+)$", log, flags=re.M)
+    assert m
+    assert m[1].startswith(header + "; send=")
+    assert f"Timings: {m[1]}" in r.output
+
+
+def test_daemail_debug_timings_message_size(mocker: MockerFixture) -> None:
+    # Spooling the output to disk makes daemail write out the message itself,
+    # and so the message's size is counted as it's sent
+    mocker.patch("daemail.util.dtnow", return_value=MOCK_START)
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        Path("config.toml").write_text(
+            "[outgoing]\n" 'method = "mbox"\n' 'path = "daemail.mbox"\n'
+        )
+        r = runner.invoke(
+            main,
+            [
+                "--foreground",
+                "-t",
+                "null@test.test",
+                "--config",
+                "config.toml",
+                "--debug-timings",
+                "--mime-type",
+                "text/plain",
+                "--spool-size",
+                "0",
+                sys.executable,
+                "-c",
+                "print('Hello')",
+            ],
+        )
+        assert r.exit_code == 0, show_result(r)
+        log = Path("daemail.log").read_text()
+        mbox_size = os.path.getsize("daemail.mbox")
+    m = re.search(r"; send=\d+\.\d{6}s/(\d+)B$", log, flags=re.M)
+    assert m
+    # The mbox entry also contains the "From " line and a trailing blank line:
+    assert 0 < int(m[1]) < mbox_size
+
+
+def test_daemail_dedup_dead_letter(mocker: MockerFixture) -> None:
+    mocker.patch("daemon.DaemonContext", autospec=True)
+    mocker.patch("daemail.util.dtnow", return_value=MOCK_START)
+    runner = CliRunner()
+    argv = [sys.executable, "-c", "print('boom'); raise SystemExit(1)"]
+    opts = ["-t", "null@test.test", "--config", "config.toml", "--dedup", "dedup.json"]
+    with runner.isolated_filesystem():
+        Path("config.toml").write_text(
+            "[outgoing]\n" 'method = "mbox"\n' 'path = "daemail.mbox"\n'
+        )
+        send_mock = mocker.patch(
+            "daemail.senders.send_with", side_effect=OSError("Connection refused")
+        )
+        r = runner.invoke(main, [*opts, *argv])
+        mocker.stop(send_mock)
+        assert r.exit_code == 0, show_result(r)
+        assert os.path.exists("dead.letter")
+        # The undelivered run wasn't recorded, so this report isn't shrunk:
+        assert not os.path.exists("dedup.json")
+        r = runner.invoke(main, [*opts, *argv])
+        assert r.exit_code == 0, show_result(r)
+        r = runner.invoke(main, [*opts, *argv])
+        assert r.exit_code == 0, show_result(r)
+        mbox = mailbox.mbox("daemail.mbox")
+        mbox.lock()
+        msgs = list(mbox)
+        mbox.close()
+    assert len(msgs) == 2
+    assert "> boom\n" in email2dict(msgs[0])["content"]
+    assert "Output identical to the previous run" in email2dict(msgs[1])["content"]
@@ -0,0 +1,261 @@
+from __future__ import annotations
+from email.message import EmailMessage
+import json
+import mailbox
+from pathlib import Path
+from traceback import format_exception
+from click.testing import CliRunner, Result
+import pytest
+from daemail import deadletter
+from daemail.deadletter import (
+    DeadLetterBox,
+    command_of,
+    parse_from_time,
+    strip_error_parts,
+)
+from daemail.replay import main, replay
+from daemail.senders import TryingSender
+
+
+def show_result(r: Result) -> str:
+    if r.exception is not None:
+        assert isinstance(r.exc_info, tuple)
+        return "".join(format_exception(*r.exc_info))
+    else:
+        return r.output
+
+
+def mkmsg(subject: str) -> EmailMessage:
+    msg = EmailMessage()
+    msg["Subject"] = subject
+    msg["From"] = "me@example.nil"
+    msg["To"] = "null@test.test"
+    msg.set_content("This is the output.\nFrom the top.\n")
+    return msg
+
+
+def save_failed(path: Path, subject: str) -> None:
+    mailer = TryingSender(sender=None, dead_letter_path=str(path))
+    mailer.save_dead_letter(mkmsg(subject), OSError("Connection refused"))
+
+
+def subjects(path: Path) -> list[str]:
+    mbox = mailbox.mbox(path)
+    try:
+        return [m["Subject"] for m in mbox]
+    finally:
+        mbox.close()
+
+
+def test_add(tmp_path: Path) -> None:
+    box = DeadLetterBox(str(tmp_path / "dead.letter"))
+    e1 = box.add(mkmsg("[FAILED] foo --bar"))
+    e2 = box.add(mkmsg("Custom subject"))
+    assert e1.offset == 0
+    assert e2.offset == e1.end == (tmp_path / "dead.letter").stat().st_size - e2.length
+    assert e1.command == "foo --bar"
+    assert e2.command is None
+    assert e1.message_id is not None and e1.message_id.startswith("<")
+    assert e1.message_id != e2.message_id
+    assert box.entries() == [e1, e2]
+    lines = (tmp_path / "dead.letter.idx").read_text().splitlines()
+    assert [json.loads(ln)["offset"] for ln in lines] == [e1.offset, e2.offset]
+    msg = box.read(e2)
+    assert msg["Subject"] == "Custom subject"
+    assert msg["Message-ID"] == e2.message_id
+    assert msg.get_content() == "This is the output.\n>From the top.\n"
+    assert subjects(tmp_path / "dead.letter") == [
+        "[FAILED] foo --bar",
+        "Custom subject",
+    ]
+
+
+def test_mark_delivered(tmp_path: Path) -> None:
+    box = DeadLetterBox(str(tmp_path / "dead.letter"))
+    e1 = box.add(mkmsg("[FAILED] foo"))
+    e2 = box.add(mkmsg("[FAILED] bar"))
+    box.mark_delivered(e1)
+    assert e1.delivered
+    assert DeadLetterBox(box.path).undelivered() == [e2]
+    assert [e.delivered for e in box.entries()] == [True, False]
+
+
+def test_rebuild_legacy(tmp_path: Path) -> None:
+    path = tmp_path / "dead.letter"
+    mbox = mailbox.mbox(path)
+    mbox.add(mkmsg("[DONE] foo"))
+    mbox.add(mkmsg("[ERROR] bar baz"))
+    mbox.close()
+    box = DeadLetterBox(str(path))
+    entries = box.entries()
+    assert [e.command for e in entries] == ["foo", "bar baz"]
+    assert all(e.timestamp is not None for e in entries)
+    assert [box.read(e)["Subject"] for e in entries] == [
+        "[DONE] foo",
+        "[ERROR] bar baz",
+    ]
+    assert (tmp_path / "dead.letter.idx").exists()
+    e3 = box.add(mkmsg("[DONE] quux"))
+    assert box.entries() == [*entries, e3]
+    assert subjects(path) == ["[DONE] foo", "[ERROR] bar baz", "[DONE] quux"]
+
+
+def test_rebuild_stale_keeps_delivered(tmp_path: Path) -> None:
+    path = tmp_path / "dead.letter"
+    box = DeadLetterBox(str(path))
+    e1 = box.add(mkmsg("[FAILED] foo"))
+    box.mark_delivered(e1)
+    # Append a message behind the index's back:
+    mbox = mailbox.mbox(path)
+    mbox.add(mkmsg("[FAILED] bar"))
+    mbox.close()
+    entries = box.entries()
+    assert [(e.command, e.delivered) for e in entries] == [
+        ("foo", True),
+        ("bar", False),
+    ]
+    assert [e.command for e in box.undelivered()] == ["bar"]
+
+
+def test_damaged_index(tmp_path: Path) -> None:
+    box = DeadLetterBox(str(tmp_path / "dead.letter"))
+    e1 = box.add(mkmsg("[FAILED] foo"))
+    with open(box.index_path, "a") as fp:
+        fp.write('{"offset": 12, "len')
+    assert box.entries() == [e1]
+
+
+def test_add_reads_only_index_tail(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(deadletter, "INDEX_BLOCK_SIZE", 16)
+    box = DeadLetterBox(str(tmp_path / "dead.letter"))
+    entries = [box.add(mkmsg(f"[FAILED] foo{i}")) for i in range(3)]
+    with open(box.index_path, "a") as fp:
+        fp.write('{"offset": 12, "len\n')
+    for e in entries:
+        box.mark_delivered(e)
+    monkeypatch.setattr(DeadLetterBox, "_load", None)
+    monkeypatch.setattr(DeadLetterBox, "_rebuild", None)
+    e4 = box.add(mkmsg("[FAILED] bar"))
+    assert e4.offset == entries[-1].end
+    lines = Path(box.index_path).read_text().splitlines()
+    assert json.loads(lines[-1]) == e4.for_json()
+
+
+def test_add_stale_index(tmp_path: Path) -> None:
+    path = tmp_path / "dead.letter"
+    box = DeadLetterBox(str(path))
+    e1 = box.add(mkmsg("[FAILED] foo"))
+    # Append a message behind the index's back:
+    mbox = mailbox.mbox(path)
+    mbox.add(mkmsg("[FAILED] bar"))
+    mbox.close()
+    e3 = box.add(mkmsg("[FAILED] baz"))
+    assert [e.command for e in box.entries()] == ["foo", "bar", "baz"]
+    assert box.entries()[0] == e1
+    assert box.entries()[2].offset == e3.offset
+
+
+def test_no_mbox(tmp_path: Path) -> None:
+    box = DeadLetterBox(str(tmp_path / "dead.letter"))
+    assert box.entries() == []
+    assert not (tmp_path / "dead.letter").exists()
+
+
+def test_strip_error_parts(tmp_path: Path) -> None:
+    path = tmp_path / "dead.letter"
+    save_failed(path, "[FAILED] foo")
+    box = DeadLetterBox(str(path))
+    (entry,) = box.entries()
+    msg = box.read(entry)
+    assert len(list(msg.iter_parts())) == 2
+    strip_error_parts(msg)
+    (part,) = msg.iter_parts()
+    assert isinstance(part, EmailMessage)
+    assert part.get_content() == "This is the output.\n>From the top.\n"
+
+
+def test_replay(tmp_path: Path) -> None:
+    path = tmp_path / "dead.letter"
+    for subject in ["[FAILED] foo", "[FAILED] bar", "[FAILED] baz"]:
+        save_failed(path, subject)
+    box = DeadLetterBox(str(path))
+    sent: list[EmailMessage] = []
+
+    def send(msg: EmailMessage) -> None:
+        if msg["Subject"] == "[FAILED] bar":
+            raise OSError("Still refusing")
+        sent.append(msg)
+
+    assert replay(box, box.undelivered(), send, workers=2) == 1
+    assert sorted(m["Subject"] for m in sent) == ["[FAILED] baz", "[FAILED] foo"]
+    assert all(len(list(m.iter_parts())) == 1 for m in sent)
+    assert [e.command for e in box.undelivered()] == ["bar"]
+
+
+def test_main(tmp_path: Path) -> None:
+    path = tmp_path / "dead.letter"
+    for subject in ["[FAILED] foo", "[FAILED] bar", "[FAILED] baz"]:
+        save_failed(path, subject)
+    config = tmp_path / "config.toml"
+    config.write_text(
+        f'[outgoing]\nmethod = "mbox"\npath = "{tmp_path / "resent.mbox"}"\n'
+    )
+    runner = CliRunner()
+    r = runner.invoke(main, ["--config", str(config), "--list", str(path)])
+    assert r.exit_code == 0, show_result(r)
+    assert [ln.split("\t")[-1] for ln in r.output.splitlines()] == [
+        "foo",
+        "bar",
+        "baz",
+    ]
+    assert not (tmp_path / "resent.mbox").exists()
+    r = runner.invoke(
+        main, ["--config", str(config), "--pool-size", "1", "--limit", "2", str(path)]
+    )
+    assert r.exit_code == 0, show_result(r)
+    assert sorted(subjects(tmp_path / "resent.mbox")) == [
+        "[FAILED] bar",
+        "[FAILED] foo",
+    ]
+    r = runner.invoke(main, ["--config", str(config), str(path)])
+    assert r.exit_code == 0, show_result(r)
+    assert sorted(subjects(tmp_path / "resent.mbox")) == [
+        "[FAILED] bar",
+        "[FAILED] baz",
+        "[FAILED] foo",
+    ]
+    assert DeadLetterBox(str(path)).undelivered() == []
+    r = runner.invoke(main, ["--config", str(config), "--pool-size", "1", str(path)])
+    assert r.exit_code == 0, show_result(r)
+    assert len(subjects(tmp_path / "resent.mbox")) == 3
+
+
+def test_main_pool_size_mbox(tmp_path: Path) -> None:
+    path = tmp_path / "dead.letter"
+    save_failed(path, "[FAILED] foo")
+    config = tmp_path / "config.toml"
+    config.write_text(
+        f'[outgoing]\nmethod = "mbox"\npath = "{tmp_path / "resent.mbox"}"\n'
+    )
+    r = CliRunner().invoke(
+        main, ["--config", str(config), "--pool-size", "2", str(path)]
+    )
+    assert r.exit_code == 2
+    assert "--pool-size must be 1 when not sending via SMTP" in r.output
+    assert not (tmp_path / "resent.mbox").exists()
+    assert len(DeadLetterBox(str(path)).undelivered()) == 1
+
+
+def test_command_of() -> None:
+    assert command_of("[DONE] foo -x 'bar baz'") == "foo -x 'bar baz'"
+    assert command_of("[DONE]") is None
+    assert command_of(None) is None
+
+
+def test_parse_from_time() -> None:
+    dt = parse_from_time(b"From MAILER-DAEMON Wed Mar 11 20:22:32 2020\n")
+    assert dt is not None
+    assert dt.isoformat() == "2020-03-11T20:22:32+00:00"
+    assert parse_from_time(b"From nobody\n") is None
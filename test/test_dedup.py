@@ -0,0 +1,96 @@
+from __future__ import annotations
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from daemail.capture import STDERR, STDOUT, SpooledOutput
+from daemail.dedup import DedupStore, RunRecord, hash_sinks, output_digest
+from daemail.runner import CommandResult
+
+w4 = timezone(timedelta(hours=-4))
+
+START = datetime(2020, 3, 10, 15, 0, 28, 123456, w4)
+
+
+def mkresult(
+    rc: int, stdout: bytes, stderr: bytes | None = None, hours: int = 0
+) -> CommandResult:
+    return CommandResult(
+        argv=["foo", "-x", "bar.txt"],
+        rc=rc,
+        start=START + timedelta(hours=hours),
+        end=START + timedelta(hours=hours, minutes=1),
+        stdout=stdout,
+        stderr=stderr,
+    )
+
+
+def test_output_digest() -> None:
+    d = output_digest(mkresult(1, b"out\n", b"err\n"))
+    assert d == output_digest(mkresult(1, b"out\n", b"err\n"))
+    assert d != output_digest(mkresult(1, b"out\nerr\n"))
+    assert d != output_digest(mkresult(1, b"err\n", b"out\n"))
+    assert output_digest(mkresult(1, b"", None)) != output_digest(mkresult(1, b"", b""))
+
+
+def test_output_digest_from_sinks() -> None:
+    # The digests computed by hash_sinks() during capture are the same as
+    # those computed from the output afterwards
+    out = SpooledOutput(None)
+    out.write(b"out\n")
+    sinks = {STDOUT: hash_sinks(STDOUT), STDERR: hash_sinks(STDERR)}
+    sinks[STDOUT][0].write(b"out\n")
+    sinks[STDERR][0].write(b"err\n")
+    r = CommandResult(
+        argv=["foo"],
+        rc=1,
+        start=START,
+        end=START,
+        stdout=out,
+        stderr=b"err\n",
+        sinks=sinks,
+    )
+    assert output_digest(r) == output_digest(mkresult(1, b"out\n", b"err\n"))
+    # The hashers are used instead of rereading the output:
+    sinks[STDOUT][0].write(b"more\n")
+    assert output_digest(r) != output_digest(mkresult(1, b"out\n", b"err\n"))
+    out.close()
+
+
+def check_and_record(store: DedupStore, result: CommandResult) -> RunRecord | None:
+    prev = store.check(result)
+    store.record(result)
+    return prev
+
+
+def test_dedup_store(tmp_path: Path) -> None:
+    store = DedupStore(str(tmp_path / "dedup.json"))
+    assert check_and_record(store, mkresult(1, b"boom\n")) is None
+    prev = check_and_record(store, mkresult(1, b"boom\n", hours=1))
+    assert prev is not None
+    assert (prev.rc, prev.last, prev.since, prev.count) == (1, START, START, 1)
+    prev = check_and_record(store, mkresult(1, b"boom\n", hours=2))
+    assert prev is not None
+    assert prev.last == START + timedelta(hours=1)
+    assert prev.since == START
+    assert prev.count == 2
+    # Different output:
+    assert check_and_record(store, mkresult(1, b"bang\n", hours=3)) is None
+    # Different exit status:
+    assert check_and_record(store, mkresult(2, b"bang\n", hours=4)) is None
+    prev = check_and_record(store, mkresult(2, b"bang\n", hours=5))
+    assert prev is not None
+    assert prev.since == START + timedelta(hours=4)
+
+
+def test_dedup_store_check_does_not_record(tmp_path: Path) -> None:
+    store = DedupStore(str(tmp_path / "dedup.json"))
+    assert store.check(mkresult(1, b"boom\n")) is None
+    assert store.check(mkresult(1, b"boom\n", hours=1)) is None
+    assert not (tmp_path / "dedup.json").exists()
+
+
+def test_dedup_store_damaged(tmp_path: Path) -> None:
+    path = tmp_path / "dedup.json"
+    path.write_text('{"foo": ')
+    store = DedupStore(str(path))
+    assert check_and_record(store, mkresult(1, b"boom\n")) is None
+    assert check_and_record(store, mkresult(1, b"boom\n")) is not None
@@ -0,0 +1,108 @@
+from __future__ import annotations
+from email.headerregistry import Address
+from pathlib import Path
+import threading
+import time
+from unittest.mock import MagicMock
+import pytest
+from daemail.digest import Digest, flush_digests
+from daemail.message import DraftMessage
+
+
+def mkreport(subject: str) -> DraftMessage:
+    msg = DraftMessage(
+        from_addr=Address("Me", addr_spec="sender@example.nil"),
+        to_addrs=[Address(addr_spec="null@test.test")],
+        subject=subject,
+    )
+    msg.addtext("Exit Status: 0\n")
+    return msg
+
+
+def test_digest_size_limit(tmp_path: Path) -> None:
+    digest = Digest(key="nightly", digest_dir=str(tmp_path), window=600, max_size=1)
+    mailer = MagicMock()
+    digest.add_report(mkreport("[DONE] true"), mailer)
+    assert mailer.send.call_count == 1
+    (sent,) = mailer.send.call_args[0]
+    assert sent.subject == "[DIGEST] nightly: 1 report"
+    assert digest.spool.keys() == []
+
+
+def test_digest_window(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    digest = Digest(
+        key="nightly", digest_dir=str(tmp_path), window=600, max_size=1 << 20
+    )
+    mailer = MagicMock()
+    offset = 0.0
+
+    def fake_time() -> float:
+        return real_time() + offset
+
+    real_time = time.time
+    monkeypatch.setattr("time.time", fake_time)
+    # Adding reports doesn't wait for the window to close:
+    monkeypatch.setattr("time.sleep", MagicMock(side_effect=AssertionError))
+    digest.add_report(mkreport("[DONE] true"), mailer)
+    digest.add_report(mkreport("[FAILED] false"), mailer)
+    assert not mailer.send.called
+    offset += 600
+    # The first report after the window closes sends the digest:
+    digest.add_report(mkreport("[DONE] echo hi"), mailer)
+    assert mailer.send.call_count == 1
+    (sent,) = mailer.send.call_args[0]
+    assert sent.subject == "[DIGEST] nightly: 3 reports (1 failed)"
+    assert digest.spool.keys() == []
+    msgobj = sent.compile()
+    assert msgobj.get_content_type() == "multipart/mixed"
+    summary, *reports = msgobj.iter_parts()
+    assert summary.get_content() == (
+        "- [DONE] true\n- [FAILED] false\n- [DONE] echo hi\n"
+    )
+    assert [r.get_content_type() for r in reports] == ["message/rfc822"] * 3
+    assert [r.get_content()["Subject"] for r in reports] == [
+        "[DONE] true",
+        "[FAILED] false",
+        "[DONE] echo hi",
+    ]
+
+
+def test_flush_digests(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    mailer = MagicMock()
+    for key in ["nightly", "weekly"]:
+        digest = Digest(key=key, digest_dir=str(tmp_path), window=600, max_size=1 << 20)
+        digest.add_report(mkreport(f"[DONE] {key}"), mailer)
+    (tmp_path / "stray-file").touch()
+    assert flush_digests(str(tmp_path), 600, 1 << 20, mailer) == 0
+    assert not mailer.send.called
+    offset = 600.0
+    real_time = time.time
+    monkeypatch.setattr("time.time", lambda: real_time() + offset)
+    assert flush_digests(str(tmp_path), 600, 1 << 20, mailer) == 2
+    assert [c[0][0].subject for c in mailer.send.call_args_list] == [
+        "[DIGEST] nightly: 1 report",
+        "[DIGEST] weekly: 1 report",
+    ]
+    # The digests are addressed like their reports:
+    sent = mailer.send.call_args[0][0]
+    assert sent.from_addr == Address("Me", addr_spec="sender@example.nil")
+    assert sent.to_addrs == [Address(addr_spec="null@test.test")]
+
+
+def test_flush_digests_no_dir(tmp_path: Path) -> None:
+    mailer = MagicMock()
+    assert flush_digests(str(tmp_path / "nowhere"), 600, 1 << 20, mailer) == 0
+
+
+def test_digest_send_lock(tmp_path: Path) -> None:
+    digest = Digest(key="nightly", digest_dir=str(tmp_path), window=600, max_size=1)
+    lock = threading.Lock()
+    mailer = MagicMock()
+    mailer.send.side_effect = lambda _: assert_locked(lock)
+    digest.add_report(mkreport("[DONE] true"), mailer, lock)
+    assert mailer.send.call_count == 1
+    assert not lock.locked()
+
+
+def assert_locked(lock: threading.Lock) -> None:
+    assert lock.locked()
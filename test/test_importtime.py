@@ -0,0 +1,47 @@
+from __future__ import annotations
+import subprocess
+import sys
+
+#: Modules that should not be loaded just to start up the ``daemail`` command,
+#: as they're only needed once there's a message to compose & send (or, for
+#: ``daemon`` and ``morecontext``, once we know whether we're daemonizing, or,
+#: for ``asyncio``, once an `AsyncCommandRunner` is used, or, for
+#: ``concurrent.futures``, once ``--batch`` is used)
+DEFERRED_MODULES = [
+    "asyncio",
+    "concurrent.futures",
+    "daemon",
+    "eletter",
+    "morecontext",
+    "outgoing",
+    "pydantic",
+]
+
+
+def importtime(module: str) -> dict[str, int]:
+    """
+    Import ``module`` in a fresh interpreter under ``-X importtime`` and return
+    a mapping from the names of all modules loaded to their cumulative import
+    times in microseconds
+    """
+    r = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in r.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit():
+                times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_deferred_imports() -> None:
+    loaded = importtime("daemail.__main__")
+    assert "daemail.__main__" in loaded
+    for mod in DEFERRED_MODULES:
+        assert mod not in loaded, f"{mod} is imported at startup"
@@ -1,7 +1,25 @@
 from __future__ import annotations
+import email
+from email import policy
 from email.headerregistry import Address
+from email.message import EmailMessage
+import gzip
+from eletter import BytesAttachment, reply_quote
 from mailbits import email2dict
-from daemail.message import USER_AGENT, DraftMessage
+import pytest
+from daemail import message
+from daemail.capture import SpooledOutput
+from daemail.message import (
+    USER_AGENT,
+    BlobAttachment,
+    CompressedAttachment,
+    DeferredTextBody,
+    DraftBody,
+    DraftMessage,
+    TextStats,
+    append_part,
+)
+from daemail.stream import has_deferred, write_message
 
 TEXT = "àéîøü\n"
 
@@ -276,3 +294,317 @@ def test_compile_text_undecodable_quote() -> None:
         ],
         "epilogue": None,
     }
+
+
+def test_iterparts() -> None:
+    draft = DraftMessage(
+        from_addr=None,
+        to_addrs=[Address(addr_spec="me@example.com")],
+        subject="This is a test e-mail.",
+    )
+    draft.addtext("This is line 1.\n")
+    draft.addtext("This is line 2.\n")
+    draft.addmimeblob(b"\xde\xad\xbe\xef", "application/octet-stream", "x.dat")
+    draft.addtext("This is line 3.\n")
+    draft.addtext("This is line 4.\n")
+    assert list(draft.iterparts()) == [
+        "This is line 1.\nThis is line 2.\n",
+        BytesAttachment(
+            b"\xde\xad\xbe\xef",
+            "x.dat",
+            content_type="application/octet-stream",
+            inline=True,
+        ),
+        "This is line 3.\nThis is line 4.\n",
+    ]
+
+
+def test_addmimeblob_captured_output() -> None:
+    data = bytes(range(256)) * 1000
+    out = SpooledOutput(1024)
+    out.write(data)
+    assert out.rolled_over
+    draft = DraftMessage(
+        from_addr=None,
+        to_addrs=[Address(addr_spec="me@example.com")],
+        subject="This is a test e-mail.",
+    )
+    draft.addmimeblob(out, "application/octet-stream", "x.dat")
+    (att,) = draft.iterparts()
+    assert isinstance(att, BlobAttachment)
+    assert att.blob is out
+    assert att.filename == "x.dat"
+    assert att.content_type == "application/octet-stream"
+    msg = draft.compile()
+    out.close()
+    assert msg["Content-Transfer-Encoding"] == "base64"
+    assert msg.get_filename() == "x.dat"
+    assert msg.get_content() == data
+    # The result is the same as when `email` does the encoding itself:
+    expected = DraftMessage(
+        from_addr=None,
+        to_addrs=[Address(addr_spec="me@example.com")],
+        subject="This is a test e-mail.",
+    )
+    expected.addmimeblob(data, "application/octet-stream", "x.dat")
+    assert msg.get_payload() == expected.compile().get_payload()
+
+
+def test_addmimeblob_captured_output_compressed() -> None:
+    data = bytes(range(256)) * 1000
+    out = SpooledOutput(1024)
+    out.write(data)
+    draft = DraftMessage(
+        from_addr=None,
+        to_addrs=[Address(addr_spec="me@example.com")],
+        subject="This is a test e-mail.",
+    )
+    draft.addmimeblob(out, "application/octet-stream", "x.dat", compress="gzip")
+    (att,) = draft.iterparts()
+    assert isinstance(att, CompressedAttachment)
+    assert att.blob is out
+    assert att.filename == "x.dat.gz"
+    assert att.content_type == "application/gzip"
+    msg = draft.compile(deferred=True)
+    assert has_deferred(msg)
+    chunks: list[bytes] = []
+    write_message(msg, chunks.append, linesep="\r\n")
+    out.close()
+    parsed = email.message_from_bytes(b"".join(chunks), policy=policy.default)
+    assert isinstance(parsed, EmailMessage)
+    assert parsed["Content-Transfer-Encoding"] == "base64"
+    assert parsed.get_filename() == "x.dat.gz"
+    assert gzip.decompress(parsed.get_content()) == data
+
+
+def test_addblobquote_binary_captured_output() -> None:
+    out = SpooledOutput(None)
+    out.write(b"\xde\xad\xbe\xef")
+    draft = DraftMessage(
+        from_addr=None,
+        to_addrs=[Address(addr_spec="me@example.com")],
+        subject="This is a test e-mail.",
+    )
+    draft.addblobquote(out, "utf-8", "stdout")
+    (att,) = draft.iterparts()
+    assert isinstance(att, BlobAttachment)
+    assert att.filename == "stdout"
+    try:
+        assert draft.compile().get_content() == b"\xde\xad\xbe\xef"
+    finally:
+        out.close()
+
+
+def test_append_part_text() -> None:
+    draft = DraftMessage(
+        from_addr=None,
+        to_addrs=[Address(addr_spec="me@example.com")],
+        subject="This is a test e-mail.",
+    )
+    draft.addtext("This is the body.\n")
+    msg = draft.compile()
+    annex = DraftBody()
+    annex.addtext("This is the annex.\n")
+    append_part(msg, annex.compose())
+    assert email2dict(msg) == {
+        "unixfrom": None,
+        "headers": {
+            "subject": "This is a test e-mail.",
+            "to": [{"display_name": "", "address": "me@example.com"}],
+            "user-agent": [USER_AGENT],
+            "content-type": {
+                "content_type": "multipart/mixed",
+                "params": {},
+            },
+        },
+        "preamble": None,
+        "content": [
+            {
+                "unixfrom": None,
+                "headers": {
+                    "content-type": {
+                        "content_type": "text/plain",
+                        "params": {},
+                    },
+                },
+                "preamble": None,
+                "content": "This is the body.\n",
+                "epilogue": None,
+            },
+            {
+                "unixfrom": None,
+                "headers": {
+                    "content-type": {
+                        "content_type": "text/plain",
+                        "params": {},
+                    },
+                },
+                "preamble": None,
+                "content": "This is the annex.\n",
+                "epilogue": None,
+            },
+        ],
+        "epilogue": None,
+    }
+
+
+def test_append_part_mixed() -> None:
+    draft = DraftMessage(
+        from_addr=None,
+        to_addrs=[Address(addr_spec="me@example.com")],
+        subject="This is a test e-mail.",
+    )
+    draft.addtext("This is the body.\n")
+    draft.addmimeblob(b"\xde\xad\xbe\xef", "application/octet-stream", "x.dat")
+    msg = draft.compile()
+    attachment = list(msg.iter_parts())[1]
+    annex = DraftBody()
+    annex.addtext("This is the annex.\n")
+    append_part(msg, annex.compose())
+    assert msg.get_content_type() == "multipart/mixed"
+    parts = list(msg.iter_parts())
+    assert len(parts) == 3
+    # The existing parts are kept as-is rather than being recomposed:
+    assert parts[1] is attachment
+    assert email2dict(parts[2])["content"] == "This is the annex.\n"
+
+
+def test_addblobquote_spooled() -> None:
+    blob = SpooledOutput(16)
+    for _ in range(20):
+        blob.write(TEXT.encode("utf-8"))
+    draft = DraftMessage(
+        from_addr=None,
+        to_addrs=[Address(addr_spec="me@example.com")],
+        subject="This is a test e-mail.",
+    )
+    draft.addtext("Output:\n")
+    draft.addblobquote(blob, "utf-8", "stdout")
+    assert list(draft.iterparts()) == ["Output:\n" + ("> " + TEXT) * 20]
+    blob.close()
+
+
+@pytest.mark.parametrize(
+    "text,cte",
+    [
+        ("This is the output.\r\nIt has lines.\rMany lines.\n" * 50, "7bit"),
+        (TEXT * 50, "8bit"),
+        ("x" * 100 + "\n" + TEXT * 50, "quoted-printable"),
+        ("From here on\n" + "y = 1 \n" * 50, "7bit"),
+    ],
+)
+@pytest.mark.parametrize("linesep", ["\n", "\r\n"])
+def test_addblobquote_deferred(
+    monkeypatch: pytest.MonkeyPatch, text: str, cte: str, linesep: str
+) -> None:
+    monkeypatch.setattr(message, "DEFER_QUOTE_SIZE", 64)
+    blob = SpooledOutput(16)
+    data = text.encode("utf-8")
+    # Write in pieces that split characters and CR LF pairs:
+    for i in range(0, len(data), 7):
+        blob.write(data[i : i + 7])
+    draft = DraftMessage(
+        from_addr=None,
+        to_addrs=[Address(addr_spec="me@example.com")],
+        subject="This is a test e-mail.",
+    )
+    draft.addtext("Output:\n")
+    draft.addblobquote(blob, "utf-8", "stdout")
+    (body,) = draft.iterparts()
+    assert isinstance(body, DeferredTextBody)
+    assert body.pieces[0] == "Output:\n"
+    msg = draft.compile(deferred=True)
+    assert has_deferred(msg)
+    chunks: list[bytes] = []
+    write_message(msg, chunks.append, linesep=linesep)
+    blob.close()
+    parsed = email.message_from_bytes(b"".join(chunks), policy=policy.default)
+    assert isinstance(parsed, EmailMessage)
+    # The header text & the quote form a single text part
+    assert parsed.get_content_type() == "text/plain"
+    assert parsed["Content-Transfer-Encoding"] == cte
+    # The quote is the same as when it's composed in memory, apart from the
+    # line endings being normalized
+    quoted = reply_quote(text).replace("\r\n", "\n").replace("\r", "\n")
+    assert parsed.get_content().replace("\r\n", "\n") == "Output:\n" + quoted
+    assert max(map(len, b"".join(chunks).split(linesep.encode()))) <= 78
+
+
+def test_addblobquote_deferred_expanded(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(message, "DEFER_QUOTE_SIZE", 64)
+    blob = SpooledOutput(16)
+    blob.write(TEXT.encode("utf-8") * 50)
+    draft = DraftMessage(
+        from_addr=None,
+        to_addrs=[Address(addr_spec="me@example.com")],
+        subject="This is a test e-mail.",
+    )
+    draft.addtext("Output:\n")
+    draft.addblobquote(blob, "utf-8", "stdout")
+    msg = draft.compile()
+    blob.close()
+    assert not has_deferred(msg)
+    assert msg["Content-Transfer-Encoding"] == "8bit"
+    assert msg.get_content() == "Output:\n" + ("> " + TEXT) * 50
+    raw = msg.as_bytes()
+    assert raw.count(("> " + TEXT).encode("utf-8")) == 50
+
+
+def test_addblobquote_deferred_undecodable(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(message, "DEFER_QUOTE_SIZE", 64)
+    blob = SpooledOutput(16)
+    blob.write(TEXT.encode("utf-8") * 50 + b"\xff")
+    draft = DraftMessage(
+        from_addr=None,
+        to_addrs=[Address(addr_spec="me@example.com")],
+        subject="This is a test e-mail.",
+    )
+    draft.addblobquote(blob, "utf-8", "stdout")
+    (att,) = draft.iterparts()
+    assert isinstance(att, BlobAttachment)
+    assert att.blob is blob
+    blob.close()
+
+
+def test_addblobquote_deferred_mbox(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(message, "DEFER_QUOTE_SIZE", 64)
+    blob = SpooledOutput(16)
+    blob.write(b"From the top\n" * 10)
+    draft = DraftMessage(
+        from_addr=None,
+        to_addrs=[Address(addr_spec="me@example.com")],
+        subject="This is a test e-mail.",
+    )
+    draft.addblobquote(blob, "utf-8", "stdout")
+    draft.addtext("From the bottom\n")
+    msg = draft.compile(deferred=True)
+    # The trailing text is part of the deferred part, so BytesGenerator never
+    # sees it to mangle it itself
+    chunks: list[bytes] = []
+    write_message(msg, chunks.append, mangle_from=True)
+    blob.close()
+    body = b"".join(chunks).split(b"\n\n", 1)[1]
+    assert body == b"> From the top\n" * 10 + b">From the bottom\n"
+
+
+@pytest.mark.parametrize(
+    "pieces,cte",
+    [
+        ([], "7bit"),
+        (["> foo\n", "> bar"], "7bit"),
+        (["> caf\u00e9\n"], "8bit"),
+        (["> " + "x" * 38, "y" * 38 + "\n"], "7bit"),
+        (["> " + "x" * 38, "y" * 39 + "\n"], "quoted-printable"),
+        (["> " + "x" * 76 + "\r", "\n> short\n"], "7bit"),
+        (["a\n" + "x" * 70, "y" * 8, "\nb"], "7bit"),
+        (["a\n" + "x" * 70, "y" * 9, "\nb"], "quoted-printable"),
+        (["a\n", "x" * 80], "quoted-printable"),
+    ],
+)
+def test_text_stats(pieces: list[str], cte: str) -> None:
+    assert TextStats.scan(pieces).cte == cte
+    # Scanning the pieces separately & adding the results gives the same
+    # statistics:
+    assert sum((TextStats.scan([p]) for p in pieces), TextStats()) == TextStats.scan(
+        pieces
+    )
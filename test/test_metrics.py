@@ -0,0 +1,117 @@
+from __future__ import annotations
+from datetime import datetime, timedelta, timezone
+import json
+from pathlib import Path
+import socket
+import threading
+from daemail.capture import TruncatedOutput
+from daemail.metrics import JobMetrics, MetricsSink
+from daemail.runner import CommandError, CommandResult, ResourceUsage
+
+w4 = timezone(timedelta(hours=-4))
+
+START = datetime(2020, 3, 10, 15, 0, 28, 123456, w4)
+END = datetime(2020, 3, 10, 15, 1, 27, 654321, w4)
+
+
+def test_metrics_from_result() -> None:
+    stdout = TruncatedOutput(10)
+    stdout.write(b"0123456789abcdef")
+    result = CommandResult(
+        argv=["foo", "-x", "bar.txt"],
+        rc=2,
+        start=START,
+        end=END,
+        stdout=stdout,
+        stderr=b"oops\n",
+        rusage=ResourceUsage(
+            maxrss=12582912,
+            utime=1.25,
+            stime=0.0625,
+            inblock=8,
+            oublock=1024,
+            nvcsw=42,
+            nivcsw=3,
+        ),
+    )
+    stats = JobMetrics.from_result(result, 0.5)
+    stats.send_time = 0.25
+    stats.send_outcome = "sent"
+    assert stats.as_record() == {
+        "argv": ["foo", "-x", "bar.txt"],
+        "start": "2020-03-10T15:00:28.123456-04:00",
+        "end": "2020-03-10T15:01:27.654321-04:00",
+        "duration": 59.530865,
+        "rc": 2,
+        "timed_out": False,
+        "stdout_bytes": 16,
+        "stderr_bytes": 5,
+        "rusage": {
+            "maxrss": 12582912,
+            "utime": 1.25,
+            "stime": 0.0625,
+            "inblock": 8,
+            "oublock": 1024,
+            "nvcsw": 42,
+            "nivcsw": 3,
+        },
+        "compose_time": 0.5,
+        "send_time": 0.25,
+        "send_outcome": "sent",
+    }
+
+
+def test_metrics_from_error() -> None:
+    result = CommandError(
+        argv=["foo", "-x", "bar.txt"],
+        start=START,
+        end=END,
+        tb="Traceback ...",
+    )
+    assert JobMetrics.from_result(result, 0.125).as_record() == {
+        "argv": ["foo", "-x", "bar.txt"],
+        "start": "2020-03-10T15:00:28.123456-04:00",
+        "end": "2020-03-10T15:01:27.654321-04:00",
+        "duration": 59.530865,
+        "rc": None,
+        "timed_out": False,
+        "stdout_bytes": None,
+        "stderr_bytes": None,
+        "rusage": None,
+        "compose_time": 0.125,
+        "send_time": None,
+        "send_outcome": "skipped",
+    }
+
+
+def test_metrics_sink_file(tmp_path: Path) -> None:
+    path = tmp_path / "metrics.ndjson"
+    sink = MetricsSink(str(path))
+    sink.write({"rc": 0})
+    sink.write({"rc": 1})
+    assert path.read_text() == '{"rc": 0}\n{"rc": 1}\n'
+
+
+def test_metrics_sink_socket(tmp_path: Path) -> None:
+    path = str(tmp_path / "metrics.sock")
+    received: list[bytes] = []
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(path)
+        server.listen()
+
+        def serve() -> None:
+            for _ in range(2):
+                conn, _ = server.accept()
+                with conn, conn.makefile("rb") as fp:
+                    received.append(fp.read())
+
+        thread = threading.Thread(target=serve)
+        thread.start()
+        sink = MetricsSink(path)
+        sink.write({"rc": 0})
+        sink.write({"rc": 1, "argv": ["false"]})
+        thread.join()
+    assert [json.loads(r) for r in received] == [
+        {"rc": 0},
+        {"rc": 1, "argv": ["false"]},
+    ]
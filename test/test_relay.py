@@ -0,0 +1,205 @@
+from __future__ import annotations
+from collections.abc import Iterator
+from email.message import EmailMessage
+import io
+from pathlib import Path
+import socket
+import threading
+from typing import Any
+from unittest.mock import MagicMock
+from aiosmtpd.controller import Controller
+from outgoing import Sender, from_dict
+import pytest
+from daemail.relay import FRAME_HEADER, RelayError, read_frames, relay_send
+from daemail.relayd import RelayServer, SenderPool
+from daemail.senders import TryingSender
+
+
+class RecordingHandler:
+    def __init__(self) -> None:
+        self.connections = 0
+        self.subjects: list[str] = []
+
+    async def handle_EHLO(
+        self,
+        _server: Any,
+        session: Any,
+        _envelope: Any,
+        hostname: str,
+        responses: list[str],
+    ) -> list[str]:
+        self.connections += 1
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, _server: Any, _session: Any, envelope: Any) -> str:
+        for line in envelope.content.splitlines():
+            if line.startswith(b"Subject: "):
+                self.subjects.append(line[9:].decode())
+        return "250 OK"
+
+
+@pytest.fixture
+def smtpd() -> Iterator[tuple[RecordingHandler, int]]:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    handler = RecordingHandler()
+    controller = Controller(handler, hostname="127.0.0.1", port=port)
+    controller.start()
+    try:
+        yield (handler, port)
+    finally:
+        controller.stop()
+
+
+def mkmsg(subject: str) -> EmailMessage:
+    msg = EmailMessage()
+    msg["Subject"] = subject
+    msg["From"] = "me@example.nil"
+    msg["To"] = "null@test.test"
+    msg.set_content("This is the output.\n")
+    return msg
+
+
+def smtp_factory(port: int) -> Sender:
+    return from_dict({"method": "smtp", "host": "127.0.0.1", "port": port})
+
+
+@pytest.fixture
+def relay(
+    smtpd: tuple[RecordingHandler, int], tmp_path: Path
+) -> Iterator[tuple[RecordingHandler, str]]:
+    handler, port = smtpd
+    path = str(tmp_path / "relay.sock")
+    pool = SenderPool(factory=lambda: smtp_factory(port), size=2)
+    server = RelayServer(path, pool)
+    t = threading.Thread(target=server.serve_forever)
+    t.start()
+    try:
+        yield (handler, path)
+    finally:
+        server.shutdown()
+        t.join()
+        server.server_close()
+
+
+def test_pool_reuses_connection(smtpd: tuple[RecordingHandler, int]) -> None:
+    handler, port = smtpd
+    pool = SenderPool(factory=lambda: smtp_factory(port))
+    for i in range(5):
+        pool.send(mkmsg(f"Message {i}"))
+    pool.close()
+    assert handler.subjects == [f"Message {i}" for i in range(5)]
+    assert handler.connections == 1
+
+
+def test_pool_idle_timeout(smtpd: tuple[RecordingHandler, int]) -> None:
+    handler, port = smtpd
+    pool = SenderPool(factory=lambda: smtp_factory(port), idle_timeout=0)
+    pool.send(mkmsg("First"))
+    pool.send(mkmsg("Second"))
+    pool.close()
+    assert handler.subjects == ["First", "Second"]
+    assert handler.connections == 2
+
+
+def test_pool_reconnects_stale(smtpd: tuple[RecordingHandler, int]) -> None:
+    handler, port = smtpd
+    pool = SenderPool(factory=lambda: smtp_factory(port))
+    pool.send(mkmsg("First"))
+    # Simulate the server hanging up on the idle connection:
+    sender, _ = pool.idle[0]
+    sender._client.sock.shutdown(socket.SHUT_RDWR)  # type: ignore[attr-defined]
+    pool.send(mkmsg("Second"))
+    pool.close()
+    assert handler.subjects == ["First", "Second"]
+    assert handler.connections == 2
+
+
+def test_relay_send(relay: tuple[RecordingHandler, str]) -> None:
+    handler, path = relay
+    for i in range(3):
+        relay_send(path, mkmsg(f"Message {i}"))
+    assert handler.subjects == ["Message 0", "Message 1", "Message 2"]
+    assert handler.connections == 1
+
+
+@pytest.mark.parametrize("cut", ["mid-frame", "before-end"])
+def test_relay_incomplete_message(
+    relay: tuple[RecordingHandler, str], cut: str
+) -> None:
+    # A client that dies partway through sending doesn't get its truncated
+    # message delivered
+    handler, path = relay
+    data = mkmsg("Truncated").as_bytes()
+    if cut == "mid-frame":
+        payload = FRAME_HEADER.pack(len(data)) + data[: len(data) // 2]
+    else:
+        payload = FRAME_HEADER.pack(len(data)) + data
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall(payload)
+        s.shutdown(socket.SHUT_WR)
+        reply = b""
+        while chunk := s.recv(4096):
+            reply += chunk
+    assert reply == b"ERR Incomplete message\n"
+    assert handler.subjects == []
+
+
+def test_read_frames() -> None:
+    buf = io.BytesIO(
+        FRAME_HEADER.pack(3)
+        + b"foo"
+        + FRAME_HEADER.pack(4)
+        + b"bar\n"
+        + FRAME_HEADER.pack(0)
+    )
+    assert read_frames(buf.read) == b"foobar\n"
+    assert read_frames(io.BytesIO(b"").read) is None
+    assert read_frames(io.BytesIO(FRAME_HEADER.pack(3) + b"fo").read) is None
+
+
+def test_relay_send_failure(tmp_path: Path) -> None:
+    sender = MagicMock()
+    sender.send.side_effect = ValueError("No recipients")
+    path = str(tmp_path / "relay.sock")
+    server = RelayServer(path, SenderPool(factory=lambda: sender))
+    t = threading.Thread(target=server.serve_forever)
+    t.start()
+    try:
+        with pytest.raises(RelayError) as excinfo:
+            relay_send(path, mkmsg("Doomed"))
+    finally:
+        server.shutdown()
+        t.join()
+        server.server_close()
+    assert str(excinfo.value) == "ValueError: No recipients"
+
+
+def test_trying_sender_relay(relay: tuple[RecordingHandler, str]) -> None:
+    handler, path = relay
+    draft = MagicMock()
+    draft.compile.return_value = mkmsg("Relayed")
+    sender = MagicMock()
+    mailer = TryingSender(
+        sender=sender, dead_letter_path="dead.letter", relay_socket=path
+    )
+    assert mailer.send(draft) == "relayed"
+    assert not sender.send.called
+    assert handler.subjects == ["Relayed"]
+
+
+def test_trying_sender_relay_not_running(tmp_path: Path) -> None:
+    draft = MagicMock()
+    draft.compile.return_value = mkmsg("Direct")
+    sender = MagicMock()
+    mailer = TryingSender(
+        sender=sender,
+        dead_letter_path=str(tmp_path / "dead.letter"),
+        relay_socket=str(tmp_path / "relay.sock"),
+    )
+    assert mailer.send(draft) == "sent"
+    sender.send.assert_called_once_with(draft.compile.return_value)
+    assert not (tmp_path / "dead.letter").exists()
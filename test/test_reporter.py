@@ -1,18 +1,33 @@
+from __future__ import annotations
 from dataclasses import asdict
 from datetime import datetime, timedelta, timezone
+import email
+from email import policy
 from email.headerregistry import Address
+from email.message import EmailMessage
+import gzip
+from pathlib import Path
 import signal
+from typing import Any
 from eletter import BytesAttachment
 import pytest
 from pytest_mock import MockerFixture
-from daemail import util
-from daemail.message import DraftMessage
-from daemail.reporter import CommandReporter
-from daemail.runner import CommandError, CommandResult
+from daemail import message, util
+from daemail.capture import STDERR, STDOUT, Event, EventLog, TruncatedOutput
+from daemail.dedup import DedupStore
+from daemail.message import DeferredTextBody, DraftMessage
+from daemail.reporter import CommandReporter, timestamped_lines
+from daemail.runner import CommandError, CommandResult, Progress, ResourceUsage
+from daemail.stream import has_deferred, write_message
 
 w4 = timezone(timedelta(hours=-4))
 
 
+def draft2dict(msg: DraftMessage) -> dict[str, Any]:
+    # Join the text pieces together so that they can be compared as a whole
+    return {**asdict(msg), "parts": list(msg.iterparts())}
+
+
 @pytest.mark.parametrize(
     "result,subject,body",
     [
@@ -202,7 +217,7 @@ def test_report_plain_message(
     show_argv_spy = mocker.spy(util, "show_argv")
     msg = reporter.report(result)
     assert isinstance(msg, DraftMessage)
-    assert asdict(msg) == {
+    assert draft2dict(msg) == {
         "to_addrs": to_addrs,
         "subject": subject,
         "from_addr": from_addr,
@@ -244,7 +259,7 @@ def test_report_command_error(
     show_argv_spy = mocker.spy(util, "show_argv")
     msg = reporter.report(result)
     assert isinstance(msg, DraftMessage)
-    assert asdict(msg) == {
+    assert draft2dict(msg) == {
         "to_addrs": to_addrs,
         "subject": "[ERROR] foo -x bar.txt",
         "from_addr": from_addr,
@@ -283,7 +298,7 @@ def test_report_stdout_mime(mocker: MockerFixture) -> None:
     show_argv_spy = mocker.spy(util, "show_argv")
     msg = reporter.report(result)
     assert isinstance(msg, DraftMessage)
-    assert asdict(msg) == {
+    assert draft2dict(msg) == {
         "to_addrs": to_addrs,
         "subject": "[DONE] foo -x bar.txt",
         "from_addr": from_addr,
@@ -431,7 +446,7 @@ def test_report_nonempty(
         assert msg is None
     else:
         assert isinstance(msg, DraftMessage)
-        assert asdict(msg) == {
+        assert draft2dict(msg) == {
             "to_addrs": to_addrs,
             "subject": subject,
             "from_addr": from_addr,
@@ -538,7 +553,7 @@ def test_report_failure_only(
         assert msg is None
     else:
         assert isinstance(msg, DraftMessage)
-        assert asdict(msg) == {
+        assert draft2dict(msg) == {
             "to_addrs": to_addrs,
             "subject": subject,
             "from_addr": from_addr,
@@ -571,7 +586,7 @@ def test_report_utc(mocker: MockerFixture) -> None:
     show_argv_spy = mocker.spy(util, "show_argv")
     msg = reporter.report(result)
     assert isinstance(msg, DraftMessage)
-    assert asdict(msg) == {
+    assert draft2dict(msg) == {
         "to_addrs": to_addrs,
         "subject": "[DONE] foo -x bar.txt",
         "from_addr": from_addr,
@@ -616,7 +631,7 @@ def test_report_undecodable_stdout_empty_stderr(
     show_argv_spy = mocker.spy(util, "show_argv")
     msg = reporter.report(result)
     assert isinstance(msg, DraftMessage)
-    assert asdict(msg) == {
+    assert draft2dict(msg) == {
         "to_addrs": to_addrs,
         "subject": "[DONE] foo -x bar.txt",
         "from_addr": from_addr,
@@ -664,7 +679,7 @@ def test_report_undecodable_stdout_good_stderr(mocker: MockerFixture) -> None:
     show_argv_spy = mocker.spy(util, "show_argv")
     msg = reporter.report(result)
     assert isinstance(msg, DraftMessage)
-    assert asdict(msg) == {
+    assert draft2dict(msg) == {
         "to_addrs": to_addrs,
         "subject": "[DONE] foo -x bar.txt",
         "from_addr": from_addr,
@@ -713,7 +728,7 @@ def test_report_empty_stdout_undecodable_stderr(mocker: MockerFixture) -> None:
     show_argv_spy = mocker.spy(util, "show_argv")
     msg = reporter.report(result)
     assert isinstance(msg, DraftMessage)
-    assert asdict(msg) == {
+    assert draft2dict(msg) == {
         "to_addrs": to_addrs,
         "subject": "[DONE] foo -x bar.txt",
         "from_addr": from_addr,
@@ -763,7 +778,7 @@ def test_report_good_stdout_undecodable_stderr(mocker: MockerFixture) -> None:
     show_argv_spy = mocker.spy(util, "show_argv")
     msg = reporter.report(result)
     assert isinstance(msg, DraftMessage)
-    assert asdict(msg) == {
+    assert draft2dict(msg) == {
         "to_addrs": to_addrs,
         "subject": "[DONE] foo -x bar.txt",
         "from_addr": from_addr,
@@ -814,7 +829,7 @@ def test_report_undecodable_stdout_and_stderr(mocker: MockerFixture) -> None:
     show_argv_spy = mocker.spy(util, "show_argv")
     msg = reporter.report(result)
     assert isinstance(msg, DraftMessage)
-    assert asdict(msg) == {
+    assert draft2dict(msg) == {
         "to_addrs": to_addrs,
         "subject": "[DONE] foo -x bar.txt",
         "from_addr": from_addr,
@@ -842,3 +857,579 @@ def test_report_undecodable_stdout_and_stderr(mocker: MockerFixture) -> None:
         ],
     }
     show_argv_spy.assert_called_once_with(*result.argv)
+
+
+def test_report_truncated_output() -> None:
+    from_addr = Address("Command Reporter", addr_spec="reporter@example.com")
+    to_addrs = [Address("Re Cipient", addr_spec="person@example.com")]
+    stdout = TruncatedOutput(40)
+    for i in range(1, 101):
+        stdout.write(b"This is line %d.\n" % i)
+    stderr = TruncatedOutput(40)
+    stderr.write(b"This is the stderr.\n")
+    result = CommandResult(
+        argv=["foo", "-x", "bar.txt"],
+        rc=0,
+        start=datetime(2020, 3, 10, 15, 0, 28, 123456, w4),
+        end=datetime(2020, 3, 10, 15, 1, 27, 654321, w4),
+        stdout=stdout,
+        stderr=stderr,
+    )
+    reporter = CommandReporter(
+        encoding="utf-8",
+        failure_only=False,
+        from_addr=from_addr,
+        mime_type=None,
+        nonempty=False,
+        stderr_encoding="utf-8",
+        stdout_filename=None,
+        to_addrs=to_addrs,
+        utc=False,
+    )
+    msg = reporter.report(result)
+    assert isinstance(msg, DraftMessage)
+    assert draft2dict(msg) == {
+        "to_addrs": to_addrs,
+        "subject": "[DONE] foo -x bar.txt",
+        "from_addr": from_addr,
+        "parts": [
+            "Start Time:  2020-03-10 15:00:28.123456-04:00\n"
+            "End Time:    2020-03-10 15:01:27.654321-04:00\n"
+            "Exit Status: 0\n"
+            "\n"
+            "Output:\n"
+            "> This is line 1.\n"
+            "> This\n"
+            "[... 1652 bytes omitted ...]\n"
+            "> .\n"
+            "> This is line 100.\n"
+            "\n"
+            "Error Output:\n"
+            "> This is the stderr.\n"
+        ],
+    }
+
+
+@pytest.mark.parametrize(
+    "max_size,head,tail,omitted",
+    [
+        # The cut splits a character at the end of the head:
+        (11, "\u00e9\u00e9", "\u00e9\u00e9\u00e9", 90),
+        # The cut splits a character at the start of the tail:
+        (9, "\u00e9\u00e9", "\u00e9\u00e9", 92),
+    ],
+)
+def test_report_truncated_output_split_char(
+    max_size: int, head: str, tail: str, omitted: int
+) -> None:
+    stdout = TruncatedOutput(max_size)
+    stdout.write("\u00e9".encode("utf-8") * 50)
+    result = CommandResult(
+        argv=["foo"],
+        rc=0,
+        start=datetime(2020, 3, 10, 15, 0, 28, 123456, w4),
+        end=datetime(2020, 3, 10, 15, 1, 27, 654321, w4),
+        stdout=stdout,
+        stderr=None,
+    )
+    reporter = CommandReporter(
+        encoding="utf-8",
+        failure_only=False,
+        from_addr=None,
+        mime_type=None,
+        nonempty=False,
+        stderr_encoding="utf-8",
+        stdout_filename=None,
+        to_addrs=[Address("Re Cipient", addr_spec="person@example.com")],
+        utc=False,
+    )
+    msg = reporter.report(result)
+    assert isinstance(msg, DraftMessage)
+    (text,) = draft2dict(msg)["parts"]
+    assert text.endswith(
+        f"Output:\n> {head}\n[... {omitted} bytes omitted ...]\n> {tail}\n"
+    )
+
+
+def test_report_truncated_output_mime() -> None:
+    from_addr = Address("Command Reporter", addr_spec="reporter@example.com")
+    to_addrs = [Address("Re Cipient", addr_spec="person@example.com")]
+    stdout = TruncatedOutput(8)
+    stdout.write(b"0123456789")
+    result = CommandResult(
+        argv=["foo", "-x", "bar.txt"],
+        rc=0,
+        start=datetime(2020, 3, 10, 15, 0, 28, 123456, w4),
+        end=datetime(2020, 3, 10, 15, 1, 27, 654321, w4),
+        stdout=stdout,
+        stderr=None,
+    )
+    reporter = CommandReporter(
+        encoding="utf-8",
+        failure_only=False,
+        from_addr=from_addr,
+        mime_type="text/csv",
+        nonempty=False,
+        stderr_encoding="utf-8",
+        stdout_filename="data.csv",
+        to_addrs=to_addrs,
+        utc=False,
+    )
+    msg = reporter.report(result)
+    assert isinstance(msg, DraftMessage)
+    assert draft2dict(msg)["parts"] == [
+        "Start Time:  2020-03-10 15:00:28.123456-04:00\n"
+        "End Time:    2020-03-10 15:01:27.654321-04:00\n"
+        "Exit Status: 0\n"
+        "\n"
+        "Output:\n",
+        BytesAttachment(
+            b"0123",
+            "data-head.csv",
+            content_type="text/csv",
+            inline=True,
+        ),
+        "[... 2 bytes omitted ...]\n",
+        BytesAttachment(
+            b"6789",
+            "data-tail.csv",
+            content_type="text/csv",
+            inline=True,
+        ),
+    ]
+
+
+@pytest.mark.parametrize("threshold,compressed", [(0, True), (1024, False)])
+def test_report_stdout_compressed(threshold: int, compressed: bool) -> None:
+    from_addr = Address("Command Reporter", addr_spec="reporter@example.com")
+    to_addrs = [Address("Re Cipient", addr_spec="person@example.com")]
+    stdout = b'{"This": "is the output."}\n'
+    result = CommandResult(
+        argv=["foo", "-x", "bar.txt"],
+        rc=0,
+        start=datetime(2020, 3, 10, 15, 0, 28, 123456, w4),
+        end=datetime(2020, 3, 10, 15, 1, 27, 654321, w4),
+        stdout=stdout,
+        stderr=b"",
+    )
+    reporter = CommandReporter(
+        encoding="utf-8",
+        failure_only=False,
+        from_addr=from_addr,
+        mime_type="application/json",
+        nonempty=False,
+        stderr_encoding="utf-8",
+        stdout_filename="stdout.json",
+        to_addrs=to_addrs,
+        utc=False,
+        compress="gzip",
+        compress_threshold=threshold,
+    )
+    msg = reporter.report(result)
+    assert isinstance(msg, DraftMessage)
+    parts = list(msg.iterparts())
+    assert len(parts) == 2
+    attachment = parts[1]
+    assert isinstance(attachment, BytesAttachment)
+    if compressed:
+        assert attachment.filename == "stdout.json.gz"
+        assert attachment.content_type == "application/gzip"
+        assert gzip.decompress(attachment.content) == stdout
+    else:
+        assert attachment.filename == "stdout.json"
+        assert attachment.content_type == "application/json"
+        assert attachment.content == stdout
+
+
+def test_report_truncated_output_compressed() -> None:
+    stdout = TruncatedOutput(8)
+    stdout.write(b"0123456789")
+    result = CommandResult(
+        argv=["foo", "-x", "bar.txt"],
+        rc=0,
+        start=datetime(2020, 3, 10, 15, 0, 28, 123456, w4),
+        end=datetime(2020, 3, 10, 15, 1, 27, 654321, w4),
+        stdout=stdout,
+        stderr=None,
+    )
+    reporter = CommandReporter(
+        encoding="utf-8",
+        failure_only=False,
+        from_addr=None,
+        mime_type="text/csv",
+        nonempty=False,
+        stderr_encoding="utf-8",
+        stdout_filename="data.csv",
+        to_addrs=[Address("Re Cipient", addr_spec="person@example.com")],
+        utc=False,
+        compress="gzip",
+    )
+    msg = reporter.report(result)
+    assert isinstance(msg, DraftMessage)
+    attachments = [p for p in msg.iterparts() if isinstance(p, BytesAttachment)]
+    assert [(a.filename, gzip.decompress(a.content)) for a in attachments] == [
+        ("data-head.csv.gz", b"0123"),
+        ("data-tail.csv.gz", b"6789"),
+    ]
+
+
+def test_report_rusage() -> None:
+    from_addr = Address("Command Reporter", addr_spec="reporter@example.com")
+    to_addrs = [Address("Re Cipient", addr_spec="person@example.com")]
+    result = CommandResult(
+        argv=["foo", "-x", "bar.txt"],
+        rc=0,
+        start=datetime(2020, 3, 10, 15, 0, 28, 123456, w4),
+        end=datetime(2020, 3, 10, 15, 1, 27, 654321, w4),
+        stdout=b"This is the output.\n",
+        stderr=None,
+        rusage=ResourceUsage(
+            maxrss=12582912,
+            utime=1.25,
+            stime=0.0625,
+            inblock=8,
+            oublock=1024,
+            nvcsw=42,
+            nivcsw=3,
+        ),
+    )
+    reporter = CommandReporter(
+        encoding="utf-8",
+        failure_only=False,
+        from_addr=from_addr,
+        mime_type=None,
+        nonempty=False,
+        stderr_encoding="utf-8",
+        stdout_filename=None,
+        to_addrs=to_addrs,
+        utc=False,
+    )
+    msg = reporter.report(result)
+    assert isinstance(msg, DraftMessage)
+    assert draft2dict(msg) == {
+        "to_addrs": to_addrs,
+        "subject": "[DONE] foo -x bar.txt",
+        "from_addr": from_addr,
+        "parts": [
+            "Start Time:  2020-03-10 15:00:28.123456-04:00\n"
+            "End Time:    2020-03-10 15:01:27.654321-04:00\n"
+            "Exit Status: 0\n"
+            "\n"
+            "Resource Usage:\n"
+            "  Max RSS:                       12.0 MiB\n"
+            "  User CPU Time:                 1.250 s\n"
+            "  System CPU Time:               0.062 s\n"
+            "  Block Input Operations:        8\n"
+            "  Block Output Operations:       1024\n"
+            "  Voluntary Context Switches:    42\n"
+            "  Involuntary Context Switches:  3\n"
+            "\n"
+            "Output:\n"
+            "> This is the output.\n"
+        ],
+    }
+
+
+def test_report_timeout() -> None:
+    from_addr = Address("Command Reporter", addr_spec="reporter@example.com")
+    to_addrs = [Address("Re Cipient", addr_spec="person@example.com")]
+    result = CommandResult(
+        argv=["foo", "-x", "bar.txt"],
+        rc=-15,
+        start=datetime(2020, 3, 10, 15, 0, 28, 123456, w4),
+        end=datetime(2020, 3, 10, 15, 1, 27, 654321, w4),
+        stdout=b"Working...\n",
+        stderr=None,
+        timed_out=True,
+    )
+    reporter = CommandReporter(
+        encoding="utf-8",
+        failure_only=True,
+        from_addr=from_addr,
+        mime_type=None,
+        nonempty=False,
+        stderr_encoding="utf-8",
+        stdout_filename=None,
+        to_addrs=to_addrs,
+        utc=False,
+    )
+    msg = reporter.report(result)
+    assert isinstance(msg, DraftMessage)
+    assert draft2dict(msg) == {
+        "to_addrs": to_addrs,
+        "subject": "[TIMEOUT] foo -x bar.txt",
+        "from_addr": from_addr,
+        "parts": [
+            "Start Time:  2020-03-10 15:00:28.123456-04:00\n"
+            "End Time:    2020-03-10 15:01:27.654321-04:00\n"
+            "Exit Status: -15 (SIGTERM)\n"
+            "Timed Out:   yes\n"
+            "\n"
+            "Output:\n"
+            "> Working...\n"
+        ],
+    }
+
+
+@pytest.mark.parametrize(
+    "mime_type,stdout_part",
+    [
+        (None, "\nRecent Output:\n> step 41\n> step 42\n"),
+        ("application/json", ""),
+    ],
+)
+def test_heartbeat(mime_type: str | None, stdout_part: str) -> None:
+    from_addr = Address("Command Reporter", addr_spec="reporter@example.com")
+    to_addrs = [Address("Re Cipient", addr_spec="person@example.com")]
+    progress = Progress(
+        argv=["foo", "-x", "bar.txt"],
+        start=datetime(2020, 3, 10, 15, 0, 28, 123456, w4),
+        now=datetime(2020, 3, 11, 17, 1, 27, 654321, w4),
+        stdout=b"step 41\nstep 42\n",
+        stderr=b"warning: slow\n",
+        rusage=ResourceUsage(
+            maxrss=12582912,
+            utime=1.25,
+            stime=0.0625,
+            inblock=8,
+            oublock=1024,
+            nvcsw=42,
+            nivcsw=3,
+        ),
+    )
+    reporter = CommandReporter(
+        encoding="utf-8",
+        failure_only=True,
+        from_addr=from_addr,
+        mime_type=mime_type,
+        nonempty=False,
+        stderr_encoding="utf-8",
+        stdout_filename=None if mime_type is None else "stdout.json",
+        to_addrs=to_addrs,
+        utc=False,
+    )
+    msg = reporter.heartbeat(progress)
+    assert draft2dict(msg) == {
+        "to_addrs": to_addrs,
+        "subject": "[RUNNING] foo -x bar.txt",
+        "from_addr": from_addr,
+        "parts": [
+            "Start Time:  2020-03-10 15:00:28.123456-04:00\n"
+            "Elapsed:     1 day, 2:00:59\n"
+            "\n"
+            "Resource Usage So Far:\n"
+            "  Max RSS:                       12.0 MiB\n"
+            "  User CPU Time:                 1.250 s\n"
+            "  System CPU Time:               0.062 s\n"
+            "  Block Input Operations:        8\n"
+            "  Block Output Operations:       1024\n"
+            "  Voluntary Context Switches:    42\n"
+            "  Involuntary Context Switches:  3\n"
+            + stdout_part
+            + "\nRecent Error Output:\n> warning: slow\n"
+        ],
+    }
+
+
+@pytest.mark.parametrize("split", [False, True])
+def test_report_timestamps(mocker: MockerFixture, split: bool) -> None:
+    clock = mocker.patch("daemail.capture.time")
+    clock.monotonic.side_effect = [100.0, 100.5, 101.25, 101.5, 102.0, 103.5]
+    log = EventLog(None)
+    out, err = log.view(STDOUT), log.view(STDERR)
+    out.write(b"Starting...\nStep ")
+    err.write(b"warning: slow\n")
+    out.write(b"1 done\n")
+    out.write(b"All done.")
+    err.write(b"\xc3\xa9\n")
+    result = CommandResult(
+        argv=["foo", "-x", "bar.txt"],
+        rc=0,
+        start=datetime(2020, 3, 10, 15, 0, 28, 123456, w4),
+        end=datetime(2020, 3, 10, 15, 1, 27, 654321, w4),
+        stdout=out if split else log.view(STDOUT, STDERR),
+        stderr=err if split else None,
+        events=log,
+    )
+    reporter = CommandReporter(
+        encoding="utf-8",
+        failure_only=False,
+        from_addr=None,
+        mime_type=None,
+        nonempty=False,
+        stderr_encoding="utf-8",
+        stdout_filename=None,
+        to_addrs=[Address("Re Cipient", addr_spec="person@example.com")],
+        utc=False,
+        timestamps=True,
+    )
+    msg = reporter.report(result)
+    result.close()
+    assert isinstance(msg, DraftMessage)
+    if split:
+        output = (
+            "Output:\n"
+            "> [+0.500s] Starting...\n"
+            "> [+0.500s] Step 1 done\n"
+            "> [+2.000s] All done.\n"
+            "\n"
+            "Error Output:\n"
+            "> [+1.250s] warning: slow\n"
+            "> [+3.500s] \u00e9\n"
+        )
+    else:
+        output = (
+            "Output:\n"
+            "> [+0.500s out] Starting...\n"
+            "> [+1.250s err] warning: slow\n"
+            "> [+0.500s out] Step 1 done\n"
+            "> [+3.500s err] \u00e9\n"
+            "> [+2.000s out] All done.\n"
+        )
+    assert draft2dict(msg)["parts"] == [
+        "Start Time:  2020-03-10 15:00:28.123456-04:00\n"
+        "End Time:    2020-03-10 15:01:27.654321-04:00\n"
+        "Exit Status: 0\n"
+        "\n" + output
+    ]
+
+
+@pytest.mark.parametrize("undecodable", [False, True])
+def test_report_timestamps_deferred(
+    mocker: MockerFixture, monkeypatch: pytest.MonkeyPatch, undecodable: bool
+) -> None:
+    monkeypatch.setattr(message, "DEFER_QUOTE_SIZE", 16)
+    clock = mocker.patch("daemail.capture.time")
+    clock.monotonic.side_effect = [100.0, 100.5, 101.25, 102.0]
+    log = EventLog(None)
+    out, err = log.view(STDOUT), log.view(STDERR)
+    out.write(b"Starting...\n")
+    err.write(b"warning: slow\n")
+    out.write(b"All done.\n" if not undecodable else b"\xff\n")
+    result = CommandResult(
+        argv=["foo", "-x", "bar.txt"],
+        rc=0,
+        start=datetime(2020, 3, 10, 15, 0, 28, 123456, w4),
+        end=datetime(2020, 3, 10, 15, 1, 27, 654321, w4),
+        stdout=log.view(STDOUT, STDERR),
+        stderr=None,
+        events=log,
+    )
+    reporter = CommandReporter(
+        encoding="utf-8",
+        failure_only=False,
+        from_addr=None,
+        mime_type=None,
+        nonempty=False,
+        stderr_encoding="utf-8",
+        stdout_filename=None,
+        to_addrs=[Address("Re Cipient", addr_spec="person@example.com")],
+        utc=False,
+        timestamps=True,
+    )
+    draft = reporter.report(result)
+    assert isinstance(draft, DraftMessage)
+    if undecodable:
+        # The output is attached as-is instead
+        assert any(isinstance(p, BytesAttachment) for p in draft.iterparts())
+        result.close()
+        return
+    (body,) = draft.iterparts()
+    assert isinstance(body, DeferredTextBody)
+    msg = draft.compile(deferred=True)
+    assert has_deferred(msg)
+    chunks: list[bytes] = []
+    write_message(msg, chunks.append)
+    result.close()
+    parsed = email.message_from_bytes(b"".join(chunks), policy=policy.default)
+    assert isinstance(parsed, EmailMessage)
+    assert parsed.get_content().endswith(
+        "Output:\n"
+        "> [+0.500s out] Starting...\n"
+        "> [+1.250s err] warning: slow\n"
+        "> [+2.000s out] All done.\n"
+    )
+
+
+def test_timestamped_lines_undecodable() -> None:
+    with pytest.raises(UnicodeDecodeError):
+        list(timestamped_lines([Event(0.0, STDOUT, b"\xff\n")], "utf-8", False))
+
+
+def test_timestamped_lines_split_character() -> None:
+    events = [
+        Event(0.0, STDOUT, b"caf\xc3"),
+        Event(1.0, STDERR, b"oops\n"),
+        Event(2.0, STDOUT, b"\xa9\n"),
+    ]
+    assert list(timestamped_lines(events, "utf-8", True)) == [
+        "[+1.000s err] oops\n",
+        "[+0.000s out] caf\u00e9\n",
+    ]
+
+
+@pytest.mark.parametrize("suppress", [False, True])
+def test_report_dedup(tmp_path: Path, suppress: bool) -> None:
+    reporter = CommandReporter(
+        encoding="utf-8",
+        failure_only=False,
+        from_addr=None,
+        mime_type=None,
+        nonempty=False,
+        stderr_encoding="utf-8",
+        stdout_filename=None,
+        to_addrs=[Address("Re Cipient", addr_spec="person@example.com")],
+        utc=False,
+        dedup=DedupStore(str(tmp_path / "dedup.json")),
+        dedup_suppress=suppress,
+    )
+
+    def run(rc: int, hours: int) -> DraftMessage | None:
+        result = CommandResult(
+            argv=["foo", "-x", "bar.txt"],
+            rc=rc,
+            start=datetime(2020, 3, 10, 15, 0, 28, 123456, w4) + timedelta(hours=hours),
+            end=datetime(2020, 3, 10, 15, 1, 27, 654321, w4) + timedelta(hours=hours),
+            stdout=b"Something broke.\n",
+            stderr=None,
+        )
+        msg = reporter.report(result)
+        reporter.record(result)
+        return msg
+
+    msg = run(1, 0)
+    assert isinstance(msg, DraftMessage)
+    assert "> Something broke.\n" in draft2dict(msg)["parts"][0]
+    for hours, note in [
+        (
+            1,
+            "Output identical to the previous run at"
+            " 2020-03-10 15:00:28.123456-04:00\n",
+        ),
+        (
+            2,
+            "Output identical to the previous run at"
+            " 2020-03-10 16:00:28.123456-04:00 (3 identical runs in a row"
+            " since 2020-03-10 15:00:28.123456-04:00)\n",
+        ),
+    ]:
+        msg = run(1, hours)
+        if suppress:
+            assert msg is None
+        else:
+            assert isinstance(msg, DraftMessage)
+            assert msg.subject == "[FAILED] foo -x bar.txt"
+            assert draft2dict(msg)["parts"] == [
+                f"Start Time:  2020-03-10 {15 + hours}:00:28.123456-04:00\n"
+                f"End Time:    2020-03-10 {15 + hours}:01:27.654321-04:00\n"
+                "Exit Status: 1\n"
+                "\n" + note
+            ]
+    # Successes are never deduplicated, but they do reset the run of failures
+    for hours in (3, 4):
+        msg = run(0, hours)
+        assert isinstance(msg, DraftMessage)
+        assert "> Something broke.\n" in draft2dict(msg)["parts"][0]
+    msg = run(1, 5)
+    assert isinstance(msg, DraftMessage)
+    assert "> Something broke.\n" in draft2dict(msg)["parts"][0]
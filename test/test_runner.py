@@ -1,12 +1,37 @@
 from __future__ import annotations
+import asyncio
 from datetime import datetime, timedelta, timezone
+import gzip
+from hashlib import sha256
+import os
+from pathlib import Path
+import signal
 import subprocess
+import sys
+import time
 from types import SimpleNamespace
 from typing import Any
 from unittest.mock import ANY, sentinel
 import pytest
 from pytest_mock import MockerFixture
-from daemail.runner import CommandError, CommandResult, CommandRunner
+from daemail.capture import (
+    STDERR,
+    STDOUT,
+    EventView,
+    OutputSink,
+    SpooledOutput,
+    TruncatedOutput,
+)
+from daemail.runner import (
+    AsyncCommandRunner,
+    CommandError,
+    CommandResult,
+    CommandRunner,
+    Heartbeat,
+    Progress,
+    proc_usage,
+)
+from daemail.sinks import CompressedFile, Hasher, LineCounter
 
 w4 = timezone(timedelta(hours=-4))
 
@@ -17,6 +42,16 @@ ARGV = ["not-a-real-command", "-x", "foo.txt"]
 
 ERROR = OSError("The kernel died.")
 
+SCRIPT = [
+    sys.executable,
+    "-c",
+    "import sys\n"
+    "print('out 1', flush=True)\n"
+    "print('err 1', file=sys.stderr, flush=True)\n"
+    "print('out 2', flush=True)\n"
+    "sys.exit(3)\n",
+]
+
 
 @pytest.mark.parametrize(
     "no_stderr,no_stdout,split,run_kwargs,runresult,cmdresult",
@@ -141,3 +176,562 @@ def test_runner(
     run_mock.assert_called_once_with(ARGV, **run_kwargs)
     assert dtnow_mock.call_count == 2
     assert r == cmdresult
+
+
+@pytest.mark.parametrize(
+    "no_stderr,no_stdout,split,stdout,stderr",
+    [
+        (False, False, False, b"out 1\nerr 1\nout 2\n", None),
+        (False, False, True, b"out 1\nout 2\n", b"err 1\n"),
+        (True, False, False, b"out 1\nout 2\n", None),
+        (False, True, False, None, b"err 1\n"),
+    ],
+)
+def test_runner_spooled(
+    capfd: pytest.CaptureFixture[str],
+    no_stderr: bool,
+    no_stdout: bool,
+    split: bool,
+    stdout: bytes | None,
+    stderr: bytes | None,
+) -> None:
+    runner = CommandRunner(
+        no_stderr=no_stderr,
+        no_stdout=no_stdout,
+        split=split,
+        spool_size=4,
+    )
+    r = runner.run(*SCRIPT)
+    assert isinstance(r, CommandResult)
+    assert r.argv == SCRIPT
+    assert r.rc == 3
+    for out, expected in [(r.stdout, stdout), (r.stderr, stderr)]:
+        if expected is None:
+            assert out is None
+        else:
+            assert isinstance(out, SpooledOutput)
+            assert out.rolled_over
+            assert out.getvalue() == expected
+    r.close()
+    capfd.readouterr()
+
+
+def test_runner_spooled_error() -> None:
+    runner = CommandRunner(
+        no_stderr=False,
+        no_stdout=False,
+        split=False,
+        spool_size=1024,
+    )
+    r = runner.run("/nonexistent/command")
+    assert isinstance(r, CommandError)
+    assert "FileNotFoundError" in r.tb
+
+
+def test_runner_max_output() -> None:
+    runner = CommandRunner(
+        no_stderr=False,
+        no_stdout=False,
+        split=True,
+        spool_size=1024,
+        max_output=8,
+    )
+    r = runner.run(*SCRIPT)
+    assert isinstance(r, CommandResult)
+    assert r.rc == 3
+    assert isinstance(r.stdout, TruncatedOutput)
+    assert r.stdout.head == b"out "
+    assert r.stdout.tail == b"t 2\n"
+    assert r.stdout.omitted == 4
+    assert isinstance(r.stderr, TruncatedOutput)
+    assert r.stderr.getvalue() == b"err 1\n"
+    assert r.stderr.omitted == 0
+
+
+@pytest.mark.parametrize(
+    "no_stderr,no_stdout,split,stdout,stderr",
+    [
+        (False, False, False, b"out 1\nerr 1\nout 2\n", None),
+        (False, False, True, b"out 1\nout 2\n", b"err 1\n"),
+        (True, False, False, b"out 1\nout 2\n", None),
+        (False, True, False, None, b"err 1\n"),
+    ],
+)
+def test_async_runner(
+    capfd: pytest.CaptureFixture[str],
+    no_stderr: bool,
+    no_stdout: bool,
+    split: bool,
+    stdout: bytes | None,
+    stderr: bytes | None,
+) -> None:
+    runner = AsyncCommandRunner(no_stderr=no_stderr, no_stdout=no_stdout, split=split)
+    r = runner.run(*SCRIPT)
+    assert isinstance(r, CommandResult)
+    assert r.argv == SCRIPT
+    assert r.rc == 3
+    for out, expected in [(r.stdout, stdout), (r.stderr, stderr)]:
+        if expected is None:
+            assert out is None
+        else:
+            assert isinstance(out, SpooledOutput)
+            assert not out.rolled_over
+            assert out.getvalue() == expected
+    r.close()
+    capfd.readouterr()
+
+
+def test_async_runner_sink_factory() -> None:
+    runner = AsyncCommandRunner(
+        no_stderr=False,
+        no_stdout=False,
+        split=True,
+        sink_factory=lambda: TruncatedOutput(8),
+    )
+    r = runner.run(*SCRIPT)
+    assert isinstance(r, CommandResult)
+    assert isinstance(r.stdout, TruncatedOutput)
+    assert r.stdout.head == b"out "
+    assert r.stdout.tail == b"t 2\n"
+    assert isinstance(r.stderr, TruncatedOutput)
+    assert r.stderr.getvalue() == b"err 1\n"
+
+
+def test_async_runner_error() -> None:
+    runner = AsyncCommandRunner(no_stderr=False, no_stdout=False, split=False)
+    r = runner.run("/nonexistent/command")
+    assert isinstance(r, CommandError)
+    assert r.argv == ["/nonexistent/command"]
+    assert "FileNotFoundError" in r.tb
+
+
+def test_async_runner_error_reaps_child() -> None:
+    pids: list[int] = []
+
+    class FailingSink(SpooledOutput):
+        def write(self, chunk: bytes) -> None:
+            pids.append(int(chunk.split()[0]))
+            raise RuntimeError("Sink failed")
+
+    runner = AsyncCommandRunner(
+        no_stderr=True,
+        no_stdout=False,
+        split=False,
+        sink_factory=lambda: FailingSink(None),
+    )
+    r = runner.run(
+        sys.executable,
+        "-c",
+        "import os, time; print(os.getpid(), flush=True); time.sleep(30)",
+    )
+    assert isinstance(r, CommandError)
+    assert "Sink failed" in r.tb
+    (pid,) = pids
+    # The child has been killed and reaped, not left as a zombie:
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
+
+
+def test_async_runner_concurrent() -> None:
+    runner = AsyncCommandRunner(no_stderr=False, no_stdout=False, split=False)
+    sleeper = [sys.executable, "-c", "import time; time.sleep(0.5); print('done')"]
+
+    async def main() -> list[CommandResult | CommandError]:
+        return await asyncio.gather(*(runner.run_async(*sleeper) for _ in range(4)))
+
+    start = time.monotonic()
+    results = asyncio.run(main())
+    elapsed = time.monotonic() - start
+    # The commands run at the same time rather than one after another:
+    assert elapsed < 1.5
+    for r in results:
+        assert isinstance(r, CommandResult)
+        assert r.rc == 0
+        assert isinstance(r.stdout, SpooledOutput)
+        assert r.stdout.getvalue() == b"done\n"
+        r.close()
+
+
+def test_runner_rusage(capfd: pytest.CaptureFixture[str]) -> None:
+    runner = CommandRunner(
+        no_stderr=False,
+        no_stdout=False,
+        split=True,
+        rusage=True,
+    )
+    script = [
+        sys.executable,
+        "-c",
+        "import sys, time\n"
+        "buf = bytearray(64 << 20)\n"
+        "end = time.process_time() + 0.2\n"
+        "while time.process_time() < end:\n"
+        "    pass\n"
+        "print('out')\n"
+        "sys.exit(3)\n",
+    ]
+    r = runner.run(*script)
+    assert isinstance(r, CommandResult)
+    assert r.rc == 3
+    assert isinstance(r.stdout, SpooledOutput)
+    assert r.stdout.getvalue() == b"out\n"
+    assert r.rusage is not None
+    assert r.rusage.maxrss >= 64 << 20
+    assert r.rusage.utime + r.rusage.stime >= 0.2
+    r.close()
+    capfd.readouterr()
+
+
+def test_runner_rusage_signal() -> None:
+    runner = CommandRunner(
+        no_stderr=False,
+        no_stdout=False,
+        split=False,
+        rusage=True,
+    )
+    r = runner.run(
+        sys.executable, "-c", "import os, signal; os.kill(os.getpid(), signal.SIGTERM)"
+    )
+    assert isinstance(r, CommandResult)
+    assert r.rc == -signal.SIGTERM
+    assert r.rusage is not None
+    r.close()
+
+
+HANGER = [
+    sys.executable,
+    "-c",
+    "import signal, subprocess, sys, time\n"
+    "if sys.argv[1:] == ['--ignore-term']:\n"
+    "    signal.signal(signal.SIGTERM, signal.SIG_IGN)\n"
+    "# A grandchild holding the output pipe open must be killed too:\n"
+    "subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)'])\n"
+    "print('started', flush=True)\n"
+    "time.sleep(60)\n",
+]
+
+
+@pytest.mark.parametrize("rusage", [False, True])
+def test_runner_timeout(rusage: bool) -> None:
+    runner = CommandRunner(
+        no_stderr=False,
+        no_stdout=False,
+        split=False,
+        rusage=rusage,
+        timeout=0.5,
+    )
+    start = time.monotonic()
+    r = runner.run(*HANGER)
+    assert time.monotonic() - start < 10
+    assert isinstance(r, CommandResult)
+    assert r.timed_out
+    assert r.rc == -signal.SIGTERM
+    assert isinstance(r.stdout, SpooledOutput)
+    assert r.stdout.getvalue() == b"started\n"
+    assert (r.rusage is not None) is rusage
+    r.close()
+
+
+@pytest.mark.parametrize("rusage", [False, True])
+def test_runner_timeout_kill(rusage: bool) -> None:
+    runner = CommandRunner(
+        no_stderr=False,
+        no_stdout=False,
+        split=False,
+        rusage=rusage,
+        timeout=0.5,
+        kill_after=0.5,
+    )
+    r = runner.run(*HANGER, "--ignore-term")
+    assert isinstance(r, CommandResult)
+    assert r.timed_out
+    assert r.rc == -signal.SIGKILL
+    assert isinstance(r.stdout, SpooledOutput)
+    assert r.stdout.getvalue() == b"started\n"
+    r.close()
+
+
+@pytest.mark.parametrize("runner_class", [CommandRunner, AsyncCommandRunner])
+def test_runner_timeout_process_group(runner_class: type[CommandRunner]) -> None:
+    # With a timeout, the command gets its own process group but stays in our
+    # session (and thus keeps our controlling terminal, if any)
+    runner = runner_class(no_stderr=True, no_stdout=False, split=False, timeout=30)
+    r = runner.run(
+        sys.executable,
+        "-c",
+        "import os; print(os.getpid(), os.getpgid(0), os.getsid(0))",
+    )
+    assert isinstance(r, CommandResult)
+    assert isinstance(r.stdout, SpooledOutput)
+    pid, pgid, sid = map(int, r.stdout.getvalue().split())
+    r.close()
+    assert pgid == pid
+    assert sid == os.getsid(0)
+
+
+def test_runner_timeout_not_reached() -> None:
+    runner = CommandRunner(
+        no_stderr=False,
+        no_stdout=False,
+        split=False,
+        timeout=30,
+    )
+    r = runner.run(*SCRIPT)
+    assert isinstance(r, CommandResult)
+    assert not r.timed_out
+    assert r.rc == 3
+    assert isinstance(r.stdout, SpooledOutput)
+    assert r.stdout.getvalue() == b"out 1\nerr 1\nout 2\n"
+    r.close()
+
+
+def test_async_runner_timeout() -> None:
+    runner = AsyncCommandRunner(
+        no_stderr=False,
+        no_stdout=False,
+        split=False,
+        timeout=0.5,
+        kill_after=0.5,
+    )
+    r = runner.run(*HANGER, "--ignore-term")
+    assert isinstance(r, CommandResult)
+    assert r.timed_out
+    assert r.rc == -signal.SIGKILL
+    assert isinstance(r.stdout, SpooledOutput)
+    assert r.stdout.getvalue() == b"started\n"
+    r.close()
+
+
+TICKER = [
+    sys.executable,
+    "-c",
+    "import time\n"
+    "for i in range(10):\n"
+    "    print('tick', i, flush=True)\n"
+    "    time.sleep(0.1)\n",
+]
+
+
+@pytest.mark.parametrize("rusage", [False, True])
+def test_runner_heartbeat(rusage: bool) -> None:
+    beats: list[Progress] = []
+    runner = CommandRunner(
+        no_stderr=False,
+        no_stdout=False,
+        split=True,
+        rusage=rusage,
+        heartbeat=0.25,
+        on_heartbeat=beats.append,
+    )
+    r = runner.run(*TICKER)
+    assert isinstance(r, CommandResult)
+    assert r.rc == 0
+    assert isinstance(r.stdout, SpooledOutput)
+    assert r.stdout.getvalue() == b"".join(b"tick %d\n" % i for i in range(10))
+    r.close()
+    assert 1 <= len(beats) <= 4
+    for p in beats:
+        assert p.argv == TICKER
+        assert p.start <= p.now
+        assert p.stdout is not None
+        assert p.stdout.startswith(b"tick 0\n")
+        assert p.stdout.endswith(b"\n")
+        assert p.stderr == b""
+        if sys.platform == "linux":
+            assert p.rusage is not None
+    assert len(beats[-1].stdout or b"") > len(beats[0].stdout or b"")
+
+
+def test_heartbeat_skips_missed_beats(mocker: MockerFixture) -> None:
+    time_mock = mocker.patch("daemail.runner.time")
+    time_mock.monotonic.return_value = 100.0
+    beats: list[Progress] = []
+    beat = Heartbeat(interval=10, snapshot=mocker.Mock(), callback=beats.append)
+    assert beat.next_beat == 110
+    time_mock.monotonic.return_value = 109.5
+    beat.check()
+    assert beats == []
+    time_mock.monotonic.return_value = 110.0
+    beat.check()
+    assert len(beats) == 1
+    assert beat.next_beat == 120
+    # Fall behind by several beats:
+    time_mock.monotonic.return_value = 1000000.5
+    beat.check()
+    assert len(beats) == 2
+    assert beat.next_beat == 1000010
+
+
+def test_runner_heartbeat_after_output_closed() -> None:
+    # Heartbeats continue even once the command has closed its stdout
+    beats: list[Progress] = []
+    runner = CommandRunner(
+        no_stderr=True,
+        no_stdout=False,
+        split=False,
+        heartbeat=0.2,
+        on_heartbeat=beats.append,
+    )
+    r = runner.run(
+        sys.executable,
+        "-c",
+        "import os, time; print('bye', flush=True); os.close(1); time.sleep(1)",
+    )
+    assert isinstance(r, CommandResult)
+    assert r.rc == 0
+    r.close()
+    assert len(beats) >= 2
+    assert beats[-1].stdout == b"bye\n"
+
+
+def test_runner_tee_file(tmp_path: Path) -> None:
+    teefile = tmp_path / "tee.log"
+    teefile.write_bytes(b"previous\n")
+    runner = CommandRunner(
+        no_stderr=False, no_stdout=False, split=True, tee=str(teefile)
+    )
+    r = runner.run(*SCRIPT)
+    assert isinstance(r, CommandResult)
+    assert r.rc == 3
+    assert isinstance(r.stdout, SpooledOutput)
+    assert r.stdout.getvalue() == b"out 1\nout 2\n"
+    assert isinstance(r.stderr, SpooledOutput)
+    assert r.stderr.getvalue() == b"err 1\n"
+    r.close()
+    lines = teefile.read_bytes().splitlines(keepends=True)
+    assert lines[0] == b"previous\n"
+    assert sorted(lines[1:]) == [b"err 1\n", b"out 1\n", b"out 2\n"]
+
+
+def test_runner_tee_stdout(capfd: pytest.CaptureFixture[str]) -> None:
+    runner = CommandRunner(no_stderr=False, no_stdout=False, split=False, tee="-")
+    r = runner.run(*SCRIPT)
+    assert isinstance(r, CommandResult)
+    assert isinstance(r.stdout, SpooledOutput)
+    assert r.stdout.getvalue() == b"out 1\nerr 1\nout 2\n"
+    r.close()
+    assert capfd.readouterr() == ("out 1\nerr 1\nout 2\n", "")
+
+
+@pytest.mark.skipif(not Path("/dev/full").exists(), reason="Requires /dev/full")
+def test_runner_tee_write_error() -> None:
+    # Failing to write the copy doesn't affect capturing the output
+    runner = CommandRunner(
+        no_stderr=False, no_stdout=False, split=False, tee="/dev/full"
+    )
+    r = runner.run(*SCRIPT)
+    assert isinstance(r, CommandResult)
+    assert r.rc == 3
+    assert isinstance(r.stdout, SpooledOutput)
+    assert r.stdout.getvalue() == b"out 1\nerr 1\nout 2\n"
+    r.close()
+
+
+def test_async_runner_tee_file(tmp_path: Path) -> None:
+    teefile = tmp_path / "tee.log"
+    runner = AsyncCommandRunner(
+        no_stderr=False, no_stdout=False, split=False, tee=str(teefile)
+    )
+    r = runner.run(*SCRIPT)
+    assert isinstance(r, CommandResult)
+    assert isinstance(r.stdout, SpooledOutput)
+    assert r.stdout.getvalue() == b"out 1\nerr 1\nout 2\n"
+    r.close()
+    assert teefile.read_bytes() == b"out 1\nerr 1\nout 2\n"
+
+
+@pytest.mark.parametrize("split", [False, True])
+def test_runner_events(split: bool) -> None:
+    runner = CommandRunner(no_stderr=False, no_stdout=False, split=split, events=True)
+    r = runner.run(*SCRIPT)
+    assert isinstance(r, CommandResult)
+    assert r.rc == 3
+    assert r.events is not None
+    events = list(r.events.events())
+    assert b"".join(ev.data for ev in events if ev.stream == STDOUT) == (
+        b"out 1\nout 2\n"
+    )
+    assert b"".join(ev.data for ev in events if ev.stream == STDERR) == b"err 1\n"
+    assert isinstance(r.stdout, EventView)
+    if split:
+        assert r.stdout.getvalue() == b"out 1\nout 2\n"
+        assert isinstance(r.stderr, EventView)
+        assert r.stderr.getvalue() == b"err 1\n"
+    else:
+        assert sorted(r.stdout.getvalue().splitlines()) == [
+            b"err 1",
+            b"out 1",
+            b"out 2",
+        ]
+        assert r.stderr is None
+    r.close()
+
+
+@pytest.mark.parametrize("split", [False, True])
+def test_runner_sinks(tmp_path: Path, split: bool) -> None:
+    # Count lines, keep only the tail, and save a gzipped copy, all in one pass
+    made: dict[int, list[OutputSink]] = {}
+
+    def factory(stream: int) -> list[OutputSink]:
+        made[stream] = [
+            LineCounter(),
+            CompressedFile(str(tmp_path / f"{stream}.gz"), "gzip"),
+        ]
+        return made[stream]
+
+    runner = CommandRunner(
+        no_stderr=False, no_stdout=False, split=split, max_output=12, sinks=factory
+    )
+    r = runner.run(*SCRIPT)
+    assert isinstance(r, CommandResult)
+    assert r.rc == 3
+    assert r.sinks == made
+    assert isinstance(r.stdout, TruncatedOutput)
+    assert r.stdout.tail == b"out 2\n"
+    r.close()
+    if split:
+        assert set(made) == {STDOUT, STDERR}
+        counter = made[STDERR][0]
+        assert isinstance(counter, LineCounter)
+        assert counter.lines == 1
+        assert gzip.decompress((tmp_path / f"{STDERR}.gz").read_bytes()) == (b"err 1\n")
+        out = b"out 1\nout 2\n"
+    else:
+        assert set(made) == {STDOUT}
+        out = b"out 1\nerr 1\nout 2\n"
+    counter = made[STDOUT][0]
+    assert isinstance(counter, LineCounter)
+    assert counter.nbytes == len(out)
+    assert gzip.decompress((tmp_path / f"{STDOUT}.gz").read_bytes()) == out
+
+
+def test_async_runner_sinks() -> None:
+    hashers: dict[int, Hasher] = {}
+
+    def factory(stream: int) -> list[OutputSink]:
+        hashers[stream] = Hasher()
+        return [hashers[stream]]
+
+    runner = AsyncCommandRunner(
+        no_stderr=False, no_stdout=False, split=True, sinks=factory
+    )
+    r = runner.run(*SCRIPT)
+    assert isinstance(r, CommandResult)
+    r.close()
+    assert hashers[STDOUT].hexdigest() == sha256(b"out 1\nout 2\n").hexdigest()
+    assert hashers[STDERR].hexdigest() == sha256(b"err 1\n").hexdigest()
+
+
+@pytest.mark.skipif(sys.platform != "linux", reason="Requires /proc")
+def test_proc_usage() -> None:
+    p = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(5)"])
+    try:
+        ru = proc_usage(p.pid)
+        assert ru is not None
+        assert ru.maxrss > 0
+        assert ru.utime >= 0
+        assert ru.nvcsw >= 0
+    finally:
+        p.kill()
+        p.wait()
+    assert proc_usage(p.pid) is None
@@ -0,0 +1,60 @@
+from __future__ import annotations
+from collections.abc import Callable
+import gzip
+import hashlib
+import lzma
+from pathlib import Path
+import pytest
+from daemail.sinks import CompressedFile, Hasher, LineCounter
+
+
+@pytest.mark.parametrize(
+    "chunks,lines",
+    [
+        ([], 0),
+        ([b""], 0),
+        ([b"foo\n"], 1),
+        ([b"foo\nba", b"r\n"], 2),
+        ([b"foo\nbar"], 2),
+        ([b"foo", b"\n", b"\n"], 2),
+    ],
+)
+def test_line_counter(chunks: list[bytes], lines: int) -> None:
+    counter = LineCounter()
+    for c in chunks:
+        counter.write(c)
+    counter.close()
+    assert counter.lines == lines
+    assert counter.nbytes == sum(map(len, chunks))
+
+
+def test_hasher() -> None:
+    hasher = Hasher()
+    hasher.write(b"This is the ")
+    hasher.write(b"output.\n")
+    assert hasher.hexdigest() == hashlib.sha256(b"This is the output.\n").hexdigest()
+    md5 = Hasher("md5")
+    md5.write(b"abc")
+    assert md5.hexdigest() == hashlib.md5(b"abc").hexdigest()
+
+
+@pytest.mark.parametrize(
+    "method,decompress", [("gzip", gzip.decompress), ("xz", lzma.decompress)]
+)
+def test_compressed_file(
+    tmp_path: Path, method: str, decompress: Callable[[bytes], bytes]
+) -> None:
+    path = tmp_path / "out.bin"
+    sink = CompressedFile(str(path), method)
+    data = b"Line of output\n" * 10000
+    for i in range(0, len(data), 4096):
+        sink.write(data[i : i + 4096])
+    sink.close()
+    sink.close()
+    assert decompress(path.read_bytes()) == data
+
+
+def test_compressed_file_bad_method(tmp_path: Path) -> None:
+    with pytest.raises(ValueError):
+        CompressedFile(str(tmp_path / "out"), "lzw")
+    assert not (tmp_path / "out").exists()
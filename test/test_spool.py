@@ -0,0 +1,167 @@
+from __future__ import annotations
+import email
+from email import policy
+from email.headerregistry import Address
+from email.message import EmailMessage
+import mailbox
+import os
+from pathlib import Path
+from unittest.mock import MagicMock
+from mailbits import email2dict
+import pytest
+from daemail.digest import Digest
+from daemail.message import DraftMessage
+from daemail.senders import TryingSender
+from daemail.spool import Spool
+from daemail.spoold import SpoolWorker
+
+
+def mkmsg(subject: str) -> EmailMessage:
+    msg = EmailMessage()
+    msg["Subject"] = subject
+    msg["To"] = "null@test.test"
+    msg.set_content("This is the output.\n")
+    return msg
+
+
+def age(spool: Spool, key: str, secs: float) -> None:
+    mtime = spool.mtime(key) - secs
+    os.utime(os.path.join(spool.path, "new", key), (mtime, mtime))
+
+
+def test_spool(tmp_path: Path) -> None:
+    spool = Spool(str(tmp_path / "spool"))
+    assert spool.keys() == []
+    k1 = spool.add(mkmsg("First"))
+    k2 = spool.add(mkmsg("Second"))
+    assert k1 != k2
+    age(spool, k1, 10)
+    assert spool.keys() == [k1, k2]
+    assert os.listdir(tmp_path / "spool" / "tmp") == []
+    assert email2dict(spool.get(k1)) == email2dict(mkmsg("First"))
+    spool.remove(k1)
+    assert spool.keys() == [k2]
+
+
+def test_trying_sender_spools(tmp_path: Path) -> None:
+    draft = MagicMock()
+    draft.compile.return_value = mkmsg("Spooled")
+    sender = MagicMock()
+    mailer = TryingSender(
+        sender=sender,
+        dead_letter_path=str(tmp_path / "dead.letter"),
+        spool_dir=str(tmp_path / "spool"),
+    )
+    assert mailer.send(draft) == "spooled"
+    assert not sender.send.called
+    spool = Spool(str(tmp_path / "spool"))
+    (key,) = spool.keys()
+    assert spool.get(key)["Subject"] == "Spooled"
+
+
+def test_worker_delivers(tmp_path: Path) -> None:
+    spool = Spool(str(tmp_path / "spool"))
+    spool.add(mkmsg("First"))
+    spool.add(mkmsg("Second"))
+    sender = MagicMock()
+    mailer = TryingSender(sender=sender, dead_letter_path=str(tmp_path / "dead.letter"))
+    worker = SpoolWorker(spool=spool, mailer=mailer, max_age=3600)
+    assert worker.drain() == 0
+    assert sender.send.call_count == 2
+    assert spool.keys() == []
+    assert not (tmp_path / "dead.letter").exists()
+
+
+def test_worker_flushes_digests(tmp_path: Path) -> None:
+    spool = Spool(str(tmp_path / "spool"))
+    sender = MagicMock()
+    mailer = TryingSender(sender=sender, dead_letter_path=str(tmp_path / "dead.letter"))
+    draft = DraftMessage(
+        from_addr=None,
+        to_addrs=[Address(addr_spec="null@test.test")],
+        subject="[DONE] true",
+    )
+    draft.addtext("Exit Status: 0\n")
+    digest = Digest(
+        key="nightly", digest_dir=str(tmp_path / "digests"), window=600, max_size=1
+    )
+    key = digest.spool.add(draft.compile())
+    age(digest.spool, key, 600)
+    worker = SpoolWorker(
+        spool=spool, mailer=mailer, max_age=3600, digest_dir=digest.digest_dir
+    )
+    assert worker.drain() == 0
+    (sent,) = sender.send.call_args[0]
+    assert sent["Subject"] == "[DIGEST] nightly: 1 report"
+    assert sent["To"] == "null@test.test"
+    assert digest.spool.keys() == []
+    assert spool.keys() == []
+
+
+def test_worker_retries(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    spool = Spool(str(tmp_path / "spool"))
+    key = spool.add(mkmsg("Flaky"))
+    sender = MagicMock()
+    mailer = TryingSender(sender=sender, dead_letter_path=str(tmp_path / "dead.letter"))
+    sender.send.side_effect = [OSError("Connection refused"), None]
+    worker = SpoolWorker(spool=spool, mailer=mailer, max_age=3600, min_delay=60)
+    now = spool.mtime(key)
+    monkeypatch.setattr("time.time", lambda: now)
+    assert worker.drain() == 1
+    assert worker.retries == {key: (1, now + 60)}
+    # Not due yet:
+    assert worker.drain() == 1
+    assert sender.send.call_count == 1
+    now += 60
+    assert worker.drain() == 0
+    assert sender.send.call_count == 2
+    assert spool.keys() == []
+    assert worker.retries == {}
+
+
+def test_worker_backoff(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    spool = Spool(str(tmp_path / "spool"))
+    key = spool.add(mkmsg("Down"))
+    sender = MagicMock()
+    mailer = TryingSender(sender=sender, dead_letter_path=str(tmp_path / "dead.letter"))
+    sender.send.side_effect = OSError("Connection refused")
+    worker = SpoolWorker(
+        spool=spool, mailer=mailer, max_age=86400, min_delay=60, max_delay=300
+    )
+    now = spool.mtime(key)
+    monkeypatch.setattr("time.time", lambda: now)
+    delays = []
+    for _ in range(5):
+        worker.drain()
+        _, next_try = worker.retries[key]
+        delays.append(next_try - now)
+        now = next_try
+    assert delays == [60, 120, 240, 300, 300]
+
+
+def test_worker_expires(tmp_path: Path) -> None:
+    spool = Spool(str(tmp_path / "spool"))
+    key = spool.add(mkmsg("Doomed"))
+    age(spool, key, 7200)
+    sender = MagicMock()
+    mailer = TryingSender(sender=sender, dead_letter_path=str(tmp_path / "dead.letter"))
+    sender.send.side_effect = OSError("Connection refused")
+    worker = SpoolWorker(spool=spool, mailer=mailer, max_age=3600)
+    assert worker.drain() == 0
+    assert spool.keys() == []
+    assert worker.retries == {}
+    mbox = mailbox.mbox(str(tmp_path / "dead.letter"))
+    (mkey,) = mbox.keys()
+    dead = email.message_from_bytes(
+        mbox.get_bytes(mkey),
+        # <https://github.com/python/typeshed/issues/13273>
+        policy=policy.default,  # type: ignore[arg-type]
+    )
+    mbox.close()
+    assert dead["Subject"] == "Doomed"
+    assert dead.get_content_type() == "multipart/mixed"
+    annex = list(dead.iter_parts())[-1].get_content()
+    assert annex.startswith(
+        "Additionally, an error occurred while trying to send this e-mail:\n\n"
+    )
+    assert "OSError: Connection refused" in annex
@@ -0,0 +1,242 @@
+from __future__ import annotations
+import base64
+import binascii
+from collections.abc import Iterator
+import copy
+import email
+from email import policy
+from email.headerregistry import Address
+from email.message import EmailMessage
+import mailbox
+from pathlib import Path
+import socket
+from typing import Any
+from aiosmtpd.controller import Controller
+from outgoing import from_dict
+import pytest
+from daemail import stream
+from daemail.capture import SpooledOutput
+from daemail.message import DraftMessage
+from daemail.stream import (
+    encode_base64,
+    encode_qp,
+    escape_from_lines,
+    expand_deferred,
+    has_deferred,
+    normalize_newlines,
+    send_with,
+    write_mbox,
+    write_message,
+    written_size,
+)
+
+DATA = bytes(range(256)) * 4000
+
+
+class ContentHandler:
+    def __init__(self) -> None:
+        self.messages: list[bytes] = []
+        self.recipients: list[list[str]] = []
+
+    async def handle_DATA(self, _server: Any, _session: Any, envelope: Any) -> str:
+        self.messages.append(envelope.original_content)
+        self.recipients.append(envelope.rcpt_tos)
+        return "250 OK"
+
+
+@pytest.fixture
+def smtpd() -> Iterator[tuple[ContentHandler, int]]:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    handler = ContentHandler()
+    controller = Controller(handler, hostname="127.0.0.1", port=port)
+    controller.start()
+    try:
+        yield (handler, port)
+    finally:
+        controller.stop()
+
+
+@pytest.fixture
+def blob() -> Iterator[SpooledOutput]:
+    out = SpooledOutput(1024)
+    out.write(DATA)
+    assert out.rolled_over
+    try:
+        yield out
+    finally:
+        out.close()
+
+
+def mkdraft(blob: SpooledOutput) -> DraftMessage:
+    draft = DraftMessage(
+        from_addr=Address(addr_spec="me@example.nil"),
+        to_addrs=[Address(addr_spec="null@test.test")],
+        subject="Deferred output",
+    )
+    draft.addtext("From the top.\n.\nThis line follows a lone period.\n")
+    draft.addmimeblob(blob, "application/octet-stream", "x.dat")
+    return draft
+
+
+def expanded(msg: EmailMessage, blob: SpooledOutput) -> EmailMessage:
+    # Copy the message but not the blob it refers to
+    full = copy.deepcopy(msg, {id(blob): blob})
+    expand_deferred(full)
+    return full
+
+
+def attachment_content(raw: bytes) -> bytes:
+    msg = email.message_from_bytes(raw, policy=policy.default)
+    assert isinstance(msg, EmailMessage)
+    (att,) = msg.iter_attachments()
+    assert isinstance(att, EmailMessage)
+    content = att.get_content()
+    assert isinstance(content, bytes)
+    return content
+
+
+def test_compile_deferred(blob: SpooledOutput) -> None:
+    msg = mkdraft(blob).compile(deferred=True)
+    assert has_deferred(msg)
+    assert DATA.hex()[:64] not in str(msg)
+    full = expanded(msg, blob)
+    assert not has_deferred(full)
+    assert attachment_content(full.as_bytes()) == DATA
+
+
+def test_compile_expands_by_default(blob: SpooledOutput) -> None:
+    msg = mkdraft(blob).compile()
+    assert not has_deferred(msg)
+    assert attachment_content(msg.as_bytes()) == DATA
+
+
+@pytest.mark.parametrize("linesep", ["\n", "\r\n"])
+def test_write_message(blob: SpooledOutput, linesep: str) -> None:
+    msg = mkdraft(blob).compile(deferred=True)
+    chunks: list[bytes] = []
+    write_message(msg, chunks.append, linesep=linesep)
+    data = b"".join(chunks)
+    assert data == expanded(msg, blob).as_bytes(
+        policy=msg.policy.clone(linesep=linesep)
+    )
+    assert written_size(msg) == len(data)
+    # Writing doesn't consume the deferred parts:
+    assert has_deferred(msg)
+
+
+def test_write_mbox(blob: SpooledOutput, tmp_path: Path) -> None:
+    path = tmp_path / "mbox"
+    mbox = mailbox.mbox(path)
+    mbox.add(email.message_from_string("Subject: First\n\nFrom here on.\n"))
+    mbox.close()
+    msg = mkdraft(blob).compile(deferred=True)
+    write_mbox(str(path), msg)
+    write_mbox(str(path), msg)
+    mbox = mailbox.mbox(path)
+    try:
+        msgs = list(mbox)
+    finally:
+        mbox.close()
+    assert [m["Subject"] for m in msgs] == [
+        "First",
+        "Deferred output",
+        "Deferred output",
+    ]
+    assert attachment_content(msgs[2].as_bytes()) == DATA
+
+
+def test_send_with_mbox(blob: SpooledOutput, tmp_path: Path) -> None:
+    path = tmp_path / "mbox"
+    msg = mkdraft(blob).compile(deferred=True)
+    with from_dict({"method": "mbox", "path": str(path)}) as sender:
+        send_with(sender, msg)
+    assert has_deferred(msg)
+    mbox = mailbox.mbox(path)
+    try:
+        (m,) = list(mbox)
+    finally:
+        mbox.close()
+    assert attachment_content(m.as_bytes()) == DATA
+
+
+def test_send_with_smtp(blob: SpooledOutput, smtpd: tuple[ContentHandler, int]) -> None:
+    handler, port = smtpd
+    msg = mkdraft(blob).compile(deferred=True)
+    sender = from_dict({"method": "smtp", "host": "127.0.0.1", "port": port})
+    send_with(sender, msg)
+    assert has_deferred(msg)
+    (raw,) = handler.messages
+    assert raw == expanded(msg, blob).as_bytes(policy=msg.policy.clone(linesep="\r\n"))
+    assert b"\r\n.\r\nThis line follows a lone period." in raw
+    assert attachment_content(raw) == DATA
+    assert written_size(msg) == len(raw)
+
+
+def test_send_with_smtp_bcc(
+    blob: SpooledOutput, smtpd: tuple[ContentHandler, int]
+) -> None:
+    handler, port = smtpd
+    msg = mkdraft(blob).compile(deferred=True)
+    msg["Bcc"] = "hidden@test.test"
+    sender = from_dict({"method": "smtp", "host": "127.0.0.1", "port": port})
+    send_with(sender, msg)
+    (raw,) = handler.messages
+    assert b"hidden@test.test" not in raw
+    assert handler.recipients == [["null@test.test", "hidden@test.test"]]
+    assert attachment_content(raw) == DATA
+    # The message itself still has its Bcc header, e.g., for the dead letter
+    # mbox:
+    assert msg["Bcc"] == "hidden@test.test"
+
+
+def test_send_with_other_sender(blob: SpooledOutput) -> None:
+    sent: list[EmailMessage] = []
+
+    class ListSender:
+        def send(self, msg: EmailMessage) -> None:
+            sent.append(msg)
+
+    msg = mkdraft(blob).compile(deferred=True)
+    send_with(ListSender(), msg)  # type: ignore[arg-type]
+    (m,) = sent
+    assert not has_deferred(m)
+    assert attachment_content(m.as_bytes()) == DATA
+
+
+@pytest.mark.parametrize("linesep", [b"\n", b"\r\n"])
+def test_encode_base64(linesep: bytes) -> None:
+    chunks = [DATA[i : i + 1000] for i in range(0, len(DATA), 1000)]
+    expected = base64.encodebytes(DATA).replace(b"\n", linesep)
+    assert b"".join(encode_base64(chunks, linesep)) == expected
+
+
+def test_normalize_newlines() -> None:
+    chunks = [b"foo\r", b"\nbar\r", b"\r\n", b"\r", b"baz\r\nquux\r", b"", b"\n"]
+    assert b"".join(normalize_newlines(chunks)) == b"foo\nbar\n\n\nbaz\nquux\n"
+
+
+@pytest.mark.parametrize("linesep", [b"\n", b"\r\n"])
+def test_encode_qp(monkeypatch: pytest.MonkeyPatch, linesep: bytes) -> None:
+    monkeypatch.setattr(stream, "QP_CHUNK_SIZE", 100)
+    text = (
+        "caf\u00e9 = ok \n".encode("utf-8") * 20
+        + b"x " * 500
+        + b"\n\tindented\t\n"
+        + b"y" * 1000
+    )
+    chunks = [text[i : i + 7] for i in range(0, len(text), 7)]
+    encoded = b"".join(encode_qp(chunks, linesep))
+    lines = encoded.split(linesep)
+    assert all(len(ln) <= 76 for ln in lines)
+    assert not any(b"\n" in ln or b"\r" in ln for ln in lines)
+    assert binascii.a2b_qp(encoded.replace(linesep, b"\n")) == text
+
+
+def test_escape_from_lines() -> None:
+    chunks = [b"From a\nFr", b"om b\nx From c\n", b"F", b"r", b"o", b"m", b" d\n"]
+    chunks += [b"Fro", b"\nFrom", b"\n", b"Fr"]
+    assert b"".join(escape_from_lines(chunks)) == (
+        b">From a\n>From b\nx From c\n>From d\nFro\nFrom\nFr"
+    )
@@ -0,0 +1,36 @@
+from __future__ import annotations
+import re
+import pytest
+from daemail.timings import NullTimings, Stage, Timings
+
+
+def test_timings() -> None:
+    timings = Timings()
+    assert timings.enabled
+    with timings.stage("run") as st:
+        st.nbytes = 1024
+    with timings.stage("report"):
+        pass
+    assert [st.name for st in timings.stages] == ["run", "report"]
+    for st in timings.stages:
+        assert st.end >= st.start
+    assert timings.stages[0].nbytes == 1024
+    assert timings.stages[1].nbytes is None
+    assert re.fullmatch(r"run=\d+\.\d{6}s/1024B; report=\d+\.\d{6}s", str(timings))
+
+
+def test_timings_records_failed_stage() -> None:
+    timings = Timings()
+    with pytest.raises(RuntimeError):
+        with timings.stage("send"):
+            raise RuntimeError("Oh no!")
+    assert [st.name for st in timings.stages] == ["send"]
+
+
+def test_null_timings() -> None:
+    timings = NullTimings()
+    assert not timings.enabled
+    with timings.stage("run") as st:
+        assert isinstance(st, Stage)
+    assert timings.stages == []
+    assert str(timings) == ""
@@ -1,8 +1,22 @@
 from __future__ import annotations
 from datetime import datetime, timedelta, timezone
+import signal
 import sys
+from eletter import reply_quote
 import pytest
-from daemail.util import dt2stamp, get_mime_type, multiline822, show_argv
+from daemail.util import (
+    decode_chunks,
+    dt2stamp,
+    get_mime_type,
+    multiline822,
+    parse_batch,
+    parse_duration,
+    parse_signal,
+    parse_size,
+    reply_quote_chunks,
+    show_argv,
+    trim_split_chars,
+)
 
 w4 = timezone(timedelta(hours=-4))
 
@@ -152,3 +166,147 @@ def test_multiline822(sin: str, sout: str) -> None:
 )
 def test_get_mime_type(filename: str, mtype: str) -> None:
     assert get_mime_type(filename) == mtype
+
+
+@pytest.mark.parametrize("s", ["TERM", "SIGTERM", "term", "sigterm", "15"])
+def test_parse_signal(s: str) -> None:
+    assert parse_signal(s) is signal.SIGTERM
+
+
+@pytest.mark.parametrize("s", ["", "SIG", "TERMINATE", "-15", "1000"])
+def test_parse_signal_invalid(s: str) -> None:
+    with pytest.raises(ValueError):
+        parse_signal(s)
+
+
+def test_parse_batch() -> None:
+    assert parse_batch(
+        "# Comment\n"
+        "\n"
+        "echo 'Hello, world!'\n"
+        "  ls -l /tmp  # List files\n"
+        'sh -c "exit 1"\n'
+    ) == [
+        ["echo", "Hello, world!"],
+        ["ls", "-l", "/tmp"],
+        ["sh", "-c", "exit 1"],
+    ]
+
+
+def test_parse_batch_invalid() -> None:
+    with pytest.raises(ValueError) as excinfo:
+        parse_batch("true\necho 'unclosed\n")
+    assert str(excinfo.value) == "line 2: No closing quotation"
+
+
+@pytest.mark.parametrize(
+    "s,secs",
+    [
+        ("0", 0),
+        ("90", 90),
+        ("2.5", 2.5),
+        ("30s", 30),
+        ("10m", 600),
+        ("1.5h", 5400),
+        ("5d", 432000),
+        ("1h30m", 5400),
+        ("1H 30M", 5400),
+    ],
+)
+def test_parse_duration(s: str, secs: float) -> None:
+    assert parse_duration(s) == secs
+
+
+@pytest.mark.parametrize("s", ["", "m", "-1", "10x", "1h-30m", "1.h"])
+def test_parse_duration_invalid(s: str) -> None:
+    with pytest.raises(ValueError):
+        parse_duration(s)
+
+
+@pytest.mark.parametrize(
+    "s,size",
+    [
+        ("0", 0),
+        ("512", 512),
+        ("512B", 512),
+        ("64K", 65536),
+        ("64k", 65536),
+        ("64KiB", 65536),
+        ("64 KB", 65536),
+        ("10M", 10485760),
+        ("1G", 1073741824),
+        ("2T", 2199023255552),
+    ],
+)
+def test_parse_size(s: str, size: int) -> None:
+    assert parse_size(s) == size
+
+
+@pytest.mark.parametrize("s", ["", "K", "-1", "1.5M", "10X", "10 MBs"])
+def test_parse_size_invalid(s: str) -> None:
+    with pytest.raises(ValueError):
+        parse_size(s)
+
+
+@pytest.mark.parametrize(
+    "chunks",
+    [
+        [],
+        [""],
+        ["foo"],
+        ["foo\n"],
+        ["foo\nbar\n"],
+        ["fo", "o\nb", "ar"],
+        ["foo\r", "\nbar\r", "\n"],
+        ["foo\r", "bar"],
+        ["\n", "\n", "\n"],
+        ["> already quoted\n", "not quoted\n"],
+        [">", " already quoted\n>", "> doubly quoted\n"],
+        [">", "", "not quoted\n"],
+        ["a very long line ", "that arrives in ", "many pieces\n", "> x"],
+        ["foo\x0cbar\u2028baz\x85"],
+    ],
+)
+def test_reply_quote_chunks(chunks: list[str]) -> None:
+    assert "".join(reply_quote_chunks(chunks)) == reply_quote("".join(chunks))
+
+
+def test_reply_quote_chunks_long_line() -> None:
+    # Pieces of an unterminated line are passed through without waiting for
+    # the end of the line
+    quoted = reply_quote_chunks(["x" * 10] * 3)
+    assert next(quoted) == "> " + "x" * 10
+    assert next(quoted) == "x" * 10
+    assert next(quoted) == "x" * 10
+    assert list(quoted) == ["\n"]
+
+
+def test_decode_chunks() -> None:
+    blob = "àéîøü\n".encode("utf-8")
+    chunks = [blob[i : i + 1] for i in range(len(blob))]
+    assert "".join(decode_chunks(chunks, "utf-8")) == "àéîøü\n"
+
+
+def test_decode_chunks_invalid() -> None:
+    with pytest.raises(UnicodeDecodeError):
+        "".join(decode_chunks([b"\xc3", b"("], "utf-8"))
+    with pytest.raises(UnicodeDecodeError):
+        "".join(decode_chunks([b"abc\xc3"], "utf-8"))
+
+
+@pytest.mark.parametrize(
+    "head,tail,trimmed",
+    [
+        (b"caf\xc3\xa9", b"na\xc3\xafve", (b"caf\xc3\xa9", b"na\xc3\xafve")),
+        (b"caf\xc3", b"\xa9 na\xc3\xafve", (b"caf", b" na\xc3\xafve")),
+        (b"\xe2\x82", b"\xac!", (b"", b"!")),
+        (b"\xf0\x9f\x98", b"\x80", (b"", b"")),
+        (b"\xff\xc3", b"\xa9", (b"\xff\xc3", b"")),
+        (b"abc", b"\x80\x80\x80\x80\x80", (b"abc", b"\x80\x80\x80\x80\x80")),
+        (b"abc", b"d\xffe", (b"abc", b"d\xffe")),
+    ],
+)
+def test_trim_split_chars(
+    head: bytes, tail: bytes, trimmed: tuple[bytes, bytes]
+) -> None:
+    assert trim_split_chars(head, tail, "utf-8") == trimmed